@@ -7,12 +7,17 @@
 @time: 2/29/24 15:14
 """
 from typing import List
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
 import json
+import os
+import threading
 from pydantic import BaseModel
 from TtsStream import TtsStream
+from ProviderScheduler import ProviderScheduler
+from StepOpeningCache import StepOpeningCache
 from PromptManager import PromptManager
-from AgentPromptHandler import AgentPromptHandler
-from MessageStorageHandler import MessageStorageHandler
+from ProviderClients import ProviderClients
 import uuid
 import time
 import re
@@ -48,85 +53,160 @@ class ChatStream:
     """
     ChatStream: AI chat with OpenAI/Anthropic, streams the output via server-sent events.
     Using this class need to pass in the full messages history, and the provider (openai or anthropic).
+    The provider SDK streams are blocking, they are read on the executor and their tokens handed to the event loop.
     """
+    executor = None  # worker threads reading the provider streams, LLM_STREAM_WORKERS of them
+    executor_lock = threading.Lock()
 
-    def __init__(self, sio_server, openai_client, anthropic_client):
+    def __init__(self, sio_server, openai_client, anthropic_client, tts_encoding: str = TtsStream.DEFAULT_ENCODING,
+                 trace=None):
         self.openai_client = openai_client
         self.anthropic_client = anthropic_client
         self.sio_server = sio_server
 
         self.tts_session_id = str(uuid.uuid4())
-        self.tts = TtsStream(self.tts_session_id)
-        self.agent_prompt_handler = AgentPromptHandler()
+        self.trace = trace  # SessionTrace of the session in capture mode, None otherwise
+        self.tts = TtsStream(self.tts_session_id, tts_encoding, trace)
+        self.provider_scheduler = ProviderScheduler.get_instance()
+        self.session_key = self.tts_session_id  # fair queuing key in the provider scheduler, the sid once known
+        provider_clients = ProviderClients.get_instance()
+        self.agent_prompt_handler = provider_clients.get("agent_prompt_handler")
         self.user_message_timestamp = str(int(time.time() * 1000))  # unix timestamp in milliseconds
-        self.message_storage_handler = MessageStorageHandler()
+        self.message_storage_handler = provider_clients.get("message_storage_handler")
         self.thread_id = None
         self.user_id = None
         self.user_message_content = None
         self.step_id = None
+        self.step_prompt = None  # stored prompt of the current step, as read by __messages_processor
+        self.history_bytes = 0  # size of the message history this turn holds, for the memory diagnostics
+        self.response_text = None  # the whole reply, once it has been streamed
+        self.prepared_messages = None  # messages of the turn, once __prepare_turn has run
+        self.llm_priority = ProviderScheduler.PRIORITY_FIRST  # the candidate is waiting on the first tokens
 
     async def stream_chat(self, chat_stream_model: ChatStreamModel, requested_provider, current_step, agent_id, sid,
-                          user_id):
+                          user_id, token_source=None):
+        """
+        Stream the reply of a turn to the client.
+        :param token_source: The tokens of a reply started ahead by speculate, instead of a new provider call.
+        """
+        if self.prepared_messages is None:
+            self.__prepare_turn(chat_stream_model, current_step, agent_id, sid, user_id)
+        messages = self.prepared_messages
+        opening = None
+        if token_source is None and self.__is_step_transition(chat_stream_model.messages):
+            opening = await asyncio.to_thread(StepOpeningCache.get_instance().get, agent_id, str(current_step),
+                                              self.step_prompt, self.tts.encoding)
+        if opening:
+            generator = self.__opening_generator(opening, requested_provider)
+        else:
+            generator = self.__chat_generator(messages, requested_provider, token_source)
+        try:
+            async for message in generator:
+                await self.sio_server.emit("downlink_chat_response", message, room=sid)
+        finally:
+            await generator.aclose()  # on cancel too, so the provider slot is released now and not at finalization
+
+    def speculate(self, chat_stream_model: ChatStreamModel, requested_provider, current_step, agent_id, sid,
+                  user_id):
+        """
+        Start the provider stream of a turn before the turn is confirmed (speculative generation), nothing is sent
+        or synthesized. The tokens go back in through stream_chat(token_source=...) if the turn is confirmed.
+        :return: The provider token stream.
+        """
+        self.llm_priority = ProviderScheduler.PRIORITY_NORMAL  # may be thrown away, confirmed turns go first
+        self.__prepare_turn(chat_stream_model, current_step, agent_id, sid, user_id)
+        return self.__provider_stream(self.prepared_messages, requested_provider)
+
+    def __prepare_turn(self, chat_stream_model: ChatStreamModel, current_step, agent_id, sid, user_id):
         self.user_id = user_id
+        self.session_key = sid
+        self.tts.session_key = sid
         self.thread_id = chat_stream_model.thread_id
         self.step_id = chat_stream_model.current_step
         messages = self.__messages_processor(chat_stream_model.messages, agent_id, current_step)
         self.user_message_content = messages[-1]["content"]
-        async for message in self.__chat_generator(messages, requested_provider):
-            await self.sio_server.emit("downlink_chat_response", message, room=sid)
+        self.history_bytes = sum(len(message["content"]) for message in messages)
+        self.prepared_messages = messages
+
+    @staticmethod
+    def __is_step_transition(messages: dict[int, dict[str, str | int]]) -> bool:
+        """
+        Whether the last message is the first one of a new step, same rule as the feedback processing.
+        """
+        if len(messages) < 2:
+            return False
+        keys = sorted(messages.keys())
+        last_step = messages[keys[-1]].get("step")
+        second_last_step = messages[keys[-2]].get("step")
+        return isinstance(last_step, int) and isinstance(second_last_step, int) and last_step == second_last_step + 1
+
+    async def __opening_generator(self, opening: dict, requested_provider):
+        """
+        Answer a step transition with the precomputed opening of the step, its audio is already synthesized.
+        """
+        await asyncio.to_thread(self.tts.put_audio, opening["audio"], "0")
+        if self.trace:
+            self.trace.record("step_opening", turn=self.user_message_timestamp, chars=len(opening["text"]))
+        yield {"response": opening["text"], "tts_session_id": self.tts_session_id, "have_new_chunk": True,
+               "new_chunk_id": 0, "first_yield": True, "last_yield": True}
+        self.response_text = opening["text"]
+        self.__store_messages(requested_provider, opening["text"])
 
-    async def __chat_generator(self, messages: List[dict[str, str]], requested_provider):
+    async def __chat_generator(self, messages: List[dict[str, str]], requested_provider, token_source=None):
         """
         Chat generator.
         :param messages:
+        :param token_source: Tokens already being generated, used instead of a new provider stream.
         :return:
         """
-        if requested_provider == "openai":
-            print("Using OpenAI")
-            stream = self.__openai_chat_generator(messages)
-        elif requested_provider == "anthropic":
-            print("Using Anthropic")
-            stream = self.__anthropic_chat_generator(messages)
-        else:
-            stream = self.__openai_chat_generator(messages)
+        stream = token_source if token_source is not None else self.__provider_stream(messages, requested_provider)
         response_text = ""
         chunk_id = -1  # chunk_id starts from 0, -1 means no chunk has been created
         have_new_chunk = False  # flag to indicate if a new chunk has been created
         sentence_ender = [".", "?", "!"]
         chunk_buffer = ""
         initiate_new_response = True
-        async for text_chunk in stream:
-            new_text = text_chunk
-            response_text += new_text
-            if len(chunk_buffer.split()) > (16 + (chunk_id * 13)):  # dynamically adjust the chunk size
-                if sentence_ender[0] in new_text and not chunk_buffer[-1].isnumeric():  # if the chunk contains a sentence ender . and the last character is not a number
-                    if not ("{https://" in chunk_buffer and "}" not in chunk_buffer):
-                        # do not split the chunk if it contains a URL that is not fully enclosed in curly braces
-                        chunk_buffer, chunk_id = self.__process_chunking(sentence_ender[0], new_text, chunk_buffer,
+        if self.trace:
+            self.trace.record("llm_start", turn=self.user_message_timestamp, provider=requested_provider)
+        try:
+            async for text_chunk in stream:
+                new_text = text_chunk
+                if self.trace:
+                    self.trace.record("llm_token", turn=self.user_message_timestamp, text=new_text)
+                response_text += new_text
+                if len(chunk_buffer.split()) > (16 + (chunk_id * 13)):  # dynamically adjust the chunk size
+                    if sentence_ender[0] in new_text and not chunk_buffer[-1].isnumeric():  # if the chunk contains a sentence ender . and the last character is not a number
+                        if not ("{https://" in chunk_buffer and "}" not in chunk_buffer):
+                            # do not split the chunk if it contains a URL that is not fully enclosed in curly braces
+                            chunk_buffer, chunk_id = self.__process_chunking(sentence_ender[0], new_text,
+                                                                             chunk_buffer, chunk_id)
+                            have_new_chunk = True
+                        else:
+                            chunk_buffer += new_text
+                    elif sentence_ender[1] in new_text:  # if the chunk contains a sentence ender ?
+                        chunk_buffer, chunk_id = self.__process_chunking(sentence_ender[1], new_text, chunk_buffer,
+                                                                         chunk_id)
+                        have_new_chunk = True
+                    elif sentence_ender[2] in new_text:  # if the chunk contains a sentence ender !
+                        chunk_buffer, chunk_id = self.__process_chunking(sentence_ender[2], new_text, chunk_buffer,
                                                                          chunk_id)
                         have_new_chunk = True
-                    else:
+                    else:  # if the chunk does not contain a sentence ender
                         chunk_buffer += new_text
-                elif sentence_ender[1] in new_text:  # if the chunk contains a sentence ender ?
-                    chunk_buffer, chunk_id = self.__process_chunking(sentence_ender[1], new_text, chunk_buffer,
-                                                                     chunk_id)
-                    have_new_chunk = True
-                elif sentence_ender[2] in new_text:  # if the chunk contains a sentence ender !
-                    chunk_buffer, chunk_id = self.__process_chunking(sentence_ender[2], new_text, chunk_buffer,
-                                                                     chunk_id)
-                    have_new_chunk = True
-                else:  # if the chunk does not contain a sentence ender
+                else:  # if the chunk is less than 21 words
                     chunk_buffer += new_text
-            else:  # if the chunk is less than 21 words
-                chunk_buffer += new_text
-            first_yield = False
-            if initiate_new_response:
-                initiate_new_response = False
-                first_yield = True
-            yield {"response": response_text, "tts_session_id": self.tts_session_id, "have_new_chunk": have_new_chunk,
-                   "new_chunk_id": chunk_id,
-                   "first_yield": first_yield, "last_yield": False}
-            have_new_chunk = False
+                first_yield = False
+                if initiate_new_response:
+                    initiate_new_response = False
+                    first_yield = True
+                yield {"response": response_text, "tts_session_id": self.tts_session_id,
+                       "have_new_chunk": have_new_chunk, "new_chunk_id": chunk_id,
+                       "first_yield": first_yield, "last_yield": False}
+                have_new_chunk = False
+        finally:
+            await stream.aclose()  # releases the provider slot held by the stream, on cancel too
+        if self.trace:
+            self.trace.record("llm_end", turn=self.user_message_timestamp, chars=len(response_text))
         # Process any remaining text in the chunk_buffer after the stream has finished
         test_chunk_buffer = chunk_buffer.strip()
         test_chunk_buffer = re.sub(r"\[.*?]|\{.*?}", "", test_chunk_buffer)
@@ -147,30 +227,46 @@ class ChatStream:
                    "new_chunk_id": chunk_id,
                    "first_yield": False, "last_yield": True}
         # finally store human and AI message into AWS dynamo db
+        self.response_text = response_text
+        self.__store_messages(requested_provider, response_text)
+
+    def __store_messages(self, requested_provider, response_text: str):
         self.message_storage_handler.put_message(self.thread_id, self.user_id, "human", self.user_message_content,
                                                  self.step_id, self.user_message_timestamp)
         self.message_storage_handler.put_message(self.thread_id, self.user_id, requested_provider, response_text,
                                                  self.step_id)
 
-    async def __openai_chat_generator(self, messages: List[dict[str, str]]):
+    def __provider_stream(self, messages: List[dict[str, str]], requested_provider):
+        if requested_provider == "openai":
+            print("Using OpenAI")
+            return self.__openai_chat_generator(messages)
+        elif requested_provider == "anthropic":
+            print("Using Anthropic")
+            return self.__anthropic_chat_generator(messages)
+        return self.__openai_chat_generator(messages)
+
+    def __openai_chat_generator(self, messages: List[dict[str, str]]):
         """
         OpenAI chat generator.
         :param messages:
         :return:
         """
-        with self.openai_client.chat.completions.create(
-                model="gpt-4o",
-                messages=messages,
-                stream=True,
-                max_tokens=512,
-                temperature=1,
-        ) as stream:
-            for chunk in stream:
-                if chunk.choices[0].delta.content is not None:
-                    new_text = chunk.choices[0].delta.content
-                    yield new_text
+        def texts():
+            with self.openai_client.chat.completions.create(
+                    model="gpt-4o",
+                    messages=messages,
+                    stream=True,
+                    max_tokens=512,
+                    temperature=1,
+            ) as stream:
+                for chunk in stream:
+                    if chunk.choices[0].delta.content is not None:
+                        new_text = chunk.choices[0].delta.content
+                        yield new_text
 
-    async def __anthropic_chat_generator(self, messages: List[dict[str, str]]):
+        return self.__stream_in_thread("openai", texts)
+
+    def __anthropic_chat_generator(self, messages: List[dict[str, str]]):
         """
         Anthropic chat generator.
         :param messages:
@@ -180,15 +276,70 @@ class ChatStream:
         if messages[0]["role"] == "system":
             system_message = messages.pop(0)
             system_message_content = system_message["content"]
-        with self.anthropic_client.messages.stream(
-                system=system_message_content,
-                max_tokens=512,
-                messages=messages,
-                model="claude-3-7-sonnet-latest",
-        ) as stream:
-            for text in stream.text_stream:
-                if text is not None:
-                    yield text
+
+        def texts():
+            with self.anthropic_client.messages.stream(
+                    system=system_message_content,
+                    max_tokens=512,
+                    messages=messages,
+                    model="claude-3-7-sonnet-latest",
+            ) as stream:
+                for text in stream.text_stream:
+                    if text is not None:
+                        yield text
+
+        return self.__stream_in_thread("anthropic", texts)
+
+    @classmethod
+    def get_executor(cls) -> ThreadPoolExecutor:
+        with cls.executor_lock:
+            if cls.executor is None:
+                cls.executor = ThreadPoolExecutor(max_workers=int(os.getenv("LLM_STREAM_WORKERS", "64")),
+                                                  thread_name_prefix="llm_stream")
+        return cls.executor
+
+    async def __stream_in_thread(self, provider: str, texts):
+        """
+        Read a blocking provider stream on the executor and yield its texts on the event loop, holding a provider
+        slot for the whole stream (the concurrency limit counts streams in flight).
+        Closing this generator (a cancelled turn) stops the worker at its next token, which closes the SDK stream.
+        :param texts: Generator function yielding the texts, called in the worker.
+        """
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+        stop = threading.Event()
+
+        def put(kind: str, value=None):
+            try:
+                loop.call_soon_threadsafe(queue.put_nowait, (kind, value))
+            except RuntimeError:
+                pass  # the loop is closed, nobody is waiting any more
+
+        def read():
+            stream = texts()
+            try:
+                for text in stream:
+                    if stop.is_set():
+                        return
+                    put("text", text)
+            except Exception as e:
+                put("error", e)
+            finally:
+                stream.close()
+                put("end")
+
+        async with self.provider_scheduler.async_slot(provider, self.session_key, self.llm_priority):
+            loop.run_in_executor(self.get_executor(), read)
+            try:
+                while True:
+                    kind, value = await queue.get()
+                    if kind == "error":
+                        raise value
+                    if kind == "end":
+                        return
+                    yield value
+            finally:
+                stop.set()
 
     def __process_chunking(self, sentence_ender: str, new_text: str, chunk_buffer: str, chunk_id: int):
         """
@@ -227,11 +378,11 @@ class ChatStream:
                                 4. What is our client’s current footprint?
                                 Our client has significant penetration throughout the US, but not internationally."""}]
         current_step = self.agent_prompt_handler.get_agent_prompt(agent_id, str(current_step))
+        self.step_prompt = current_step
         current_step_info = {}
         if current_step:
             current_step_info = json.loads(current_step)
-        messages_list = [{"role": "system",
-                          "content": f"{PromptManager.BASE_ROLE} Please follow this instruction: {current_step_info['instruction']} Here's some information for you, you should not give the info to candidate directly: {current_step_info['information']}"}]
+        messages_list = [{"role": "system", "content": PromptManager.step_system_prompt(current_step_info)}]
         print(messages_list)
         for key in sorted(messages.keys()):
             messages_list.append({"role": messages[key]["role"], "content": messages[key]["content"]})
@@ -0,0 +1,161 @@
+# Copyright (c) 2024.
+# -*-coding:utf-8 -*-
+"""
+@file: DownlinkScheduler.py
+@author: Jerry(Ruihuang)Yang
+@email: rxy216@case.edu
+@time: 10/19/26 23:50
+"""
+from collections import deque
+import asyncio
+import os
+
+
+class DownlinkScheduler:
+    """
+    DownlinkScheduler: per-session downlink queue with a bounded buffer, so a client on a slow connection does not
+    build up an unbounded queue of packets on the server.
+    Events of a session are queued here and sent one at a time by a sender task, which waits while the Engine.IO
+    queue of the socket holds more than DOWNLINK_MAX_TRANSPORT_PACKETS packets. Frames pile up here meanwhile, where:
+    - superseding frames (interim STT results, partial chat responses without a new chunk) replace the older pending
+      frame of the same stream, the newest wins: chat responses carry the whole text so far, interims are redone.
+    - ordered frames (finals, chunk announcements, first and last chat responses, other events) are never dropped and
+      keep their order. They also drop the pending superseding frames of their stream, which they are newer than.
+    Over DOWNLINK_MAX_QUEUED frames the oldest superseding frame is dropped. Ordered frames are queued anyway and
+    counted as overflow, up to DOWNLINK_HARD_MAX_QUEUED: a client that far behind is not reading, on_overflow is
+    called to disconnect it (its session is parked when resuming is on) and its frames are dropped until then.
+    A frame leaves the queue once it has been emitted, so a sender stopped mid-emit by take hands it over too.
+    """
+    POLL_S = 0.02
+
+    def __init__(self, sio_server, on_overflow=None):
+        self.MAX_QUEUED = int(os.getenv("DOWNLINK_MAX_QUEUED", "200"))
+        self.HARD_MAX_QUEUED = int(os.getenv("DOWNLINK_HARD_MAX_QUEUED", "1000"))  # above the resume replay size
+        self.MAX_TRANSPORT_PACKETS = int(os.getenv("DOWNLINK_MAX_TRANSPORT_PACKETS", "32"))
+        self.sio_server = sio_server
+        self.on_overflow = on_overflow  # coroutine function called with the room when it hits HARD_MAX_QUEUED
+        self.queues = {}  # room -> deque of [event, data, stream key, superseding]
+        self.senders = {}  # room -> sender task
+        self.overflowed = set()  # rooms being disconnected for hitting HARD_MAX_QUEUED
+        self.transport_readable = True  # False once the Engine.IO queues could not be read, no backpressure then
+        self.counters = {"sent": 0, "coalesced": 0, "dropped": 0, "overflow": 0, "max_depth": 0, "waits": 0,
+                         "disconnected": 0, "transport_errors": 0}
+
+    @staticmethod
+    def classify(event: str, data) -> tuple[str | None, bool]:
+        """
+        :return: The stream key of a frame (None if it belongs to no stream) and whether a newer frame supersedes it.
+        """
+        if event == "downlink_stt_result" and isinstance(data, dict):
+            return "stt", not data.get("is_final")
+        if event == "downlink_chat_response" and isinstance(data, dict):
+            superseding = not (data.get("have_new_chunk") or data.get("first_yield") or data.get("last_yield"))
+            return f"chat_{data.get('tts_session_id')}", superseding
+        return None, False
+
+    def enqueue(self, event: str, data, room: str):
+        """
+        Queue a frame for a session, must be called from the event loop.
+        """
+        if room in self.overflowed:
+            self.counters["dropped"] += 1
+            return
+        key, superseding = self.classify(event, data)
+        queue = self.queues.setdefault(room, deque())
+        if key is not None:
+            stale = [frame for frame in queue if frame[2] == key and frame[3]]
+            for frame in stale:
+                queue.remove(frame)
+            self.counters["coalesced"] += len(stale)
+        if len(queue) >= self.MAX_QUEUED:
+            oldest = next((frame for frame in queue if frame[3]), None)
+            if oldest is not None:
+                queue.remove(oldest)
+                self.counters["dropped"] += 1
+            elif superseding:
+                self.counters["dropped"] += 1
+                return
+            elif len(queue) >= self.HARD_MAX_QUEUED:
+                self.__overflow(room)
+                return
+            else:
+                self.counters["overflow"] += 1
+        queue.append([event, data, key, superseding])
+        self.counters["max_depth"] = max(self.counters["max_depth"], len(queue))
+        if room not in self.senders:
+            self.senders[room] = asyncio.create_task(self.__send(room))
+
+    def take(self, room: str) -> list[tuple[str, object]]:
+        """
+        Stop sending to a session and hand its pending frames over, in order (for the resume buffer).
+        """
+        sender = self.senders.pop(room, None)
+        if sender:
+            sender.cancel()
+        self.overflowed.discard(room)
+        return [(frame[0], frame[1]) for frame in self.queues.pop(room, ())]
+
+    def close(self, room: str):
+        self.take(room)
+
+    def depth(self, room: str) -> int:
+        return len(self.queues.get(room, ()))
+
+    def transport_depth(self, room: str) -> int:
+        """
+        Packets waiting in the Engine.IO queues of the sockets in the room. Python-engineio has no public API for
+        this, the socket queues are read directly (checked against the version pinned in requirements.txt). If
+        they cannot be read, the error is logged, counted and reported in stats, and frames are sent without
+        backpressure, still coalesced and bounded here.
+        """
+        if not self.transport_readable:
+            return 0
+        try:
+            depth = 0
+            for _, eio_sid in self.sio_server.manager.get_participants("/", room):
+                socket = self.sio_server.eio.sockets.get(eio_sid)
+                if socket is not None:
+                    depth = max(depth, socket.queue.qsize())
+            return depth
+        except Exception as e:
+            self.transport_readable = False
+            self.counters["transport_errors"] += 1
+            print(f"Cannot read the Engine.IO queues, downlink backpressure is off: {e!r}")
+            return 0
+
+    def stats(self) -> dict:
+        return {**self.counters, "transport_backpressure": self.transport_readable, "sessions": len(self.queues),
+                "queued": sum(len(queue) for queue in self.queues.values())}
+
+    def __overflow(self, room: str):
+        self.counters["dropped"] += 1
+        self.counters["disconnected"] += 1
+        self.overflowed.add(room)
+        print(f"Downlink queue of {room} is over {self.HARD_MAX_QUEUED} frames, disconnecting the client")
+        if self.on_overflow is not None:
+            asyncio.create_task(self.on_overflow(room))
+
+    async def __send(self, room: str):
+        queue = self.queues.get(room)
+        try:
+            while queue:
+                if self.transport_depth(room) > self.MAX_TRANSPORT_PACKETS:
+                    self.counters["waits"] += 1
+                    while self.transport_depth(room) > self.MAX_TRANSPORT_PACKETS:
+                        await asyncio.sleep(self.POLL_S)  # the client is slow, let the frames coalesce here
+                    continue
+                frame = queue[0]
+                await self.sio_server.emit(frame[0], frame[1], room=room)
+                # only now it leaves the queue, unless enqueue coalesced or dropped it during the emit
+                if queue and queue[0] is frame:
+                    queue.popleft()
+                self.counters["sent"] += 1
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Failed to send downlink events: {room} {e}")
+        finally:
+            if self.senders.get(room) is asyncio.current_task():
+                self.senders.pop(room)
+                if not queue:
+                    self.queues.pop(room, None)
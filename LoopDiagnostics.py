@@ -0,0 +1,138 @@
+# Copyright (c) 2024.
+# -*-coding:utf-8 -*-
+"""
+@file: LoopDiagnostics.py
+@author: Jerry(Ruihuang)Yang
+@email: rxy216@case.edu
+@time: 10/19/26 16:05
+"""
+from collections import deque
+import asyncio
+import os
+import sys
+import threading
+import time
+import traceback
+
+REPO_ROOT = os.path.dirname(os.path.abspath(__file__))
+
+
+class LoopDiagnostics:
+    """
+    LoopDiagnostics: event loop lag monitor and blocking-call detector (LOOP_DIAGNOSTICS=1, meant for staging).
+    A heartbeat task ticks on the loop every TICK_S, and a watchdog thread watches it. When the heartbeat is late by
+    more than BLOCK_THRESHOLD_MS, the watchdog grabs the stack of the loop thread, so the blocking call is caught
+    while it is still running. Stalls are grouped by handler: the outermost frame in this repo (connect,
+    uplink_chat_message, stream_chat, ...).
+    """
+    TICK_S = 0.05
+    WATCHDOG_POLL_S = 0.01
+    LAG_SAMPLES = 1200  # one minute of heartbeats
+    MAX_STACKS_PER_HANDLER = 3
+    STACK_LIMIT = 25
+
+    def __init__(self):
+        self.ENABLED = os.getenv("LOOP_DIAGNOSTICS", "0") == "1"
+        self.BLOCK_THRESHOLD_MS = float(os.getenv("LOOP_BLOCK_THRESHOLD_MS", "100"))
+        self.loop_thread_id = None
+        self.last_heartbeat = time.monotonic()
+        self.lag_samples = deque(maxlen=self.LAG_SAMPLES)
+        self.lock = threading.Lock()
+        self.stalls = {}  # handler -> {"count", "total_ms", "max_ms", "stacks": {stack: count}}
+        self.started_at = None
+
+    def start(self):
+        """
+        Start the heartbeat and the watchdog, must be called from the event loop.
+        """
+        if not self.ENABLED or self.loop_thread_id is not None:
+            return
+        self.loop_thread_id = threading.get_ident()
+        self.started_at = time.time()
+        self.last_heartbeat = time.monotonic()
+        asyncio.create_task(self.__heartbeat())
+        threading.Thread(target=self.__watchdog, name="loop_watchdog", daemon=True).start()
+        print("Loop diagnostics started, block threshold:", self.BLOCK_THRESHOLD_MS, "ms")
+
+    def report(self) -> dict:
+        samples = sorted(self.lag_samples)
+
+        def percentile(p: float) -> float:
+            return round(samples[min(len(samples) - 1, int(len(samples) * p))], 1) if samples else 0.0
+
+        with self.lock:
+            handlers = {
+                handler: {
+                    "count": stall["count"],
+                    "total_ms": round(stall["total_ms"], 1),
+                    "max_ms": round(stall["max_ms"], 1),
+                    "stacks": [{"count": count, "stack": stack} for stack, count in
+                               sorted(stall["stacks"].items(), key=lambda item: -item[1])],
+                }
+                for handler, stall in sorted(self.stalls.items(), key=lambda item: -item[1]["total_ms"])
+            }
+        return {
+            "enabled": self.ENABLED,
+            "started_at": self.started_at,
+            "block_threshold_ms": self.BLOCK_THRESHOLD_MS,
+            "loop_lag_ms": {"p50": percentile(0.5), "p99": percentile(0.99),
+                            "max": round(samples[-1], 1) if samples else 0.0, "samples": len(samples)},
+            "blocking_handlers": handlers,
+        }
+
+    def reset(self):
+        with self.lock:
+            self.stalls.clear()
+        self.lag_samples.clear()
+
+    async def __heartbeat(self):
+        while True:
+            scheduled = time.monotonic()
+            await asyncio.sleep(self.TICK_S)
+            now = time.monotonic()
+            self.lag_samples.append(max(0.0, (now - scheduled - self.TICK_S) * 1000))
+            self.last_heartbeat = now
+
+    def __watchdog(self):
+        stall_heartbeat = None  # heartbeat seen when the current stall was detected
+        stall_handler = None
+        stall_stack = None
+        while True:
+            time.sleep(self.WATCHDOG_POLL_S)
+            heartbeat = self.last_heartbeat
+            late_ms = (time.monotonic() - heartbeat - self.TICK_S) * 1000
+            if stall_heartbeat is None:
+                if late_ms > self.BLOCK_THRESHOLD_MS:
+                    stall_heartbeat = heartbeat
+                    stall_handler, stall_stack = self.__capture_loop_stack()
+            elif heartbeat != stall_heartbeat:
+                # the loop is running again, the heartbeat tells how long it was stuck
+                duration_ms = (heartbeat - stall_heartbeat - self.TICK_S) * 1000
+                self.__record(stall_handler, stall_stack, duration_ms)
+                print(f"Event loop blocked for {round(duration_ms)} ms in {stall_handler}")
+                stall_heartbeat = None
+
+    def __capture_loop_stack(self) -> tuple[str, str]:
+        frame = sys._current_frames().get(self.loop_thread_id)
+        if frame is None:
+            return "unknown", ""
+        stack = traceback.extract_stack(frame)
+        # "<frozen runpy>" and the like are not files, abspath would put them in the working directory
+        repo_frames = [entry for entry in stack
+                       if not entry.filename.startswith("<")
+                       and os.path.dirname(os.path.abspath(entry.filename)) == REPO_ROOT
+                       and not entry.filename.endswith("LoopDiagnostics.py")]
+        if repo_frames:
+            handler = f"{os.path.basename(repo_frames[0].filename)}:{repo_frames[0].name}"
+        else:
+            handler = f"{os.path.basename(stack[-1].filename)}:{stack[-1].name}"
+        return handler, "".join(traceback.format_list(stack[-self.STACK_LIMIT:]))
+
+    def __record(self, handler: str, stack: str, duration_ms: float):
+        with self.lock:
+            stall = self.stalls.setdefault(handler, {"count": 0, "total_ms": 0.0, "max_ms": 0.0, "stacks": {}})
+            stall["count"] += 1
+            stall["total_ms"] += duration_ms
+            stall["max_ms"] = max(stall["max_ms"], duration_ms)
+            if stack in stall["stacks"] or len(stall["stacks"]) < self.MAX_STACKS_PER_HANDLER:
+                stall["stacks"][stack] = stall["stacks"].get(stack, 0) + 1
@@ -0,0 +1,132 @@
+# Copyright (c) 2024.
+# -*-coding:utf-8 -*-
+"""
+@file: MemoryDiagnostics.py
+@author: Jerry(Ruihuang)Yang
+@email: rxy216@case.edu
+@time: 10/19/26 20:40
+"""
+from collections import Counter
+import gc
+import os
+import sysconfig
+import time
+import tracemalloc
+
+REPO_ROOT = os.path.dirname(os.path.abspath(__file__))
+STDLIB_ROOT = sysconfig.get_paths()["stdlib"]
+
+
+class MemoryDiagnostics:
+    """
+    MemoryDiagnostics: tools behind the admin memory endpoint, to find what makes an edge container grow.
+    - census: live instances of the per-session classes, to compare with the number of live sessions.
+    - orphans: per-sid entries whose session is gone.
+    - snapshot_diff: tracemalloc diff since the previous call, grouped by module. Tracing starts with the first call
+      (or at startup with MEMORY_TRACEMALLOC=1), since it slows every allocation down.
+    """
+    CENSUS_TYPES = ("UplinkAudioStage", "ChatStream", "TtsStream", "SessionTimeline", "VoiceActivityGate",
+                    "SessionTrace", "BytesIO", "Task")
+    MAX_ORPHAN_SAMPLES = 5
+
+    def __init__(self):
+        self.TRACEMALLOC_AT_STARTUP = os.getenv("MEMORY_TRACEMALLOC", "0") == "1"
+        self.TRACEMALLOC_FRAMES = int(os.getenv("MEMORY_TRACEMALLOC_FRAMES", "1"))
+        self.previous_snapshot = None
+        self.previous_snapshot_at = None
+
+    def start(self):
+        if self.TRACEMALLOC_AT_STARTUP:
+            self.start_tracing()
+
+    def start_tracing(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.TRACEMALLOC_FRAMES)
+            self.previous_snapshot = None
+
+    def stop_tracing(self):
+        tracemalloc.stop()
+        self.previous_snapshot = None
+        self.previous_snapshot_at = None
+
+    @staticmethod
+    def process_memory() -> dict:
+        """
+        Resident and peak memory of the process, in bytes.
+        """
+        memory = {}
+        try:
+            with open("/proc/self/status") as f:
+                for line in f:
+                    if line.startswith(("VmRSS:", "VmHWM:")):
+                        name, value = line.split(":", 1)
+                        memory["rss_bytes" if name == "VmRSS" else "peak_rss_bytes"] = int(value.split()[0]) * 1024
+        except OSError:
+            import resource
+            memory["peak_rss_bytes"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        return memory
+
+    def census(self) -> dict:
+        """
+        Count the live instances of the per-session classes.
+        """
+        counts = Counter(type(obj).__name__ for obj in gc.get_objects())
+        return {type_name: counts.get(type_name, 0) for type_name in self.CENSUS_TYPES}
+
+    def orphans(self, session_state: dict[str, dict], live_sids: set) -> dict:
+        """
+        Find the per-sid entries that outlived their session.
+        :param session_state: The per-sid dicts, by name.
+        :param live_sids: The sids of the sessions that are connected or parked.
+        """
+        report = {}
+        for name, state in session_state.items():
+            leftover = [sid for sid in list(state.keys()) if sid not in live_sids]
+            if leftover:
+                report[name] = {"count": len(leftover), "sample": leftover[0:self.MAX_ORPHAN_SAMPLES]}
+        return report
+
+    def snapshot_diff(self, top: int = 25) -> dict:
+        """
+        Diff the allocations against the previous call, grouped by module. The first call only takes the baseline.
+        """
+        self.start_tracing()
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        ))
+        now = time.time()
+        report = {"traced_bytes": tracemalloc.get_traced_memory()[0], "since": self.previous_snapshot_at}
+        if self.previous_snapshot is None:
+            report["modules"] = []
+            report["note"] = "baseline taken, call again to get the diff"
+        else:
+            modules = {}
+            for stat in snapshot.compare_to(self.previous_snapshot, "filename"):
+                module = modules.setdefault(self.__module_of(stat.traceback[0].filename),
+                                            {"size_bytes": 0, "size_diff_bytes": 0, "count_diff": 0})
+                module["size_bytes"] += stat.size
+                module["size_diff_bytes"] += stat.size_diff
+                module["count_diff"] += stat.count_diff
+            ranked = sorted(modules.items(), key=lambda item: -abs(item[1]["size_diff_bytes"]))
+            report["modules"] = [{"module": name, **module} for name, module in ranked[0:top]]
+        self.previous_snapshot = snapshot
+        self.previous_snapshot_at = now
+        return report
+
+    @staticmethod
+    def __module_of(filename: str) -> str:
+        """
+        Name the module of a source file: the file for this repo, the top package for libraries.
+        """
+        path = os.path.abspath(filename)
+        if os.path.dirname(path) == REPO_ROOT or path.startswith(REPO_ROOT + os.sep + "benchmarks"):
+            return os.path.relpath(path, REPO_ROOT)
+        for marker in ("site-packages", "dist-packages"):
+            if marker in path.split(os.sep):
+                parts = path.split(os.sep)
+                package = parts[parts.index(marker) + 1]
+                return package[:-3] if package.endswith(".py") else package
+        if path.startswith(STDLIB_ROOT):
+            return "stdlib:" + os.path.relpath(path, STDLIB_ROOT).split(os.sep)[0].removesuffix(".py")
+        return filename
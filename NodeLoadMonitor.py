@@ -0,0 +1,102 @@
+# Copyright (c) 2024.
+# -*-coding:utf-8 -*-
+"""
+@file: NodeLoadMonitor.py
+@author: Jerry(Ruihuang)Yang
+@email: rxy216@case.edu
+@time: 10/19/26 12:15
+"""
+from collections import deque
+import asyncio
+import os
+import time
+
+
+class NodeLoadMonitor:
+    """
+    NodeLoadMonitor: admission control and load score of this edge node.
+    Caps the concurrent sessions and in-flight LLM streams, and samples the event loop lag, so /ping can tell nginx
+    or a global router how loaded the node is.
+    """
+    LAG_SAMPLE_INTERVAL_S = 0.5
+    LAG_SMOOTHING = 0.2
+
+    def __init__(self):
+        self.MAX_CONCURRENT_SESSIONS = int(os.getenv("MAX_CONCURRENT_SESSIONS", "200"))
+        self.MAX_INFLIGHT_LLM_STREAMS = int(os.getenv("MAX_INFLIGHT_LLM_STREAMS", "60"))
+        self.LOOP_LAG_BUDGET_MS = float(os.getenv("LOOP_LAG_BUDGET_MS", "250"))
+        self.TTS_QUEUE_BUDGET = int(os.getenv("TTS_QUEUE_BUDGET", "100"))
+        self.BUSY_RETRY_AFTER_MS = int(os.getenv("BUSY_RETRY_AFTER_MS", "3000"))
+        self.LAG_WINDOW_S = float(os.getenv("LOOP_LAG_WINDOW_S", "60"))
+        self.loop_lag_ms = 0.0  # smoothed lag
+        self.lag_samples = deque()  # (monotonic time, lag ms) of the last LAG_WINDOW_S, for the worst lag
+        self.rejected_sessions = 0
+        self.rejected_llm_streams = 0
+
+    async def run_lag_sampler(self):
+        """
+        Sleep for a fixed interval and measure how late the loop wakes us up.
+        """
+        while True:
+            started = time.monotonic()
+            await asyncio.sleep(self.LAG_SAMPLE_INTERVAL_S)
+            lag_ms = max(0.0, (time.monotonic() - started - self.LAG_SAMPLE_INTERVAL_S) * 1000)
+            self.add_lag_sample(lag_ms)
+
+    def add_lag_sample(self, lag_ms: float, now: float | None = None):
+        now = time.monotonic() if now is None else now
+        self.loop_lag_ms += (lag_ms - self.loop_lag_ms) * self.LAG_SMOOTHING
+        self.lag_samples.append((now, lag_ms))
+        while self.lag_samples and self.lag_samples[0][0] < now - self.LAG_WINDOW_S:
+            self.lag_samples.popleft()
+
+    def max_loop_lag_ms(self, now: float | None = None) -> float:
+        """
+        Worst lag of the last LAG_WINDOW_S. Reading it does not reset it, so several pollers see the same peak.
+        """
+        now = time.monotonic() if now is None else now
+        return max((lag_ms for sampled_at, lag_ms in self.lag_samples if sampled_at >= now - self.LAG_WINDOW_S),
+                   default=0.0)
+
+    def admit_session(self, current_sessions: int) -> bool:
+        if current_sessions >= self.MAX_CONCURRENT_SESSIONS:
+            self.rejected_sessions += 1
+            return False
+        return True
+
+    def admit_llm_stream(self, current_streams: int) -> bool:
+        if current_streams >= self.MAX_INFLIGHT_LLM_STREAMS:
+            self.rejected_llm_streams += 1
+            return False
+        return True
+
+    def busy_event(self, reason: str) -> dict:
+        """
+        The payload of downlink_server_busy, the client may retry after retry_after_ms.
+        :param reason: "sessions", "llm_streams" or "warming_up".
+        """
+        return {"reason": reason, "retryable": True, "retry_after_ms": self.BUSY_RETRY_AFTER_MS}
+
+    def load_report(self, sessions: int, llm_streams: int, tts_queue_depth: int) -> dict:
+        """
+        Build the load report of /ping. load_score is the highest utilization of any limited resource, 1.0 or above
+        means the node should not get new sessions.
+        :param tts_queue_depth: TTS chunks waiting for or in synthesis on the TTS executor.
+        """
+        load_score = max(sessions / self.MAX_CONCURRENT_SESSIONS,
+                         llm_streams / self.MAX_INFLIGHT_LLM_STREAMS,
+                         self.loop_lag_ms / self.LOOP_LAG_BUDGET_MS,
+                         tts_queue_depth / self.TTS_QUEUE_BUDGET)
+        report = {
+            "ready": load_score < 1.0,
+            "load_score": round(load_score, 3),
+            "sessions": sessions,
+            "inflight_llm_streams": llm_streams,
+            "loop_lag_ms": round(self.loop_lag_ms, 1),
+            "max_loop_lag_ms": round(self.max_loop_lag_ms(), 1),
+            "lag_window_s": self.LAG_WINDOW_S,
+            "tts_queue_depth": tts_queue_depth,
+            "rejected_sessions": self.rejected_sessions,
+            "rejected_llm_streams": self.rejected_llm_streams,
+        }
+        return report
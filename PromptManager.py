@@ -9,6 +9,14 @@
 
 
 class PromptManager:
+    @staticmethod
+    def step_system_prompt(step_info: dict) -> str:
+        """
+        The system prompt of an interview step.
+        :param step_info: The stored step prompt, {"instruction": str, "information": str}.
+        """
+        return f"{PromptManager.BASE_ROLE} Please follow this instruction: {step_info['instruction']} Here's some information for you, you should not give the info to candidate directly: {step_info['information']}"
+
     BASE_ROLE = """
     You are an interviewer at McKinsey. You are conducting a case interview with a candidate. Your name is Bob Sternfels unless instructed otherwise later.
     This is a Quick ask, quick answer scenario. You should be asking questions and giving short, quick responses.
@@ -0,0 +1,113 @@
+# Copyright (c) 2024.
+# -*-coding:utf-8 -*-
+"""
+@file: ProviderClients.py
+@author: Jerry(Ruihuang)Yang
+@email: rxy216@case.edu
+@time: 10/19/26 21:10
+"""
+import os
+import threading
+import time
+
+
+class ProviderClients:
+    """
+    ProviderClients: the shared provider clients and storage handlers of the process, built on first use.
+    The SDKs (deepgram, openai, anthropic, boto3, redis) are only imported by their builders, so importing main stays
+    fast. The startup hook builds them all in a worker thread with warm_up, and the node reports ready once every
+    client is built, so a new container takes traffic with warm clients and one with a broken client never does.
+    """
+    instance = None
+    instance_lock = threading.Lock()
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clients = {}
+        self.build_ms = {}
+        self.ready = False
+        self.warm_up_ms = None
+        self.failed = {}  # name -> error of the clients the warm-up could not build
+        self.builders = {
+            "deepgram": self.__build_deepgram,
+            "openai": self.__build_openai,
+            "anthropic": self.__build_anthropic,
+            "agent_prompt_handler": self.__build_agent_prompt_handler,
+            "message_storage_handler": self.__build_message_storage_handler,
+        }
+
+    @classmethod
+    def get_instance(cls) -> "ProviderClients":
+        with cls.instance_lock:
+            if cls.instance is None:
+                cls.instance = ProviderClients()
+        return cls.instance
+
+    def get(self, name: str):
+        """
+        The shared client, built now if the warm-up has not got to it yet.
+        :param name: deepgram, openai, anthropic, agent_prompt_handler or message_storage_handler.
+        """
+        client = self.clients.get(name)
+        if client is not None:
+            return client
+        with self.lock:
+            if name not in self.clients:
+                started = time.perf_counter()
+                self.clients[name] = self.builders[name]()
+                self.build_ms[name] = round((time.perf_counter() - started) * 1000, 1)
+            return self.clients[name]
+
+    def install(self, name: str, client):
+        """
+        Use a client built elsewhere, for the benchmark and replay stand-ins.
+        """
+        with self.lock:
+            self.clients[name] = client
+
+    def warm_up(self):
+        """
+        Build every client, blocking, meant for a worker thread at startup.
+        """
+        started = time.perf_counter()
+        for name in self.builders:
+            try:
+                self.get(name)
+            except Exception as e:
+                self.failed[name] = str(e)
+                print(f"Failed to build the {name} client: {e}")
+        self.warm_up_ms = round((time.perf_counter() - started) * 1000, 1)
+        self.ready = not self.failed
+        if self.ready:
+            print("Provider clients ready in", self.warm_up_ms, "ms:", self.build_ms)
+        else:
+            print("Provider clients not ready, failed:", self.failed)
+
+    def report(self) -> dict:
+        return {"ready": self.ready, "warm_up_ms": self.warm_up_ms, "build_ms": dict(self.build_ms),
+                "failed": dict(self.failed)}
+
+    @staticmethod
+    def __build_deepgram():
+        from deepgram import DeepgramClient
+        return DeepgramClient(api_key=os.getenv("DEEPGRAM_API_KEY"))
+
+    @staticmethod
+    def __build_openai():
+        from openai import OpenAI
+        return OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+
+    @staticmethod
+    def __build_anthropic():
+        from anthropic import Anthropic
+        return Anthropic(api_key=os.getenv("ANTHROPIC_API_KEY"))
+
+    @staticmethod
+    def __build_agent_prompt_handler():
+        from AgentPromptHandler import AgentPromptHandler
+        return AgentPromptHandler()
+
+    @staticmethod
+    def __build_message_storage_handler():
+        from MessageStorageHandler import MessageStorageHandler
+        return MessageStorageHandler()
@@ -0,0 +1,215 @@
+# Copyright (c) 2024.
+# -*-coding:utf-8 -*-
+"""
+@file: ProviderScheduler.py
+@author: Jerry(Ruihuang)Yang
+@email: rxy216@case.edu
+@time: 10/19/26 18:20
+"""
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager, contextmanager
+import asyncio
+import json
+import os
+import threading
+import time
+
+
+class _Waiter:
+    def __init__(self, session_id: str, priority: int):
+        self.session_id = session_id
+        self.priority = priority
+        self.enqueued_at = time.monotonic()
+        self.granted = False
+        self.notify = None
+
+
+class _ProviderState:
+    def __init__(self, rate: float, burst: float, concurrency: int):
+        self.rate = rate
+        self.burst = burst
+        self.concurrency = concurrency
+        self.tokens = burst
+        self.last_refill = time.monotonic()
+        self.active = 0
+        self.queues = {}  # priority -> OrderedDict(session_id -> deque of waiters), served round-robin
+        self.waiting = 0
+        self.granted = 0
+        self.total_wait_ms = 0.0
+        self.max_wait_ms = 0.0
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+    def next_token_in(self) -> float:
+        if self.tokens >= 1 or self.rate <= 0:
+            return 0.1
+        return min(0.1, max(0.005, (1 - self.tokens) / self.rate))
+
+
+class ProviderScheduler:
+    """
+    ProviderScheduler: process-wide scheduler for the calls to OpenAI, Anthropic, Deepgram STT and Deepgram Speak.
+    Every provider has a token bucket (rate per second, burst) and a concurrency limit, set in DEFAULT_LIMITS and
+    overridable with the PROVIDER_LIMITS json env. Waiting calls are served by priority first (the first TTS chunk
+    and the first tokens of a reply before later chunks), then round-robin across sessions, so a class of candidates
+    starting together shares the quota instead of running into 429s.
+    Works from the event loop (async_slot) and from worker threads (slot). slot blocks the calling thread, it must
+    never be used on the event loop.
+    """
+    PRIORITY_FIRST = 0
+    PRIORITY_NORMAL = 1
+    PRIORITY_BACKGROUND = 2  # precompute / speculative work, only runs on spare capacity
+    DEFAULT_LIMITS = {
+        "openai": {"rate": 10, "burst": 20, "concurrency": 60},
+        "anthropic": {"rate": 5, "burst": 10, "concurrency": 40},
+        "deepgram_stt": {"rate": 10, "burst": 20, "concurrency": 50},  # concurrent connection opens
+        "deepgram_speak": {"rate": 20, "burst": 40, "concurrency": 40},
+    }
+    instance = None
+    instance_lock = threading.Lock()
+
+    def __init__(self):
+        limits = {provider: dict(limit) for provider, limit in self.DEFAULT_LIMITS.items()}
+        for provider, limit in json.loads(os.getenv("PROVIDER_LIMITS", "{}")).items():
+            limits.setdefault(provider, {"rate": 10, "burst": 20, "concurrency": 60}).update(limit)
+        self.lock = threading.Lock()
+        self.providers = {provider: _ProviderState(limit["rate"], limit["burst"], limit["concurrency"])
+                          for provider, limit in limits.items()}
+
+    @classmethod
+    def get_instance(cls) -> "ProviderScheduler":
+        """
+        The scheduler shared by the whole process, built on first use so the env config is loaded by then.
+        """
+        with cls.instance_lock:
+            if cls.instance is None:
+                cls.instance = ProviderScheduler()
+        return cls.instance
+
+    @contextmanager
+    def slot(self, provider: str, session_id: str, priority: int = PRIORITY_NORMAL):
+        """
+        Hold a call slot of the provider, blocking the calling thread until it is granted.
+        """
+        state = self.providers[provider]
+        event = threading.Event()
+        waiter = self.__enqueue(state, session_id, priority, event.set)
+        while not event.wait(state.next_token_in()):
+            with self.lock:
+                self.__dispatch(state)
+        try:
+            yield
+        finally:
+            self.release(provider)
+
+    @asynccontextmanager
+    async def async_slot(self, provider: str, session_id: str, priority: int = PRIORITY_NORMAL):
+        """
+        Hold a call slot of the provider, waiting on the event loop until it is granted.
+        """
+        state = self.providers[provider]
+        loop = asyncio.get_running_loop()
+        granted = loop.create_future()
+
+        def notify():
+            loop.call_soon_threadsafe(lambda: granted.done() or granted.set_result(True))
+
+        waiter = self.__enqueue(state, session_id, priority, notify)
+        try:
+            while True:
+                try:
+                    await asyncio.wait_for(asyncio.shield(granted), state.next_token_in())
+                    break
+                except asyncio.TimeoutError:
+                    with self.lock:
+                        self.__dispatch(state)
+        except asyncio.CancelledError:
+            with self.lock:
+                if not waiter.granted:
+                    self.__remove(state, waiter)
+                    raise
+            self.release(provider)
+            raise
+        try:
+            yield
+        finally:
+            self.release(provider)
+
+    def release(self, provider: str):
+        state = self.providers[provider]
+        with self.lock:
+            state.active -= 1
+            self.__dispatch(state)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                provider: {
+                    "active": state.active,
+                    "waiting": state.waiting,
+                    "tokens": round(state.tokens, 2),
+                    "granted": state.granted,
+                    "avg_wait_ms": round(state.total_wait_ms / state.granted, 1) if state.granted else 0.0,
+                    "max_wait_ms": round(state.max_wait_ms, 1),
+                }
+                for provider, state in self.providers.items()
+            }
+
+    def __enqueue(self, state: _ProviderState, session_id: str, priority: int, notify) -> _Waiter:
+        waiter = _Waiter(session_id, priority)
+        waiter.notify = notify
+        with self.lock:
+            sessions = state.queues.setdefault(priority, OrderedDict())
+            sessions.setdefault(session_id, deque()).append(waiter)
+            state.waiting += 1
+            self.__dispatch(state)
+        return waiter
+
+    def __remove(self, state: _ProviderState, waiter: _Waiter):
+        """
+        Take a cancelled waiter out of its queue, must be called with the lock held.
+        """
+        sessions = state.queues.get(waiter.priority, {})
+        session_waiters = sessions.get(waiter.session_id)
+        if session_waiters and waiter in session_waiters:
+            session_waiters.remove(waiter)
+            state.waiting -= 1
+            if not session_waiters:
+                del sessions[waiter.session_id]
+
+    def __dispatch(self, state: _ProviderState):
+        """
+        Grant slots while the concurrency limit and the token bucket allow, must be called with the lock held.
+        """
+        state.refill()
+        while state.active < state.concurrency and state.tokens >= 1:
+            waiter = self.__next_waiter(state)
+            if waiter is None:
+                return
+            state.tokens -= 1
+            state.active += 1
+            state.waiting -= 1
+            state.granted += 1
+            wait_ms = (time.monotonic() - waiter.enqueued_at) * 1000
+            state.total_wait_ms += wait_ms
+            state.max_wait_ms = max(state.max_wait_ms, wait_ms)
+            waiter.granted = True
+            waiter.notify()
+
+    @staticmethod
+    def __next_waiter(state: _ProviderState) -> _Waiter | None:
+        for priority in sorted(state.queues.keys()):
+            sessions = state.queues[priority]
+            if not sessions:
+                continue
+            session_id, session_waiters = next(iter(sessions.items()))
+            waiter = session_waiters.popleft()
+            if session_waiters:
+                sessions.move_to_end(session_id)  # round-robin: this session goes behind the others
+            else:
+                del sessions[session_id]
+            return waiter
+        return None
@@ -0,0 +1,100 @@
+# Copyright (c) 2024.
+# -*-coding:utf-8 -*-
+"""
+@file: ServerTurn.py
+@author: Jerry(Ruihuang)Yang
+@email: rxy216@case.edu
+@time: 10/19/26 21:45
+"""
+import threading
+
+
+class ServerTurn:
+    """
+    ServerTurn: server-driven turn mode of a session (auth.turn_mode = "server").
+    The final transcript segments of Deepgram are gathered here, and the end of an utterance (speech_final from the
+    endpointing, or UtteranceEnd) starts the reply right away from the history held here, without the round trip
+    through the client. The client keeps the history in sync with uplink_turn_context (step changes, typed messages).
+    Messages use the shape the client sends: {"<index>": {"role", "content", "step"}}.
+    """
+
+    def __init__(self, agent_id: str, thread_id: str, provider: str = "openai"):
+        self.lock = threading.Lock()  # transcripts come from the Deepgram SDK thread
+        self.agent_id = agent_id
+        self.thread_id = thread_id
+        self.provider = provider
+        self.current_step = 0
+        self.messages = {}
+        self.final_segments = []
+        self.interim_text = ""  # latest interim result after the final segments, for speculative generation
+        self.pending_user_text = ""  # what the candidate said since the last completed reply
+        self.turns = 0
+        self.interrupted = 0
+
+    def update_context(self, context: dict):
+        """
+        Take the history, step or provider from the client.
+        """
+        with self.lock:
+            if "messages" in context:
+                self.messages = {str(key): dict(message) for key, message in context["messages"].items()}
+            if "current_step" in context:
+                self.current_step = int(context["current_step"])
+            if "provider" in context:
+                self.provider = context["provider"]
+
+    def add_transcript(self, text: str, is_final: bool, speech_final: bool) -> str | None:
+        """
+        Gather a transcript result.
+        :return: The whole utterance when this result ends it, None otherwise.
+        """
+        with self.lock:
+            if is_final:
+                if text:
+                    self.final_segments.append(text)
+                self.interim_text = ""
+            else:
+                self.interim_text = text
+        return self.end_utterance() if speech_final else None
+
+    def end_utterance(self) -> str | None:
+        """
+        Close the utterance being gathered.
+        :return: Its text, None if nothing final was said.
+        """
+        with self.lock:
+            utterance = " ".join(self.final_segments).strip()
+            self.final_segments = []
+            self.interim_text = ""
+        return utterance or None
+
+    def candidate_text(self) -> str:
+        """
+        What the candidate has said so far in the utterance in progress, interim words included.
+        """
+        with self.lock:
+            return " ".join(self.final_segments + [self.interim_text]).strip()
+
+    def next_messages(self, user_text: str) -> dict:
+        """
+        The history with the new user message, for ChatStreamModel.
+        """
+        with self.lock:
+            messages = dict(self.messages)
+            messages[str(len(messages))] = {"role": "user", "content": user_text, "step": self.current_step}
+            return messages
+
+    def commit(self, user_text: str, reply_text: str):
+        """
+        Add a completed turn to the history.
+        """
+        with self.lock:
+            self.messages[str(len(self.messages))] = {"role": "user", "content": user_text, "step": self.current_step}
+            self.messages[str(len(self.messages))] = {"role": "assistant", "content": reply_text,
+                                                      "step": self.current_step}
+            self.pending_user_text = ""
+            self.turns += 1
+
+    def stats(self) -> dict:
+        return {"turns": self.turns, "interrupted": self.interrupted, "messages": len(self.messages),
+                "current_step": self.current_step}
@@ -0,0 +1,156 @@
+# Copyright (c) 2024.
+# -*-coding:utf-8 -*-
+"""
+@file: SessionResume.py
+@author: Jerry(Ruihuang)Yang
+@email: rxy216@case.edu
+@time: 10/19/26 20:05
+"""
+from collections import deque
+import asyncio
+import os
+import secrets
+import threading
+import time
+
+
+class SessionResume:
+    """
+    SessionResume: resume grace window for sessions whose socket drops for a moment (RESUME_GRACE_S, off by default).
+    A validated session gets a resume token. When its socket disconnects, the session is parked instead of torn
+    down: the STT connection, the recording buffer and the reply stream keep running, and the downlink events sent
+    meanwhile are buffered. A reconnect with the token within the window takes the session over and gets the buffered
+    events; otherwise the session is closed when the window ends.
+    All session state stays keyed by the sid of the first socket, the new socket joins its room.
+    """
+
+    def __init__(self):
+        self.GRACE_S = float(os.getenv("RESUME_GRACE_S", "0"))  # opt-in, clients must handle the resume events
+        self.MAX_BUFFERED_EVENTS = int(os.getenv("RESUME_MAX_BUFFERED_EVENTS", "500"))
+        self.lock = threading.Lock()  # events are buffered from the Deepgram SDK thread too
+        self.tokens = {}  # resume token -> {"sid", "thread_id"}
+        self.session_tokens = {}  # sid -> resume token
+        self.parked = {}  # sid -> {"since", "events", "dropped", "expiry"}
+        self.resumed = 0
+        self.expired = 0
+
+    def issue(self, sid: str, thread_id: str) -> str | None:
+        """
+        Give a validated session its resume token, None when resuming is off.
+        """
+        if self.GRACE_S <= 0:
+            return None
+        token = secrets.token_urlsafe(24)
+        with self.lock:
+            self.tokens[token] = {"sid": sid, "thread_id": thread_id}
+            self.session_tokens[sid] = token
+        return token
+
+    def park(self, sid: str, on_expire) -> bool:
+        """
+        Park a session whose socket disconnected, must be called from the event loop.
+        :param on_expire: Coroutine function called with the sid when the window ends without a resume.
+        :return: False if the session cannot be resumed and has to be closed now.
+        """
+        loop = asyncio.get_running_loop()
+        with self.lock:
+            if sid not in self.session_tokens or sid in self.parked:
+                return False
+            # set together with the entry, so a resume or forget never finds a parked session without its timer
+            expiry = loop.call_later(self.GRACE_S, lambda: asyncio.ensure_future(self.__expire(sid, on_expire)))
+            self.parked[sid] = {"since": time.monotonic(), "events": deque(), "dropped": 0, "expiry": expiry}
+        return True
+
+    def find(self, token: str | None, thread_id: str | None) -> str | None:
+        """
+        The sid of the parked session a reconnect can take over, None if the token is unknown or expired.
+        """
+        with self.lock:
+            session = self.tokens.get(token) if token else None
+            if session is None or session["thread_id"] != thread_id or session["sid"] not in self.parked:
+                return None
+            return session["sid"]
+
+    def resume(self, sid: str) -> tuple[list, int] | None:
+        """
+        Take a parked session back.
+        :return: The buffered (event, data) pairs in order and the number of dropped events, None if it expired.
+        """
+        with self.lock:
+            parked = self.parked.pop(sid, None)
+            if parked is None:
+                return None
+            self.resumed += 1
+        parked["expiry"].cancel()
+        return list(parked["events"]), parked["dropped"]
+
+    def buffer(self, room: str, event: str, data) -> bool:
+        """
+        Keep a downlink event of a parked session for its resume.
+        :return: True if the session is parked and the event was buffered.
+        """
+        with self.lock:
+            parked = self.parked.get(room)
+            if parked is None:
+                return False
+            if len(parked["events"]) >= self.MAX_BUFFERED_EVENTS:
+                parked["events"].popleft()
+                parked["dropped"] += 1
+            parked["events"].append((event, data))
+            return True
+
+    def token_of(self, sid: str) -> str | None:
+        return self.session_tokens.get(sid)
+
+    def forget(self, sid: str):
+        """
+        Drop the resume token of a session, its next disconnect closes it right away.
+        """
+        with self.lock:
+            token = self.session_tokens.pop(sid, None)
+            self.tokens.pop(token, None)
+            parked = self.parked.pop(sid, None)
+        if parked and parked["expiry"]:
+            parked["expiry"].cancel()
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"grace_s": self.GRACE_S, "parked": len(self.parked), "resumed": self.resumed,
+                    "expired": self.expired}
+
+    async def __expire(self, sid: str, on_expire):
+        with self.lock:
+            if self.parked.pop(sid, None) is None:
+                return  # resumed in the meantime
+            self.expired += 1
+        print("Resume window ended, closing session:", sid)
+        await on_expire(sid)
+
+
+class DownlinkEmitter:
+    """
+    DownlinkEmitter: sio_server.emit with the same signature, for the events of a session (STT results, chat
+    responses). Events to a parked session are buffered for its resume instead of being lost, the others go through
+    the downlink scheduler of the session when there is one.
+    """
+
+    def __init__(self, sio_server, session_resume: SessionResume, scheduler=None):
+        self.sio_server = sio_server
+        self.session_resume = session_resume
+        self.scheduler = scheduler  # DownlinkScheduler
+
+    async def emit(self, event: str, data=None, room=None, **kwargs):
+        if room is not None and self.session_resume.buffer(room, event, data):
+            return
+        if room is not None and self.scheduler is not None and not kwargs:
+            self.scheduler.enqueue(event, data, room)
+            return
+        await self.sio_server.emit(event, data, room=room, **kwargs)
+
+    def park(self, sid: str):
+        """
+        Move the frames still queued for a session that was just parked to its resume buffer.
+        """
+        if self.scheduler is not None:
+            for event, data in self.scheduler.take(sid):
+                self.session_resume.buffer(sid, event, data)
@@ -0,0 +1,108 @@
+# Copyright (c) 2024.
+# -*-coding:utf-8 -*-
+"""
+@file: SessionTimeline.py
+@author: Jerry(Ruihuang)Yang
+@email: rxy216@case.edu
+@time: 10/19/26 14:20
+"""
+from array import array
+import json
+import os
+import shutil
+import threading
+
+
+class SessionTimeline:
+    """
+    SessionTimeline: the STT timing data (audio_timestamps) of one session, in a compact form.
+    Only final segments are kept unless TIMING_KEEP_INTERIM=1. Segments not yet written are held column-wise in
+    arrays and streamed to a spool file every FLUSH_EVERY segments, so a long interview does not pile up thousands
+    of dicts and disconnect only has to splice the spool into the metadata json.
+    The metadata file keeps its format: audio_timestamps is still a list of
+    {text, is_final, speech_final, start, duration, timestamp} objects.
+    """
+    FLUSH_EVERY = 32
+
+    def __init__(self, spool_path: str):
+        """
+        :param spool_path: Where to stream the segments to, removed once the metadata file is written.
+        """
+        self.KEEP_INTERIM = os.getenv("TIMING_KEEP_INTERIM", "0") == "1"
+        self.spool_path = spool_path
+        self.lock = threading.Lock()  # segments are added from the Deepgram SDK thread
+        self.texts = []
+        self.is_final = array("b")
+        self.speech_final = array("b")
+        self.start = array("d")
+        self.duration = array("d")
+        self.timestamp = array("q")
+        self.rows_written = 0
+        self.closed = False
+
+    def add_segment(self, text: str, is_final: bool, speech_final: bool, start: float, duration: float,
+                    timestamp: int):
+        if not is_final and not self.KEEP_INTERIM:
+            return
+        with self.lock:
+            if self.closed:
+                return
+            self.texts.append(text)
+            self.is_final.append(bool(is_final))
+            self.speech_final.append(bool(speech_final))
+            self.start.append(start)
+            self.duration.append(duration)
+            self.timestamp.append(timestamp)
+            if len(self.texts) >= self.FLUSH_EVERY:
+                self.__flush_locked()
+
+    def estimated_bytes(self) -> int:
+        """
+        Rough size of the segments held in memory (the spooled ones are on disk).
+        """
+        columns = (self.is_final, self.speech_final, self.start, self.duration, self.timestamp)
+        return sum(len(text) for text in self.texts) + sum(column.itemsize * len(column) for column in columns)
+
+    def write_metadata(self, json_file_path: str, fields: dict):
+        """
+        Write the metadata json of the recording: the given fields plus the audio_timestamps from the spool.
+        :param json_file_path: The metadata file to write.
+        :param fields: The other fields of the recording processing data packet.
+        """
+        with self.lock:
+            self.__flush_locked()
+            self.closed = True
+        fields = {key: value for key, value in fields.items() if key != "audio_timestamps"}
+        header = json.dumps(fields)[:-1]  # drop the closing brace
+        with open(json_file_path, "w") as data_file:
+            data_file.write(header + (", " if fields else "") + '"audio_timestamps": [')
+            if os.path.isfile(self.spool_path):
+                with open(self.spool_path, "r") as spool_file:
+                    shutil.copyfileobj(spool_file, data_file)
+            data_file.write("]}")
+        self.discard()
+
+    def discard(self):
+        """
+        Drop the timeline and its spool file.
+        """
+        with self.lock:
+            self.closed = True
+            self.texts.clear()
+        if os.path.isfile(self.spool_path):
+            os.remove(self.spool_path)
+
+    def __flush_locked(self):
+        if not self.texts:
+            return
+        rows = []
+        for i, text in enumerate(self.texts):
+            rows.append(json.dumps({"text": text, "is_final": bool(self.is_final[i]),
+                                    "speech_final": bool(self.speech_final[i]), "start": self.start[i],
+                                    "duration": self.duration[i], "timestamp": self.timestamp[i]}))
+        with open(self.spool_path, "a") as spool_file:
+            spool_file.write(("," if self.rows_written else "") + ",".join(rows))
+        self.rows_written += len(rows)
+        self.texts.clear()
+        for column in (self.is_final, self.speech_final, self.start, self.duration, self.timestamp):
+            del column[:]
@@ -0,0 +1,126 @@
+# Copyright (c) 2024.
+# -*-coding:utf-8 -*-
+"""
+@file: SessionTraceRecorder.py
+@author: Jerry(Ruihuang)Yang
+@email: rxy216@case.edu
+@time: 10/19/26 16:50
+"""
+import base64
+import gzip
+import json
+import os
+import queue
+import threading
+import time
+
+
+class SessionTrace:
+    """
+    SessionTrace: the trace file of one session, gzip compressed json lines.
+    Every record has "t", the ms since the session connected, and a "type":
+    inbound: connect, audio, chat, disconnect
+    upstream: stt, llm_start, llm_token, llm_end, tts
+    Audio payloads are only kept with SESSION_TRACE_AUDIO=1, otherwise only their size is.
+    Credentials (the interview ID, resume token and auth codes) are redacted. Records are only queued here, the
+    writer thread of the recorder serializes and compresses them, so the event loop never waits on gzip.
+    """
+    REDACTED_KEYS = ("token", "resume_token", "dynamic_auth_code", "thread_id")
+    REDACTED = "redacted"
+
+    def __init__(self, trace_path: str, keep_audio: bool, write_queue: queue.Queue):
+        self.trace_path = trace_path
+        self.keep_audio = keep_audio
+        self.started = time.monotonic()
+        self.write_queue = write_queue  # records come from the loop, the Deepgram SDK thread and the TTS workers
+        self.trace_file = None  # opened by the writer thread
+        self.closed = False
+        self.finished = False  # the writer closed the file, late records from other threads are dropped
+
+    @classmethod
+    def redact(cls, data: dict) -> dict:
+        return {key: cls.REDACTED if key in cls.REDACTED_KEYS and value else value for key, value in data.items()}
+
+    def record(self, record_type: str, **fields):
+        if not self.closed:
+            self.write_queue.put((self, {"t": round((time.monotonic() - self.started) * 1000, 1),
+                                         "type": record_type, **fields}))
+
+    def audio(self, audio_data: bytes):
+        if self.keep_audio:
+            self.record("audio", size=len(audio_data), data=audio_data)  # base64 encoded by the writer
+        else:
+            self.record("audio", size=len(audio_data))
+
+    def close(self):
+        self.record("disconnect")
+        self.closed = True
+        self.write_queue.put((self, None))
+
+    def write(self, fields: dict | None):
+        """
+        Write a queued record, None closes the file. Only called from the writer thread.
+        """
+        if self.finished:
+            return
+        if fields is None:
+            self.finished = True
+            if self.trace_file is not None:
+                self.trace_file.close()
+                self.trace_file = None
+            return
+        if isinstance(fields.get("data"), bytes):
+            fields["data"] = base64.b64encode(fields["data"]).decode()
+        if self.trace_file is None:
+            self.trace_file = gzip.open(self.trace_path, "wt")
+        self.trace_file.write(json.dumps(fields, separators=(",", ":")) + "\n")
+
+
+class SessionTraceRecorder:
+    """
+    SessionTraceRecorder: capture mode for real sessions (SESSION_TRACE_DIR=<folder>), the traces are replayed by
+    benchmarks/replay_session_trace.py to benchmark changes on realistic interview shapes.
+    """
+
+    def __init__(self):
+        self.TRACE_DIR = os.getenv("SESSION_TRACE_DIR", "")
+        self.KEEP_AUDIO = os.getenv("SESSION_TRACE_AUDIO", "0") == "1"
+        self.write_queue = queue.Queue()
+        self.writer = None
+        self.writer_lock = threading.Lock()
+
+    def enabled(self) -> bool:
+        return bool(self.TRACE_DIR)
+
+    def open(self, sid: str, thread_id: str, agent_id: str, auth: dict) -> SessionTrace | None:
+        """
+        Start the trace of a session, None when capture mode is off.
+        """
+        if not self.enabled():
+            return None
+        with self.writer_lock:
+            if self.writer is None:
+                os.makedirs(self.TRACE_DIR, exist_ok=True)
+                self.writer = threading.Thread(target=self.__write_loop, name="session_trace_writer", daemon=True)
+                self.writer.start()
+        # the file name keeps a short prefix of the interview ID, enough to find a session, not to join it
+        trace = SessionTrace(f"{self.TRACE_DIR}/{thread_id[0:8]}_{sid}_{int(time.time())}.trace.jsonl.gz",
+                             self.KEEP_AUDIO, self.write_queue)
+        trace.record("connect", auth=SessionTrace.redact(auth), agent_id=agent_id)
+        return trace
+
+    def flush(self):
+        """
+        Wait until every queued record is written.
+        """
+        self.write_queue.join()
+
+    def __write_loop(self):
+        while True:
+            trace, fields = self.write_queue.get()
+            try:
+                trace.write(fields)
+            except Exception as e:
+                print(f"Error writing session trace {trace.trace_path}: {e}")
+            finally:
+                self.write_queue.task_done()
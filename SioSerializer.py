@@ -0,0 +1,73 @@
+# Copyright (c) 2024.
+# -*-coding:utf-8 -*-
+"""
+@file: SioSerializer.py
+@author: Jerry(Ruihuang)Yang
+@email: rxy216@case.edu
+@time: 10/19/26 19:30
+"""
+import json
+import os
+
+
+class OrjsonModule:
+    """
+    OrjsonModule: the json module interface python-socketio and python-engineio expect (dumps/loads), on orjson.
+    The output is the same JSON, so clients do not change.
+    """
+
+    @staticmethod
+    def dumps(obj, **kwargs) -> str:
+        import orjson
+        try:
+            return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode()
+        except TypeError:
+            return json.dumps(obj, **kwargs)  # types orjson does not know, encoded as before
+
+    @staticmethod
+    def loads(s, **kwargs):
+        import orjson
+        return orjson.loads(s)
+
+
+class SioSerializer:
+    """
+    SioSerializer: packet format of sio_server, set per deployment with SIO_SERIALIZER.
+    json: the default Socket.IO JSON packets.
+    orjson: the same JSON packets, encoded and decoded with orjson.
+    msgpack: binary MessagePack packets, the client needs the socket.io-msgpack-parser.
+    There is no negotiation on the socket: packets are decoded before connect runs, so a client with another parser
+    never reaches it. Clients read the wire format from GET /protocol over HTTP before connecting and pick their
+    parser from it. connect only checks the protocol version.
+    """
+    PROTOCOL_VERSION = 1
+    WIRE_FORMATS = {"json": "json", "orjson": "json", "msgpack": "msgpack"}
+
+    def __init__(self):
+        self.MODE = os.getenv("SIO_SERIALIZER", "json")
+        if self.MODE not in self.WIRE_FORMATS:
+            print("Unknown SIO_SERIALIZER, using json:", self.MODE)
+            self.MODE = "json"
+        self.wire_format = self.WIRE_FORMATS[self.MODE]
+
+    def server_options(self) -> dict:
+        """
+        The socketio.AsyncServer arguments of the mode.
+        """
+        if self.MODE == "orjson":
+            return {"json": OrjsonModule}
+        if self.MODE == "msgpack":
+            return {"serializer": "msgpack"}
+        return {}
+
+    def protocol_info(self) -> dict:
+        return {"protocol_version": self.PROTOCOL_VERSION, "serializer": self.wire_format}
+
+    def accepts(self, auth: dict) -> bool:
+        """
+        Whether the client speaks a protocol version this server supports. Older clients send nothing, version 1.
+        """
+        try:
+            return int(auth.get("protocol_version", 1)) <= self.PROTOCOL_VERSION
+        except (TypeError, ValueError):
+            return False
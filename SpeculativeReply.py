@@ -0,0 +1,103 @@
+# Copyright (c) 2024.
+# -*-coding:utf-8 -*-
+"""
+@file: SpeculativeReply.py
+@author: Jerry(Ruihuang)Yang
+@email: rxy216@case.edu
+@time: 10/19/26 22:30
+"""
+import asyncio
+import re
+
+
+class SpeculativeReply:
+    """
+    SpeculativeReply: a reply started on an interim transcript before the utterance is final (server turn mode,
+    SPECULATIVE_LLM=1). The provider tokens are held here, nothing is sent or synthesized. If the final transcript
+    matches the speculated text, the turn is committed and streams the held tokens at once, then the rest as they
+    come; otherwise the provider stream is cancelled and its tokens count as wasted.
+    The counters are shared by all sessions, to tune SPECULATION_STABLE_MS against the waste.
+    """
+    started = 0
+    hits = 0
+    misses = 0
+    wasted_tokens = 0
+    committed_tokens = 0
+
+    def __init__(self, text: str, chat_stream, token_stream):
+        self.text = text
+        self.key = self.normalize(text)
+        self.chat_stream = chat_stream
+        self.tokens = []
+        self.finished = False
+        self.error = None
+        self.updated = asyncio.Event()
+        self.task = asyncio.create_task(self.__hold(token_stream))
+        SpeculativeReply.started += 1
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        """
+        Compare transcripts by their words, interim and final results differ in casing and punctuation.
+        """
+        return " ".join(re.sub(r"[^\w\s']", " ", text.lower()).split())
+
+    def matches(self, text: str) -> bool:
+        return self.error is None and self.key == self.normalize(text)
+
+    def cancel(self):
+        """
+        Drop the speculation, the transcript went another way.
+        """
+        self.task.cancel()
+        SpeculativeReply.misses += 1
+        SpeculativeReply.wasted_tokens += len(self.tokens)
+
+    def commit(self):
+        """
+        Confirm the speculation. It counts as a hit once the turn starts reading the stream, a turn that is refused
+        never reads it and is cancelled as a miss.
+        :return: The token stream for ChatStream.stream_chat(token_source=...).
+        """
+        return self.__replay()
+
+    @classmethod
+    def stats(cls) -> dict:
+        decided = cls.hits + cls.misses
+        return {"started": cls.started, "hits": cls.hits, "misses": cls.misses,
+                "hit_rate": round(cls.hits / decided, 3) if decided else 0.0,
+                "wasted_tokens": cls.wasted_tokens, "committed_tokens": cls.committed_tokens}
+
+    async def __hold(self, token_stream):
+        try:
+            async for token in token_stream:
+                self.tokens.append(token)
+                self.updated.set()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.error = e
+        finally:
+            await token_stream.aclose()  # gives the provider slot back
+            self.finished = True
+            self.updated.set()
+
+    async def __replay(self):
+        SpeculativeReply.hits += 1
+        position = 0
+        try:
+            while True:
+                if position < len(self.tokens):
+                    yield self.tokens[position]
+                    position += 1
+                    continue
+                if self.finished:
+                    if self.error is not None:
+                        raise self.error
+                    return
+                self.updated.clear()
+                await self.updated.wait()
+        finally:
+            SpeculativeReply.committed_tokens += position
+            if not self.finished:
+                self.task.cancel()  # the turn was cancelled while the provider was still streaming
@@ -0,0 +1,165 @@
+# Copyright (c) 2024.
+# -*-coding:utf-8 -*-
+"""
+@file: StepOpeningCache.py
+@author: Jerry(Ruihuang)Yang
+@email: rxy216@case.edu
+@time: 10/19/26 18:55
+"""
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import json
+import logging
+import os
+import threading
+from PromptManager import PromptManager
+from ProviderScheduler import ProviderScheduler
+from TtsStream import TtsStream
+
+
+class StepOpeningCache:
+    """
+    StepOpeningCache: precomputed opening turn of every step of an agent (STEP_OPENING_PRECOMPUTE=1).
+    When an agent is cached at connect, the opening text of each step is generated once, from the step instruction
+    alone, and synthesized in the encoding of the session. When a candidate moves to the next step, ChatStream answers
+    with the stored opening and its audio right away, the following turns are generated as usual.
+    Entries are keyed by (agent_id, step, hash of the step prompt, encoding), so editing a prompt invalidates them.
+    """
+    DISK_FOLDER = "volume_cache/step_opening_cache"
+    OPENING_REQUEST = "[The candidate is ready and has moved on to this part. Open this part now.]"
+    instance = None
+    instance_lock = threading.Lock()
+
+    def __init__(self):
+        self.ENABLED = os.getenv("STEP_OPENING_PRECOMPUTE", "0") == "1"
+        self.MODEL = os.getenv("STEP_OPENING_MODEL", "gpt-4o")
+        self.lock = threading.Lock()
+        self.texts = {}  # key -> opening text, the audio stays on disk
+        self.pending = set()  # keys being precomputed, so concurrent connects of one agent do it once
+        self.hits = 0
+        self.misses = 0
+        self.precomputed = 0
+        self.executor = ThreadPoolExecutor(max_workers=int(os.getenv("STEP_OPENING_WORKERS", "2")),
+                                           thread_name_prefix="step_opening") if self.ENABLED else None
+        self.worker_state = threading.local()  # per worker AgentPromptHandler, its boto3 resource is not thread safe
+
+    @classmethod
+    def get_instance(cls) -> "StepOpeningCache":
+        with cls.instance_lock:
+            if cls.instance is None:
+                cls.instance = StepOpeningCache()
+        return cls.instance
+
+    @staticmethod
+    def make_key(agent_id: str, step: str, step_prompt: str, encoding: str) -> str:
+        prompt_hash = hashlib.sha256(step_prompt.encode()).hexdigest()[0:16]
+        return f"{agent_id}_{step}_{prompt_hash}_{encoding}"
+
+    def get(self, agent_id: str, step: str, step_prompt: str, encoding: str) -> dict | None:
+        """
+        The opening of a step, if it has been precomputed. Reads the disk, call it off the event loop.
+        :return: {"text": str, "audio": bytes}, None otherwise.
+        """
+        if not self.ENABLED or not step_prompt:
+            return None
+        key = self.make_key(agent_id, step, step_prompt, encoding)
+        with self.lock:
+            text = self.texts.get(key)
+        if text is None:
+            text = self.__load_text(key)
+        audio_path = self.__audio_path(key, encoding)
+        if text is None or not os.path.isfile(audio_path):
+            with self.lock:
+                self.misses += 1
+            return None
+        with open(audio_path, "rb") as f:
+            audio = f.read()
+        with self.lock:
+            self.texts[key] = text
+            self.hits += 1
+        return {"text": text, "audio": audio}
+
+    def submit_agent(self, agent_id: str, openai_client, encoding: str):
+        """
+        Precompute the openings of an agent in the background, called when the agent is cached.
+        """
+        if self.ENABLED:
+            self.executor.submit(self.precompute_agent, agent_id, openai_client, encoding)
+
+    def precompute_agent(self, agent_id: str, openai_client, encoding: str, agent_prompt_handler=None):
+        """
+        Precompute the openings of every step of an agent but the first, which has no transition into it.
+        Blocking, meant for a worker thread. Steps are numbered from 0, the first missing prompt ends the agent.
+        :param agent_prompt_handler: Defaults to the handler of the calling worker, never the one of the event loop.
+        """
+        if not self.ENABLED:
+            return
+        if agent_prompt_handler is None:
+            agent_prompt_handler = self.__worker_prompt_handler()
+        step = 1
+        while True:
+            step_prompt = agent_prompt_handler.get_agent_prompt(agent_id, str(step))
+            if not step_prompt:
+                return
+            key = self.make_key(agent_id, str(step), step_prompt, encoding)
+            with self.lock:
+                skip = key in self.pending or key in self.texts
+                if not skip:
+                    self.pending.add(key)
+            if not skip:
+                try:
+                    if self.__load_text(key) is None or not os.path.isfile(self.__audio_path(key, encoding)):
+                        self.__precompute_step(key, agent_id, step_prompt, openai_client, encoding)
+                except Exception as e:
+                    logging.error(f"Error precomputing the opening of agent {agent_id} at step {step}: {e}")
+                finally:
+                    with self.lock:
+                        self.pending.discard(key)
+            step += 1
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"enabled": self.ENABLED, "entries": len(self.texts), "hits": self.hits, "misses": self.misses,
+                    "precomputed": self.precomputed}
+
+    def __worker_prompt_handler(self):
+        handler = getattr(self.worker_state, "agent_prompt_handler", None)
+        if handler is None:
+            from AgentPromptHandler import AgentPromptHandler
+            handler = AgentPromptHandler()
+            self.worker_state.agent_prompt_handler = handler
+        return handler
+
+    def __precompute_step(self, key: str, agent_id: str, step_prompt: str, openai_client, encoding: str):
+        messages = [{"role": "system", "content": PromptManager.step_system_prompt(json.loads(step_prompt))},
+                    {"role": "user", "content": self.OPENING_REQUEST}]
+        # background work, it only gets the provider capacity the live sessions leave
+        with ProviderScheduler.get_instance().slot("openai", f"precompute_{agent_id}",
+                                                   ProviderScheduler.PRIORITY_BACKGROUND):
+            completion = openai_client.chat.completions.create(model=self.MODEL, messages=messages, max_tokens=512,
+                                                               temperature=1)
+        text = completion.choices[0].message.content
+        if not text:
+            return
+        audio = TtsStream(f"step_opening_{key}", encoding).synthesize(text)
+        if audio is None:
+            return
+        os.makedirs(self.DISK_FOLDER, exist_ok=True)
+        with open(self.__audio_path(key, encoding), "wb") as f:
+            f.write(audio)
+        with open(f"{self.DISK_FOLDER}/{key}.json", "w") as f:  # written last, it marks the entry complete
+            json.dump({"text": text}, f)
+        with self.lock:
+            self.texts[key] = text
+            self.precomputed += 1
+        logging.info(f"Precomputed the opening of agent {agent_id}: {key}")
+
+    def __load_text(self, key: str) -> str | None:
+        try:
+            with open(f"{self.DISK_FOLDER}/{key}.json") as f:
+                return json.load(f)["text"]
+        except (FileNotFoundError, ValueError, KeyError):
+            return None
+
+    def __audio_path(self, key: str, encoding: str) -> str:
+        return f"{self.DISK_FOLDER}/{key}.{TtsStream.ENCODINGS[encoding]['extension']}"
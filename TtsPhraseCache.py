@@ -0,0 +1,166 @@
+# Copyright (c) 2024.
+# -*-coding:utf-8 -*-
+"""
+@file: TtsPhraseCache.py
+@author: Jerry(Ruihuang)Yang
+@email: rxy216@case.edu
+@time: 10/19/26 13:05
+"""
+from collections import OrderedDict
+import hashlib
+import logging
+import os
+import threading
+
+
+class TtsPhraseCache:
+    """
+    TtsPhraseCache: content-addressed cache of synthesized audio for short phrases.
+    The interviewer answers with single words ("Okay.", "Good.", "Correct.") most of the time, those are served from
+    an in-memory LRU, backed by an optional Redis or disk tier (TTS_CACHE_TIER), without calling Deepgram.
+    """
+    DISK_FOLDER = "volume_cache/tts_phrase_cache"
+    KEY_PREFIX = "tts_phrase_"
+    KEY_VERSION = "2"  # 1 lowercased the text, its entries are left to expire
+
+    def __init__(self):
+        self.MAX_TEXT_CHARS = int(os.getenv("TTS_CACHE_MAX_TEXT_CHARS", "80"))  # only short phrases repeat
+        self.MEMORY_MAX_BYTES = int(os.getenv("TTS_CACHE_MEMORY_MAX_BYTES", str(32 * 1024 * 1024)))
+        self.MEMORY_MAX_ENTRIES = int(os.getenv("TTS_CACHE_MEMORY_MAX_ENTRIES", "2000"))
+        self.SECOND_TIER = os.getenv("TTS_CACHE_TIER", "")  # "", "redis" or "disk"
+        self.REDIS_TTL_S = int(os.getenv("TTS_CACHE_REDIS_TTL_S", str(7 * 24 * 3600)))
+        self.DISK_MAX_BYTES = int(os.getenv("TTS_CACHE_DISK_MAX_BYTES", str(512 * 1024 * 1024)))
+        self.lock = threading.Lock()
+        self.memory = OrderedDict()
+        self.memory_bytes = 0
+        self.redis_client = None
+        self.disk_bytes = 0
+        self.hits_memory = 0
+        self.hits_second_tier = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        if self.SECOND_TIER == "redis":
+            import redis
+            self.redis_client = redis.Redis(host=os.getenv("REDIS_ADDRESS"), port=6379, protocol=3,
+                                            decode_responses=False)
+        elif self.SECOND_TIER == "disk":
+            os.makedirs(self.DISK_FOLDER, exist_ok=True)
+            self.disk_bytes = sum(entry.stat().st_size for entry in os.scandir(self.DISK_FOLDER) if entry.is_file())
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        """
+        Normalize the whitespace so "Okay." and " Okay. " share one entry. The case is kept, "US" and "us" are
+        spoken differently.
+        """
+        return " ".join(text.split())
+
+    def cacheable(self, text: str) -> bool:
+        return 0 < len(text) <= self.MAX_TEXT_CHARS
+
+    def make_key(self, text: str, *variant: str) -> str:
+        """
+        Build the cache key from the normalized text and everything that changes the audio (voice model etc.).
+        """
+        key_source = "|".join([self.KEY_VERSION, *variant, self.normalize(text)])
+        return hashlib.sha256(key_source.encode()).hexdigest()
+
+    def get(self, key: str) -> bytes | None:
+        with self.lock:
+            audio = self.memory.get(key)
+            if audio is not None:
+                self.memory.move_to_end(key)
+                self.hits_memory += 1
+                return audio
+        audio = self.__get_second_tier(key)
+        with self.lock:
+            if audio is None:
+                self.misses += 1
+                return None
+            self.hits_second_tier += 1
+            self.__put_memory(key, audio)
+        return audio
+
+    def put(self, key: str, audio: bytes):
+        with self.lock:
+            self.__put_memory(key, audio)
+            self.stores += 1
+        self.__put_second_tier(key, audio)
+
+    def stats(self) -> dict:
+        lookups = self.hits_memory + self.hits_second_tier + self.misses
+        return {
+            "tier": self.SECOND_TIER or "memory",
+            "entries": len(self.memory),
+            "memory_bytes": self.memory_bytes,
+            "disk_bytes": self.disk_bytes,
+            "hits_memory": self.hits_memory,
+            "hits_second_tier": self.hits_second_tier,
+            "misses": self.misses,
+            "hit_rate": round((self.hits_memory + self.hits_second_tier) / lookups, 3) if lookups else 0.0,
+            "stores": self.stores,
+            "evictions": self.evictions,
+        }
+
+    def __put_memory(self, key: str, audio: bytes):
+        """
+        Insert into the LRU, must be called with the lock held.
+        """
+        if key in self.memory:
+            self.memory_bytes -= len(self.memory.pop(key))
+        self.memory[key] = audio
+        self.memory_bytes += len(audio)
+        while self.memory and (self.memory_bytes > self.MEMORY_MAX_BYTES
+                               or len(self.memory) > self.MEMORY_MAX_ENTRIES):
+            _, evicted = self.memory.popitem(last=False)
+            self.memory_bytes -= len(evicted)
+            self.evictions += 1
+
+    def __get_second_tier(self, key: str) -> bytes | None:
+        try:
+            if self.redis_client is not None:
+                return self.redis_client.get(self.KEY_PREFIX + key)
+            if self.SECOND_TIER == "disk":
+                path = f"{self.DISK_FOLDER}/{key}.bin"
+                if os.path.isfile(path):
+                    with open(path, "rb") as f:
+                        return f.read()
+        except Exception as e:
+            logging.error(f"Error reading the TTS phrase cache: {e}")
+        return None
+
+    def __put_second_tier(self, key: str, audio: bytes):
+        try:
+            if self.redis_client is not None:
+                self.redis_client.set(self.KEY_PREFIX + key, audio, ex=self.REDIS_TTL_S)
+            elif self.SECOND_TIER == "disk":
+                path = f"{self.DISK_FOLDER}/{key}.bin"
+                if os.path.isfile(path):
+                    return
+                with open(path, "wb") as f:
+                    f.write(audio)
+                with self.lock:
+                    self.disk_bytes += len(audio)
+                    over_limit = self.disk_bytes > self.DISK_MAX_BYTES
+                if over_limit:
+                    self.__evict_disk()
+        except Exception as e:
+            logging.error(f"Error writing the TTS phrase cache: {e}")
+
+    def __evict_disk(self):
+        """
+        Remove the least recently written files until the disk tier is back under 90% of its limit.
+        """
+        entries = sorted((entry for entry in os.scandir(self.DISK_FOLDER) if entry.is_file()),
+                         key=lambda entry: entry.stat().st_mtime)
+        total = sum(entry.stat().st_size for entry in entries)
+        for entry in entries:
+            if total <= self.DISK_MAX_BYTES * 0.9:
+                break
+            size = entry.stat().st_size
+            os.remove(entry.path)
+            total -= size
+            self.evictions += 1
+        with self.lock:
+            self.disk_bytes = total
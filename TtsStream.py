@@ -6,12 +6,17 @@
 @email: rxy216@case.edu
 @time: 3/1/24 19:30
 """
-import requests
+from urllib.parse import urlencode
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
 import os
 import re
+import threading
+from TtsPhraseCache import TtsPhraseCache
+from ProviderScheduler import ProviderScheduler
+from UpstreamPools import UpstreamPools
 
 import time
-from dotenv import load_dotenv
 
 
 class TtsStream:
@@ -19,39 +24,280 @@ class TtsStream:
     TtsStream: Text-to-Speech streaming with Deepgram API.
     """
     # Define the API endpoint
-    URL = "https://api.deepgram.com/v1/speak?model=aura-2-odysseus-en"
+    MODEL = "aura-2-odysseus-en"
+    URL = "https://api.deepgram.com/v1/speak"
+    # Output encodings a client can ask for at connect, trading bandwidth against quality
+    ENCODINGS = {
+        "mp3": {"params": {}, "extension": "mp3"},  # Deepgram default, 48 kbps
+        "mp3_low": {"params": {"encoding": "mp3", "bit_rate": "32000"}, "extension": "mp3"},
+        "opus": {"params": {"encoding": "opus", "container": "ogg"}, "extension": "ogg"},  # 12 kbps
+        "linear16": {"params": {"encoding": "linear16", "container": "wav", "sample_rate": "24000"},
+                     "extension": "wav"},  # for local playback
+    }
+    DEFAULT_ENCODING = "mp3"
+    MEDIA_TYPES = {"mp3": "audio/mpeg", "ogg": "audio/ogg", "wav": "audio/wav"}
     TTS_AUDIO_CACHE_FOLDER = "volume_cache/tts_audio_cache"
+    in_flight = 0  # number of syntheses currently waiting on Deepgram, across all sessions
+    in_flight_lock = threading.Lock()
+    phrase_cache = None  # shared by all sessions, built on first use so the env config is loaded by then
+    in_progress = {}  # "{tts_session_id}_{chunk_id}" -> synthesis still running
+    executor = None  # worker threads running the syntheses, TTS_STREAMING_WORKERS of them in both modes
+    STREAM_READ_SIZE = 4096
+    STREAM_POLL_S = 0.02
+    STREAM_TIMEOUT_S = 30  # how long /tts waits for a synthesis, without new audio in streaming mode
+    MARKUP_PATTERN = re.compile(r"\[.*?]|\{.*?}")  # anything wrapped in square brackets or curly braces
 
-    def __init__(self, tts_session_id: str):
+    def __init__(self, tts_session_id: str, encoding: str = DEFAULT_ENCODING, trace=None):
         self.API_KEY = os.getenv("DEEPGRAM_API_KEY")
         self.tts_session_id = tts_session_id
+        self.session_key = tts_session_id  # fair queuing key in the provider scheduler, ChatStream sets the sid
+        self.trace = trace  # SessionTrace of the session in capture mode, None otherwise
+        self.encoding = encoding if encoding in self.ENCODINGS else self.DEFAULT_ENCODING
+        self.extension = self.ENCODINGS[self.encoding]["extension"]
+        self.url = f"{self.URL}?{urlencode({'model': self.MODEL, **self.ENCODINGS[self.encoding]['params']})}"
+        # in streaming mode /tts serves the audio while it is still arriving, otherwise once the chunk is done
+        self.STREAMING_MODE = os.getenv("TTS_STREAMING_MODE", "0") == "1"
+
+    @classmethod
+    def negotiate_encoding(cls, requested) -> str:
+        """
+        Pick the output encoding for a client.
+        :param requested: An encoding name, or a list of them in order of preference, or None.
+        :return: The first supported encoding, the default encoding if none is supported.
+        """
+        if isinstance(requested, str):
+            requested = [requested]
+        for encoding in requested or []:
+            if encoding in cls.ENCODINGS:
+                return encoding
+        return cls.DEFAULT_ENCODING
+
+    @classmethod
+    def find_audio_file(cls, tts_session_id: str, chunk_id: str) -> tuple[str, str] | None:
+        """
+        Find the audio file of a chunk, whatever encoding it was synthesized in.
+        :return: The file path and its media type, None if there is no such file.
+        """
+        for extension, media_type in cls.MEDIA_TYPES.items():
+            file_location = f"{cls.TTS_AUDIO_CACHE_FOLDER}/{tts_session_id}_{chunk_id}.{extension}"
+            if os.path.isfile(file_location):
+                return file_location, media_type
+        return None
+
+    @classmethod
+    def queue_depth(cls) -> int:
+        """
+        TTS chunks waiting for or in synthesis, across all sessions.
+        """
+        return cls.in_flight
+
+    @classmethod
+    def get_phrase_cache(cls) -> TtsPhraseCache:
+        with cls.in_flight_lock:
+            if cls.phrase_cache is None:
+                cls.phrase_cache = TtsPhraseCache()
+        return cls.phrase_cache
 
     def stream_tts(self, text: str, chunk_id: str):
+        """
+        Start the synthesis of a chunk and return at once, it runs on the executor. /tts waits for the chunk (or
+        streams it as it arrives in streaming mode), so the event loop never waits on Deepgram or its provider slot.
+        """
+        # The first chunk of a reply is what the candidate is waiting on, it goes ahead of later chunks
+        priority = ProviderScheduler.PRIORITY_FIRST if chunk_id == "0" else ProviderScheduler.PRIORITY_NORMAL
+        # Process the text to remove anything wrapped in square brackets or curly braces
+        text = self.MARKUP_PATTERN.sub("", text)
+
+        with self.in_flight_lock:
+            TtsStream.in_flight += 1
+        # register before returning, so a /tts request that comes right away waits instead of a 404
+        file_key = f"{self.tts_session_id}_{chunk_id}"
+        self.in_progress[file_key] = {"path": self.__audio_path(chunk_id), "done": threading.Event(),
+                                      "started": threading.Event(), "progressive": self.STREAMING_MODE}
+        self.get_executor().submit(self.__synthesize_chunk, text, chunk_id, priority)
+
+    def synthesize(self, text: str) -> bytes | None:
+        """
+        Synthesize a text and return the audio, for background work (step openings), so it yields to live sessions.
+        """
+        return self.__synthesize(self.MARKUP_PATTERN.sub("", text), ProviderScheduler.PRIORITY_BACKGROUND)
+
+    def put_audio(self, audio: bytes, chunk_id: str):
+        """
+        Serve audio synthesized ahead of time as a chunk of this session.
+        """
+        self.__save_audio(audio, chunk_id)
+
+    @classmethod
+    def get_executor(cls) -> ThreadPoolExecutor:
+        with cls.in_flight_lock:
+            if cls.executor is None:
+                cls.executor = ThreadPoolExecutor(max_workers=int(os.getenv("TTS_STREAMING_WORKERS", "32")),
+                                                  thread_name_prefix="tts_stream")
+        return cls.executor
+
+    @classmethod
+    def get_in_progress(cls, tts_session_id: str, chunk_id: str) -> dict | None:
+        return cls.in_progress.get(f"{tts_session_id}_{chunk_id}")
+
+    @classmethod
+    async def wait_done(cls, synthesis: dict):
+        """
+        Wait for a synthesis to finish, without blocking the event loop.
+        :param synthesis: The in_progress entry of the chunk.
+        """
+        waited = 0.0
+        while not synthesis["done"].is_set() and waited < cls.STREAM_TIMEOUT_S:
+            await asyncio.sleep(cls.STREAM_POLL_S)
+            waited += cls.STREAM_POLL_S
+
+    @classmethod
+    async def wait_started(cls, synthesis: dict) -> bool:
+        """
+        Wait for Deepgram to accept a streaming synthesis, so /tts can still answer 404 when it fails.
+        :param synthesis: The in_progress entry of the chunk.
+        :return: True once the audio is arriving, False if the synthesis ended without audio or timed out.
+        """
+        waited = 0.0
+        while not synthesis["started"].is_set():
+            if synthesis["done"].is_set() or waited >= cls.STREAM_TIMEOUT_S:
+                return synthesis["started"].is_set()
+            await asyncio.sleep(cls.STREAM_POLL_S)
+            waited += cls.STREAM_POLL_S
+        return True
+
+    @classmethod
+    async def iter_progressive(cls, synthesis: dict):
+        """
+        Yield the audio of a synthesis that is still running, as the bytes reach the file. Gives up after
+        STREAM_TIMEOUT_S without new audio.
+        :param synthesis: The in_progress entry of the chunk.
+        """
+        position = 0
+        waited = 0.0
+        while waited < cls.STREAM_TIMEOUT_S:
+            done = synthesis["done"].is_set()  # check before reading, so the last read gets everything
+            if os.path.isfile(synthesis["path"]):
+                with open(synthesis["path"], "rb") as f:
+                    f.seek(position)
+                    data = f.read()
+                if data:
+                    position += len(data)
+                    waited = 0.0
+                    yield data
+            if done:
+                return
+            await asyncio.sleep(cls.STREAM_POLL_S)
+            waited += cls.STREAM_POLL_S
+
+    def __synthesize(self, text: str, priority: int) -> bytes | None:
         # Define the headers
         headers = {
             "Authorization": f"Token {self.API_KEY}",
             "Content-Type": "application/json"
         }
 
-        # Process the text to remove anything wrapped in square brackets or curly braces
-        text = re.sub(r"\[.*?]|\{.*?}", "", text)
-
         # Define the payload
         payload = {
             "text": text,
         }
 
-        # Make the POST request
-        response = requests.post(self.URL, headers=headers, json=payload)
+        # Make the POST request on a warm pooled connection, once the provider scheduler grants a Deepgram Speak slot
+        with ProviderScheduler.get_instance().slot("deepgram_speak", self.session_key, priority):
+            response = UpstreamPools.get_instance().request("deepgram_speak", "POST", self.url, headers=headers,
+                                                            json=payload)
 
         # Check if the request was successful
         if response.status_code == 200:
-            # check if the folder exists
-            if not os.path.exists(self.TTS_AUDIO_CACHE_FOLDER):
-                os.makedirs(self.TTS_AUDIO_CACHE_FOLDER)
-            # Save the response content to a file
-            with open(f"./{self.TTS_AUDIO_CACHE_FOLDER}/{self.tts_session_id}_{chunk_id}.mp3", "wb") as f:
-                f.write(response.content)
-            print("TTS file saved successfully.")
-        else:
-            print(f"Error: {response.status_code} - {response.text}")
+            return response.content
+        print(f"Error: {response.status_code} - {response.text}")
+        return None
+
+    def __synthesize_chunk(self, text: str, chunk_id: str, priority: int):
+        """
+        Synthesize a chunk of stream_tts into its audio file. Runs on the executor.
+        """
+        file_key = f"{self.tts_session_id}_{chunk_id}"
+        synthesis = self.in_progress[file_key]
+        try:
+            # Short phrases repeat a lot, serve them from the phrase cache without calling Deepgram
+            phrase_cache = self.get_phrase_cache()
+            cache_key = None
+            if phrase_cache.cacheable(text):
+                cache_key = phrase_cache.make_key(text, self.MODEL, self.encoding)
+                audio = phrase_cache.get(cache_key)
+                if audio is not None:
+                    self.__save_audio(audio, chunk_id)
+                    if self.trace:
+                        self.trace.record("tts", chunk_id=chunk_id, chars=len(text), bytes=len(audio),
+                                          latency_ms=0, cached=True)
+                    return
+            if self.STREAMING_MODE:
+                self.__synthesize_streaming(text, chunk_id, synthesis, cache_key, priority)
+                return
+            started = time.monotonic()
+            audio = self.__synthesize(text, priority)
+            if audio is not None:
+                self.__save_audio(audio, chunk_id)
+                if self.trace:
+                    self.trace.record("tts", chunk_id=chunk_id, chars=len(text), bytes=len(audio),
+                                      latency_ms=round((time.monotonic() - started) * 1000, 1), cached=False)
+                if cache_key:
+                    phrase_cache.put(cache_key, audio)
+        except Exception as e:
+            print(f"Error synthesizing TTS: {e}")
+        finally:
+            synthesis["done"].set()
+            self.in_progress.pop(file_key, None)
+            with self.in_flight_lock:
+                TtsStream.in_flight -= 1
+
+    def __synthesize_streaming(self, text: str, chunk_id: str, synthesis: dict, cache_key: str | None, priority: int):
+        """
+        Streaming mode: read the Deepgram response incrementally and append it to the audio file as it arrives.
+        """
+        headers = {
+            "Authorization": f"Token {self.API_KEY}",
+            "Content-Type": "application/json"
+        }
+        audio = bytearray() if cache_key else None
+        started = time.monotonic()
+        first_byte_ms = None
+        received = 0
+        with ProviderScheduler.get_instance().slot("deepgram_speak", self.session_key, priority), \
+                UpstreamPools.get_instance().stream("deepgram_speak", "POST", self.url, headers=headers,
+                                                    json={"text": text}) as response:
+            if response.status_code != 200:
+                response.read()
+                print(f"Error: {response.status_code} - {response.text}")
+                return
+            os.makedirs(self.TTS_AUDIO_CACHE_FOLDER, exist_ok=True)
+            with open(synthesis["path"], "wb") as f:
+                synthesis["started"].set()
+                for data in response.iter_bytes(chunk_size=self.STREAM_READ_SIZE):
+                    if first_byte_ms is None:
+                        first_byte_ms = round((time.monotonic() - started) * 1000, 1)
+                    received += len(data)
+                    f.write(data)
+                    f.flush()
+                    if audio is not None:
+                        audio += data
+        if cache_key:
+            self.get_phrase_cache().put(cache_key, bytes(audio))
+        if self.trace:
+            self.trace.record("tts", chunk_id=chunk_id, chars=len(text), bytes=received,
+                              latency_ms=round((time.monotonic() - started) * 1000, 1),
+                              first_byte_ms=first_byte_ms, cached=False)
+        print("TTS file streamed successfully.")
+
+    def __audio_path(self, chunk_id: str) -> str:
+        return f"./{self.TTS_AUDIO_CACHE_FOLDER}/{self.tts_session_id}_{chunk_id}.{self.extension}"
+
+    def __save_audio(self, audio: bytes, chunk_id: str):
+        # check if the folder exists
+        if not os.path.exists(self.TTS_AUDIO_CACHE_FOLDER):
+            os.makedirs(self.TTS_AUDIO_CACHE_FOLDER)
+        # Save the response content to a file
+        with open(self.__audio_path(chunk_id), "wb") as f:
+            f.write(audio)
+        print("TTS file saved successfully.")
@@ -0,0 +1,260 @@
+# Copyright (c) 2024.
+# -*-coding:utf-8 -*-
+"""
+@file: UplinkAudioStage.py
+@author: Jerry(Ruihuang)Yang
+@email: rxy216@case.edu
+@time: 10/19/26 10:40
+"""
+from bisect import bisect_left, bisect_right
+import asyncio
+import os
+import time
+
+
+class UplinkAudioStage:
+    """
+    UplinkAudioStage: per-session stage between uplink_stt_audio and the Deepgram live connection.
+    Client frames are merged into WINDOW_MS windows and sent from a background task, so one slow or reconnecting
+    STT socket never blocks the event loop. push never waits: Socket.IO runs every uplink event in its own task, so
+    waiting there would only pile up tasks holding frames. When Deepgram falls behind and the bounded queue is full:
+    - raw PCM uplinks with the "drop" policy lose their oldest batch, PCM stays decodable without it.
+    - otherwise (the "pause" policy, and always for webm/ogg, where a missing byte range breaks the container) the
+      window is held back and on_pressure(True) tells the client to pause its uplink, on_pressure(False) once the
+      queue is half empty again. A held window over MAX_PENDING_BYTES drops its oldest audio for PCM; a container
+      stream cannot skip audio, its transcription is stopped instead (overrun), the recording is not affected.
+    Queued audio is never dropped while the STT connection is being opened, it waits for it.
+    Deepgram times restart from 0 on every connection and skip dropped audio, to_input_time maps them back onto the
+    audio pushed here (PCM only, container uplinks keep one connection and never drop).
+    """
+
+    def __init__(self, sid: str, get_connection, sample_rate: int | None = None, on_pressure=None):
+        """
+        :param sid: The socket id of the session.
+        :param get_connection: Callable returning the current Deepgram live connection of the session, or None.
+        :param sample_rate: Sample rate of a raw PCM (linear16) uplink, None for webm/ogg. Only PCM audio is dropped.
+        :param on_pressure: Callable taking True when the client should pause its uplink, False when it can resume.
+        """
+        self.WINDOW_MS = int(os.getenv("UPLINK_COALESCE_WINDOW_MS", "100"))
+        self.MAX_QUEUED_BATCHES = int(os.getenv("UPLINK_MAX_QUEUED_BATCHES", "50"))
+        self.OVERFLOW_POLICY = os.getenv("UPLINK_OVERFLOW_POLICY", "drop")  # "drop" or "pause", drop is PCM only
+        self.MAX_PENDING_BYTES = int(os.getenv("UPLINK_MAX_PENDING_BYTES", str(2 * 1024 * 1024)))
+        self.LAG_WARNING_MS = int(os.getenv("UPLINK_LAG_WARNING_MS", "1000"))
+        self.sid = sid
+        self.get_connection = get_connection
+        self.droppable = sample_rate is not None
+        self.bytes_per_ms = sample_rate * 2 / 1000 if sample_rate else None
+        self.on_pressure = on_pressure
+        self.queue = asyncio.Queue(maxsize=self.MAX_QUEUED_BATCHES)
+        self.pending = bytearray()
+        self.pending_started = 0.0
+        self.input_bytes = 0  # audio pushed so far, the offset of the next frame
+        self.pending_offset = 0  # input offset of the first byte of the pending window
+        self.generation = 0  # incremented on every STT connection
+        self.stream_bytes = 0  # audio sent on the current connection
+        self.next_offset = None  # input offset that continues the current span
+        self.spans = {}  # generation -> ([stream ms], [input ms]) starts of the contiguous runs it was sent
+        self.flush_handle = None
+        self.closed = False
+        self.paused = False  # the client was told to pause its uplink
+        self.overrun = False  # a container stream that could not be held any longer, no more audio goes to STT
+        self.frames_in = 0
+        self.batches_sent = 0
+        self.bytes_sent = 0
+        self.dropped_batches = 0
+        self.dropped_bytes = 0
+        self.pauses = 0
+        self.last_lag_ms = 0.0
+        self.max_lag_ms = 0.0
+        self.connection_ready = asyncio.Event()
+        self.sender_task = asyncio.create_task(self.__sender())
+
+    def push(self, audio_data: bytes):
+        """
+        Add a client frame to the current window, the window is queued once it is WINDOW_MS old. Never waits.
+        :param audio_data: The raw audio frame from the client.
+        """
+        if self.closed or self.overrun:
+            return
+        self.frames_in += 1
+        now = time.monotonic()
+        if not self.pending:
+            self.pending_started = now
+            self.pending_offset = self.input_bytes
+            if self.WINDOW_MS > 0:
+                self.flush_handle = asyncio.get_running_loop().call_later(self.WINDOW_MS / 1000,
+                                                                          self.__flush_due)
+        self.pending += audio_data
+        self.input_bytes += len(audio_data)
+        if (now - self.pending_started) * 1000 >= self.WINDOW_MS:
+            self.__flush()
+
+    def set_connection_open(self, is_open: bool) -> int:
+        """
+        Tell the stage whether the STT connection is open, queued batches wait for it while it is being opened.
+        :return: The generation of the connection, for to_input_time.
+        """
+        if is_open:
+            self.generation += 1
+            self.stream_bytes = 0
+            self.next_offset = None
+            self.connection_ready.set()
+        else:
+            self.connection_ready.clear()
+        return self.generation
+
+    def to_input_time(self, generation: int, start_s: float, duration_s: float) -> tuple[float, float]:
+        """
+        Map the time of an STT result from the time of its connection to the time of the audio pushed here.
+        :param generation: The generation set_connection_open returned for the connection.
+        :return: The start and the duration in seconds, unchanged for container uplinks.
+        """
+        spans = self.spans.get(generation)
+        if self.bytes_per_ms is None or not spans:
+            return start_s, duration_s
+        start_ms = self.__stream_to_input_ms(spans, start_s * 1000, bisect_right)
+        # an end on a span boundary belongs to the span it closes, not to the next one
+        end_ms = self.__stream_to_input_ms(spans, (start_s + duration_s) * 1000, bisect_left)
+        return round(start_ms / 1000, 3), round(max(0.0, end_ms - start_ms) / 1000, 3)
+
+    def stats(self) -> dict:
+        return {
+            "frames_in": self.frames_in,
+            "batches_sent": self.batches_sent,
+            "bytes_sent": self.bytes_sent,
+            "dropped_batches": self.dropped_batches,
+            "dropped_bytes": self.dropped_bytes,
+            "queued_batches": self.queue.qsize(),
+            "paused": self.paused,
+            "pauses": self.pauses,
+            "overrun": self.overrun,
+            "last_lag_ms": round(self.last_lag_ms, 1),
+            "max_lag_ms": round(self.max_lag_ms, 1),
+        }
+
+    def queued_bytes(self) -> int:
+        """
+        Audio held by the stage: the open coalescing window and the batches waiting for Deepgram.
+        """
+        return len(self.pending) + sum(len(batch[0]) for batch in list(self.queue._queue))
+
+    async def close(self, timeout: float = 2.0):
+        """
+        Flush the pending window and wait (at most timeout seconds) for the queue to drain, then stop the sender.
+        """
+        if self.closed:
+            return
+        self.closed = True
+        if self.pending:
+            await self.queue.put(self.__take_pending())
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout)
+        except asyncio.TimeoutError:
+            print("Uplink queue not drained before close:", self.sid, self.stats())
+        self.sender_task.cancel()
+
+    def __take_pending(self) -> tuple[bytes, float, int]:
+        if self.flush_handle:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        batch = (bytes(self.pending), time.monotonic(), self.pending_offset)
+        self.pending.clear()
+        return batch
+
+    def __flush_due(self):
+        """
+        Timer callback, queues a window that did not fill up because the client stopped sending.
+        """
+        self.flush_handle = None
+        if self.pending and not self.closed:
+            self.__flush()
+
+    def __flush(self):
+        """
+        Queue the pending window, or hold it back while the queue is full.
+        """
+        if self.queue.full():
+            if not (self.droppable and self.OVERFLOW_POLICY == "drop"):
+                self.__hold()
+                return
+            dropped = self.queue.get_nowait()[0]
+            self.queue.task_done()
+            self.dropped_batches += 1
+            self.dropped_bytes += len(dropped)
+        self.queue.put_nowait(self.__take_pending())
+
+    def __hold(self):
+        """
+        Keep the window open while the queue is full, ask the client to pause and retry once the sender caught up.
+        """
+        self.__set_paused(True)
+        excess = len(self.pending) - self.MAX_PENDING_BYTES
+        if excess > 0:
+            if self.droppable:
+                excess += excess % 2  # whole 16-bit samples
+                del self.pending[:excess]
+                self.pending_offset += excess
+                self.dropped_bytes += excess
+            else:
+                print("Uplink overrun, stopping transcription of this session:", self.sid)
+                self.overrun = True
+                self.dropped_bytes += len(self.__take_pending())
+                self.__set_paused(False)  # the recording still needs the audio
+                return
+        if self.flush_handle is None:
+            self.flush_handle = asyncio.get_running_loop().call_later(max(self.WINDOW_MS, 10) / 1000,
+                                                                      self.__flush_due)
+
+    def __set_paused(self, paused: bool):
+        if paused == self.paused:
+            return
+        self.paused = paused
+        if paused:
+            self.pauses += 1
+        if self.on_pressure is not None:
+            self.on_pressure(paused)
+
+    def __record_span(self, offset: int, size: int):
+        """
+        Note where a batch sent on the current connection sits in the input, a new span after a gap.
+        """
+        if self.bytes_per_ms is None:
+            return
+        stream_starts, input_starts = self.spans.setdefault(self.generation, ([], []))
+        if offset != self.next_offset:
+            input_starts.append(offset / self.bytes_per_ms)
+            stream_starts.append(self.stream_bytes / self.bytes_per_ms)
+        self.stream_bytes += size
+        self.next_offset = offset + size
+
+    @staticmethod
+    def __stream_to_input_ms(spans: tuple[list, list], stream_ms: float, bisect) -> float:
+        stream_starts, input_starts = spans
+        index = max(0, bisect(stream_starts, stream_ms) - 1)
+        return input_starts[index] + stream_ms - stream_starts[index]
+
+    async def __sender(self):
+        while True:
+            data, enqueued_at, offset = await self.queue.get()
+            try:
+                # wait as long as the connection takes to open (the provider scheduler may delay it), never drop
+                connection = None
+                while connection is None:
+                    await self.connection_ready.wait()
+                    connection = self.get_connection()
+                    if connection is None:
+                        await asyncio.sleep(0.01)
+                self.__record_span(offset, len(data))
+                await asyncio.to_thread(connection.send, data)
+                self.batches_sent += 1
+                self.bytes_sent += len(data)
+                self.last_lag_ms = (time.monotonic() - enqueued_at) * 1000
+                self.max_lag_ms = max(self.max_lag_ms, self.last_lag_ms)
+                if self.last_lag_ms > self.LAG_WARNING_MS:
+                    print("Uplink lag to Deepgram:", self.sid, round(self.last_lag_ms), "ms")
+            except Exception as e:
+                print(f"Failed to send audio to Deepgram: {self.sid} {e}")
+            finally:
+                self.queue.task_done()
+                if self.paused and not self.overrun and self.queue.qsize() <= self.MAX_QUEUED_BATCHES // 2:
+                    self.__set_paused(False)
@@ -0,0 +1,166 @@
+# Copyright (c) 2024.
+# -*-coding:utf-8 -*-
+"""
+@file: UpstreamPools.py
+@author: Jerry(Ruihuang)Yang
+@email: rxy216@case.edu
+@time: 10/19/26 23:10
+"""
+from contextlib import contextmanager
+import asyncio
+import os
+import threading
+import time
+
+
+class UpstreamPools:
+    """
+    UpstreamPools: shared keep-alive connection pools (httpx) for the HTTP upstreams called during a session.
+    - deepgram_speak: one request per TTS chunk.
+    - backend: thread validation at connect.
+    - processing_node: recordings and feedback at the end of a step or session.
+    The pools are opened by the startup hook and kept warm with a HEAD request every UPSTREAM_WARM_INTERVAL_S, so a
+    TTS chunk does not pay for a TCP and TLS handshake. HTTPS upstreams negotiate HTTP/2 (one multiplexed connection),
+    the processing node is plain HTTP and keeps HTTP/1.1 keep-alive connections.
+    The clients are thread safe, TtsStream calls them from its worker threads.
+    """
+    instance = None
+    instance_lock = threading.Lock()
+    UPSTREAMS = {
+        "deepgram_speak": "https://api.deepgram.com",
+        "backend": "https://api.prepit-ai.com",
+        "processing_node": "http://code-runner-node-0.courseyai.com:6050",
+    }
+    TIMEOUTS = {"deepgram_speak": 30.0, "backend": 10.0, "processing_node": 60.0}
+
+    def __init__(self):
+        self.POOL_SIZE = int(os.getenv("UPSTREAM_POOL_SIZE", "20"))
+        self.KEEPALIVE_S = float(os.getenv("UPSTREAM_KEEPALIVE_S", "90"))
+        self.WARM_INTERVAL_S = float(os.getenv("UPSTREAM_WARM_INTERVAL_S", "30"))  # 0 turns the warm pings off
+        self.HTTP2 = os.getenv("UPSTREAM_HTTP2", "1") == "1"
+        self.lock = threading.Lock()
+        self.clients = {}
+        self.metrics = {name: {"requests": 0, "new_connections": 0, "errors": 0, "warm_pings": 0,
+                               "http_versions": {}, "last_used": None} for name in self.UPSTREAMS}
+
+    @classmethod
+    def get_instance(cls) -> "UpstreamPools":
+        with cls.instance_lock:
+            if cls.instance is None:
+                cls.instance = UpstreamPools()
+        return cls.instance
+
+    def client(self, name: str):
+        """
+        The pooled client of an upstream, built on first use.
+        """
+        client = self.clients.get(name)
+        if client is not None:
+            return client
+        with self.lock:
+            if name not in self.clients:
+                self.clients[name] = self.__build_client(name)
+            return self.clients[name]
+
+    def install(self, name: str, client):
+        """
+        Use a client built elsewhere, for the replay stand-ins.
+        """
+        with self.lock:
+            self.clients[name] = client
+
+    def request(self, name: str, method: str, url: str, **kwargs):
+        """
+        Send a request through the pool of an upstream, blocking.
+        :param name: deepgram_speak, backend or processing_node.
+        :return: The httpx response, read.
+        """
+        try:
+            response = self.client(name).request(method, url, extensions={"trace": self.__tracer(name)}, **kwargs)
+        except Exception:
+            self.__count(name, "errors")
+            raise
+        self.__count_response(name, response)
+        return response
+
+    @contextmanager
+    def stream(self, name: str, method: str, url: str, **kwargs):
+        """
+        Stream a response through the pool of an upstream, blocking. The connection goes back to the pool on exit.
+        """
+        try:
+            context = self.client(name).stream(method, url, extensions={"trace": self.__tracer(name)}, **kwargs)
+            response = context.__enter__()
+        except Exception:
+            self.__count(name, "errors")
+            raise
+        self.__count_response(name, response)
+        try:
+            yield response
+        finally:
+            context.__exit__(None, None, None)
+
+    def warm(self):
+        """
+        Open or refresh a connection to every upstream, blocking. A HEAD to the origin is enough, any status keeps the
+        connection alive.
+        """
+        for name, origin in self.UPSTREAMS.items():
+            try:
+                self.client(name).head(origin + "/", extensions={"trace": self.__tracer(name)}, timeout=5.0)
+                self.__count(name, "warm_pings")
+            except Exception as e:
+                self.__count(name, "errors")
+                print(f"Failed to warm the {name} connection: {e}")
+
+    async def keep_warm(self):
+        """
+        Open the pools and keep them warm, runs for the life of the process.
+        """
+        await asyncio.to_thread(self.warm)
+        while self.WARM_INTERVAL_S > 0:
+            await asyncio.sleep(self.WARM_INTERVAL_S)
+            await asyncio.to_thread(self.warm)
+
+    def stats(self) -> dict:
+        with self.lock:
+            report = {"pool_size": self.POOL_SIZE, "http2": self.HTTP2}
+            for name, metrics in self.metrics.items():
+                requests = metrics["requests"] + metrics["warm_pings"]
+                reused = max(0, requests - metrics["new_connections"])
+                report[name] = {**metrics, "http_versions": dict(metrics["http_versions"]),
+                                "reused_connections": reused,
+                                "reuse_rate": round(reused / requests, 3) if requests else 0.0}
+            return report
+
+    def __build_client(self, name: str):
+        import httpx
+        http2 = self.HTTP2 and self.UPSTREAMS[name].startswith("https://")
+        if http2:
+            try:
+                import h2  # noqa: F401, httpx needs it for HTTP/2
+            except ImportError:
+                print("h2 is not installed, the upstream pools use HTTP/1.1")
+                http2 = False
+        return httpx.Client(http2=http2, timeout=self.TIMEOUTS[name],
+                            limits=httpx.Limits(max_connections=self.POOL_SIZE,
+                                                max_keepalive_connections=self.POOL_SIZE,
+                                                keepalive_expiry=self.KEEPALIVE_S))
+
+    def __tracer(self, name: str):
+        def trace(event_name: str, info: dict):
+            if event_name == "connection.connect_tcp.complete":
+                self.__count(name, "new_connections")
+        return trace
+
+    def __count(self, name: str, metric: str):
+        with self.lock:
+            self.metrics[name][metric] += 1
+
+    def __count_response(self, name: str, response):
+        with self.lock:
+            metrics = self.metrics[name]
+            metrics["requests"] += 1
+            metrics["last_used"] = time.time()
+            version = getattr(response, "http_version", "unknown")
+            metrics["http_versions"][version] = metrics["http_versions"].get(version, 0) + 1
@@ -0,0 +1,145 @@
+# Copyright (c) 2024.
+# -*-coding:utf-8 -*-
+"""
+@file: VoiceActivityGate.py
+@author: Jerry(Ruihuang)Yang
+@email: rxy216@case.edu
+@time: 10/19/26 15:10
+"""
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import deque
+import math
+import os
+import warnings
+
+with warnings.catch_warnings():
+    warnings.simplefilter("ignore", DeprecationWarning)
+    try:
+        import audioop  # C implementation of rms, removed in Python 3.13
+    except ImportError:
+        audioop = None
+
+
+class VoiceActivityGate:
+    """
+    VoiceActivityGate: energy based voice-activity gate for linear16 PCM uplinks.
+    Frames go to STT while the candidate speaks and for HANGOVER_MS after, so Deepgram still gets the silence it
+    needs for endpointing. Longer silences are held back, and the STT idle scheduler sends KeepAlive meanwhile.
+    On speech onset the last PREROLL_MS of audio is released too, so the first syllable is not cut.
+    Speech intervals are measured in audio time (ms from the first frame), which matches the recording. STT only
+    hears the forwarded audio, so its result times are in gated time and are mapped back with to_recording_time.
+    """
+    SUPPORTED_SAMPLE_RATES = (8000, 16000, 24000, 32000, 44100, 48000)
+
+    def __init__(self, sample_rate: int = 16000):
+        self.THRESHOLD_RMS = int(os.getenv("VAD_THRESHOLD_RMS", "500"))
+        self.HANGOVER_MS = int(os.getenv("VAD_HANGOVER_MS", "1500"))
+        self.PREROLL_MS = int(os.getenv("VAD_PREROLL_MS", "300"))
+        self.sample_rate = sample_rate
+        self.position_ms = 0.0
+        self.in_speech = False
+        self.speech_started_ms = 0.0
+        self.silence_ms = 0.0
+        self.preroll = deque()
+        self.preroll_ms = 0.0
+        self.speech_intervals = []
+        self.bytes_in = 0
+        self.bytes_forwarded = 0
+        self.forwarded_ms = 0.0
+        self.span_forwarded_starts = []  # contiguous forwarded runs: gated start, with their recording start
+        self.span_recording_starts = []
+
+    def process(self, frame: bytes) -> list[bytes]:
+        """
+        Run one client frame through the gate.
+        :param frame: Raw little-endian 16-bit mono PCM.
+        :return: The frames to send to STT now, possibly empty.
+        """
+        frame_ms = len(frame) / 2 / self.sample_rate * 1000
+        self.bytes_in += len(frame)
+        voiced = self.__rms(frame) >= self.THRESHOLD_RMS
+        forward = []
+        if voiced:
+            if not self.in_speech:
+                self.in_speech = True
+                self.speech_started_ms = self.position_ms - self.preroll_ms
+                self.span_recording_starts.append(self.speech_started_ms)
+                self.span_forwarded_starts.append(self.forwarded_ms)
+                forward.extend(self.preroll)
+                self.preroll.clear()
+                self.preroll_ms = 0.0
+            self.silence_ms = 0.0
+            forward.append(frame)
+        elif self.in_speech:
+            forward.append(frame)
+            self.silence_ms += frame_ms
+            if self.silence_ms >= self.HANGOVER_MS:
+                self.in_speech = False
+                self.__close_interval(self.position_ms + frame_ms - self.silence_ms)
+        else:
+            self.preroll.append(frame)
+            self.preroll_ms += frame_ms
+            while self.preroll and self.preroll_ms - len(self.preroll[0]) / 2 / self.sample_rate * 1000 \
+                    >= self.PREROLL_MS:
+                dropped = self.preroll.popleft()
+                self.preroll_ms -= len(dropped) / 2 / self.sample_rate * 1000
+        self.position_ms += frame_ms
+        forwarded_bytes = sum(len(f) for f in forward)
+        self.bytes_forwarded += forwarded_bytes
+        self.forwarded_ms += forwarded_bytes / 2 / self.sample_rate * 1000
+        return forward
+
+    def to_recording_time(self, start_s: float, duration_s: float) -> tuple[float, float]:
+        """
+        Map the time of an STT result from gated time to recording time.
+        :param start_s: The start of the result in seconds of forwarded audio, see UplinkAudioStage.to_input_time.
+        :param duration_s: The duration of the result in seconds.
+        :return: The start and the duration in seconds from the first frame of the recording.
+        """
+        start_ms = self.__gated_to_recording_ms(start_s * 1000, bisect_right)
+        # an end on a span boundary belongs to the span it closes, not to the next one
+        end_ms = self.__gated_to_recording_ms((start_s + duration_s) * 1000, bisect_left)
+        return round(start_ms / 1000, 3), round(max(0.0, end_ms - start_ms) / 1000, 3)
+
+    def timing_data(self) -> dict:
+        """
+        Speech and pause intervals for the recording metadata, [start_ms, end_ms] in audio time.
+        """
+        intervals = list(self.speech_intervals)
+        if self.in_speech:
+            intervals.append([round(self.speech_started_ms), round(self.position_ms - self.silence_ms)])
+        pauses = []
+        previous_end = 0
+        for start, end in intervals:
+            if start > previous_end:
+                pauses.append([previous_end, start])
+            previous_end = end
+        if self.position_ms > previous_end:
+            pauses.append([previous_end, round(self.position_ms)])
+        return {"vad_speech_intervals": intervals, "vad_pause_intervals": pauses,
+                "vad_audio_ms": round(self.position_ms)}
+
+    def stats(self) -> dict:
+        return {"bytes_in": self.bytes_in, "bytes_forwarded": self.bytes_forwarded,
+                "in_speech": self.in_speech}
+
+    def __gated_to_recording_ms(self, gated_ms: float, bisect) -> float:
+        index = bisect(self.span_forwarded_starts, gated_ms) - 1
+        if index < 0:
+            return gated_ms
+        return self.span_recording_starts[index] + gated_ms - self.span_forwarded_starts[index]
+
+    def __close_interval(self, end_ms: float):
+        self.speech_intervals.append([round(max(0.0, self.speech_started_ms)), round(end_ms)])
+
+    @staticmethod
+    def __rms(frame: bytes) -> float:
+        if len(frame) % 2:
+            frame = frame[:-1]
+        if not frame:
+            return 0.0
+        if audioop is not None:
+            return audioop.rms(frame, 2)
+        samples = array("h", frame)
+        return math.sqrt(sum(sample * sample for sample in samples) / len(samples))
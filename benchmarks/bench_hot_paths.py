@@ -0,0 +1,368 @@
+# Copyright (c) 2024.
+# -*-coding:utf-8 -*-
+"""
+@file: bench_hot_paths.py
+@author: Jerry(Ruihuang)Yang
+@email: rxy216@case.edu
+@time: 10/19/26 10:02
+Microbenchmarks for the CPU-bound code that runs per token, per frame or per turn.
+Run from the repository root:
+    python benchmarks/bench_hot_paths.py                       # run and save results
+    python benchmarks/bench_hot_paths.py --compare <old.json>  # also diff against an earlier run
+Results are written as json to benchmarks/results/, the --compare run exits with 1 when any case got slower
+than the threshold, so it can gate a deploy.
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_FOLDER = os.path.join(REPO_ROOT, "benchmarks", "results")
+sys.path.insert(0, REPO_ROOT)
+
+from ChatStream import ChatStream, ChatStreamModel  # noqa: E402
+from PromptManager import PromptManager  # noqa: E402
+
+SAMPLE_REPLY = ("Okay. Let's talk about the market first. How big do you think the US grocery delivery market is, "
+                "and what are the main drivers? Take a minute to structure your thoughts. You can use the link "
+                "{https://example.com/market-chart} if you need it. Good! What would be your next step? ") * 3
+
+
+class _NullTts:
+    """Stand-in for TtsStream, the benchmark measures the chunking, not the Deepgram call."""
+
+    def stream_tts(self, text: str, chunk_id: str):
+        return None
+
+
+class _NullMessageStorage:
+    def put_message(self, *args, **kwargs):
+        return None
+
+
+class _StaticAgentPrompt:
+    PROMPT = json.dumps({"instruction": PromptManager.STEPS[1]["instruction"],
+                         "information": PromptManager.STEPS[1]["information"]})
+
+    def get_agent_prompt(self, agent_id: str, step: str):
+        return self.PROMPT
+
+
+class _NullSttConnection:
+    def send(self, data):
+        return None
+
+    def finish(self):
+        return None
+
+
+def tokenize_reply(text: str) -> list[str]:
+    """
+    Split a reply into provider-sized tokens (a word with its leading space, punctuation kept attached).
+    """
+    words = text.split(" ")
+    return [words[0]] + [" " + word for word in words[1:]]
+
+
+def build_chat_stream() -> ChatStream:
+    chat_stream = ChatStream.__new__(ChatStream)
+    chat_stream.tts_session_id = "benchmark"
+    chat_stream.tts = _NullTts()
+    chat_stream.trace = None
+    chat_stream.agent_prompt_handler = _StaticAgentPrompt()
+    chat_stream.message_storage_handler = _NullMessageStorage()
+    chat_stream.user_message_timestamp = "0"
+    chat_stream.thread_id = "benchmark"
+    chat_stream.user_id = "0"
+    chat_stream.user_message_content = ""
+    chat_stream.step_id = 1
+    return chat_stream
+
+
+def build_messages(count: int) -> dict[int, dict[str, str | int]]:
+    messages = {}
+    for i in range(count):
+        role = "user" if i % 2 == 0 else "assistant"
+        messages[i] = {"role": role, "content": SAMPLE_REPLY[:80 + (i % 7) * 40], "step": i // 20}
+    return messages
+
+
+def case_chat_generator_chunking():
+    tokens = tokenize_reply(SAMPLE_REPLY)
+    chat_stream = build_chat_stream()
+
+    async def token_stream(messages):
+        for token in tokens:
+            yield token
+
+    chat_stream._ChatStream__openai_chat_generator = token_stream
+
+    async def consume():
+        async for _ in chat_stream._ChatStream__chat_generator([], "openai"):
+            pass
+
+    loop = asyncio.new_event_loop()
+    devnull = io.StringIO()
+
+    def run():
+        # the generator prints the provider it uses, keep it out of the results
+        with contextlib.redirect_stdout(devnull):
+            loop.run_until_complete(consume())
+        devnull.seek(0)
+        devnull.truncate()
+
+    return run, len(tokens), loop.close
+
+
+def case_messages_processor(count: int):
+    chat_stream = build_chat_stream()
+    messages = build_messages(count)
+    devnull = io.StringIO()
+
+    def run():
+        with contextlib.redirect_stdout(devnull):
+            chat_stream._ChatStream__messages_processor(messages, "agent", 1)
+        devnull.seek(0)
+        devnull.truncate()
+
+    return run, 1, None
+
+
+def case_chat_stream_model_validation(count: int):
+    raw_messages = {str(k): v for k, v in build_messages(count).items()}
+
+    def run():
+        ChatStreamModel(dynamic_auth_code="0", messages=raw_messages, current_step=1, agent_id="agent",
+                        provider="openai", thread_id="benchmark")
+
+    return run, 1, None
+
+
+def case_tts_bracket_strip():
+    """
+    The markup strip TtsStream runs on every chunk, on its own.
+    """
+    from TtsStream import TtsStream
+    text = SAMPLE_REPLY[:200] + " [next]"
+    return (lambda: TtsStream.MARKUP_PATTERN.sub("", text)), 1, None
+
+
+def case_tts_stream_handoff():
+    """
+    TtsStream.stream_tts of a chunk up to the Deepgram call (markup strip, executor hand-off, phrase cache lookup,
+    waiting for the worker), the call stubbed.
+    """
+    from TtsStream import TtsStream
+    tts = TtsStream("benchmark")
+    tts._TtsStream__synthesize = lambda text, priority: None
+    text = SAMPLE_REPLY[:200] + " [next]"
+
+    def run():
+        tts.stream_tts(text, "1")
+        synthesis = TtsStream.get_in_progress("benchmark", "1")
+        if synthesis:
+            synthesis["done"].wait()
+
+    return run, 1, None
+
+
+def case_downlink_frame_encode(serializer: str):
+    """
+    Encoding of a downlink_chat_response event, the most frequent frame, in each SIO_SERIALIZER mode.
+    """
+    from SioSerializer import OrjsonModule
+    message = {"response": SAMPLE_REPLY, "tts_session_id": "2f1c0d3e-3b7a-4c1e-9a56-0d1f8e2b7c44",
+               "have_new_chunk": False, "new_chunk_id": 1, "first_yield": False, "last_yield": False}
+    packet = ["downlink_chat_response", message]
+    if serializer == "msgpack":
+        import msgpack
+        encode = msgpack.packb
+    else:
+        json_module = OrjsonModule if serializer == "orjson" else json
+
+        def encode(data):
+            return json_module.dumps(data, separators=(",", ":"))
+
+    def run():
+        encode(packet)
+
+    return run, 1, None
+
+
+def case_uplink_stt_audio(frame_size: int, frames: int = 200):
+    import main
+    sid = "benchmark"
+    frame = b"\x00" * frame_size
+    devnull = io.StringIO()
+    loop = asyncio.new_event_loop()
+
+    async def open_stage():
+        return main.UplinkAudioStage(sid, lambda: main.user_sessions.get(sid))
+
+    def reset():
+        if sid in main.uplink_stages:
+            main.uplink_stages[sid].sender_task.cancel()
+        main.uplink_stages[sid] = loop.run_until_complete(open_stage())
+        main.uplink_stages[sid].set_connection_open(True)
+        main.user_sessions[sid] = _NullSttConnection()
+        main.audio_buffers[sid] = io.BytesIO()
+        main.last_audio_data_received_timestamp.pop(sid, None)
+        main.recording_processing_data_packets[sid] = {"audio_started": False, "audio_timestamps": [],
+                                                       "audio_pause_timestamps": [], "user_msg_timestamps": {}}
+
+    async def send_frames():
+        for _ in range(frames):
+            await main.uplink_stt_audio(sid, frame)
+
+    def run():
+        reset()
+        with contextlib.redirect_stdout(devnull):
+            loop.run_until_complete(send_frames())
+        devnull.seek(0)
+        devnull.truncate()
+
+    def cleanup():
+        main.uplink_stages.pop(sid).sender_task.cancel()
+        for state in (main.user_sessions, main.audio_buffers, main.recording_processing_data_packets,
+                      main.last_audio_data_received_timestamp):
+            state.pop(sid, None)
+        loop.close()
+
+    return run, frames, cleanup
+
+
+def build_cases() -> dict:
+    cases = {
+        "chat_generator_chunking_per_token": case_chat_generator_chunking,
+        "tts_bracket_strip": case_tts_bracket_strip,
+        "tts_stream_handoff": case_tts_stream_handoff,
+        "downlink_frame_encode_json": lambda: case_downlink_frame_encode("json"),
+        "downlink_frame_encode_orjson": lambda: case_downlink_frame_encode("orjson"),
+        "downlink_frame_encode_msgpack": lambda: case_downlink_frame_encode("msgpack"),
+        "uplink_stt_audio_per_frame_1600b": lambda: case_uplink_stt_audio(1600),
+        "uplink_stt_audio_per_frame_8192b": lambda: case_uplink_stt_audio(8192),
+    }
+    for count in (10, 50, 200):
+        cases[f"messages_processor_{count}_msgs"] = lambda count=count: case_messages_processor(count)
+        cases[f"chat_stream_model_validation_{count}_msgs"] = \
+            lambda count=count: case_chat_stream_model_validation(count)
+    return cases
+
+
+def measure(run, ops_per_call: int, repeat: int, min_time: float) -> dict:
+    """
+    Time a case. Each sample calls run() enough times to last at least min_time seconds.
+    :return: per-operation timings in microseconds.
+    """
+    run()  # warm up
+    calls = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(calls):
+            run()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            break
+        calls *= 2
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(calls):
+            run()
+        samples.append((time.perf_counter() - start) / (calls * ops_per_call) * 1e6)
+    samples.sort()
+    return {
+        "median_us": statistics.median(samples),
+        "min_us": samples[0],
+        "p95_us": samples[min(len(samples) - 1, int(round(len(samples) * 0.95)) - 1)],
+        "stdev_us": statistics.stdev(samples) if len(samples) > 1 else 0.0,
+        "ops_per_sample": calls * ops_per_call,
+        "samples": repeat,
+    }
+
+
+def get_git_commit() -> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+
+def compare(current: dict, baseline: dict, threshold: float) -> bool:
+    """
+    Print the median delta of every case against a baseline run.
+    :return: True if any case regressed by more than threshold (a fraction, 0.1 = 10%).
+    """
+    regressed = False
+    print(f"{'case':<45}{'baseline us':>14}{'current us':>14}{'delta':>10}")
+    for name, result in current["results"].items():
+        old = baseline["results"].get(name)
+        if old is None:
+            print(f"{name:<45}{'-':>14}{result['median_us']:>14.3f}{'new':>10}")
+            continue
+        delta = result["median_us"] / old["median_us"] - 1
+        flag = ""
+        if delta > threshold:
+            regressed = True
+            flag = "  <-- regression"
+        print(f"{name:<45}{old['median_us']:>14.3f}{result['median_us']:>14.3f}{delta:>+10.1%}{flag}")
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Microbenchmarks for the ChatStream hot paths.")
+    parser.add_argument("--filter", default="", help="only run cases whose name contains this string")
+    parser.add_argument("--repeat", type=int, default=15, help="samples per case")
+    parser.add_argument("--min-time", type=float, default=0.05, help="minimum seconds per sample")
+    parser.add_argument("--output", default=None, help="result file, defaults to benchmarks/results/<time>.json")
+    parser.add_argument("--compare", default=None, help="earlier result file to compare against")
+    parser.add_argument("--threshold", type=float, default=0.10, help="allowed slowdown before failing")
+    args = parser.parse_args()
+
+    results = {}
+    for name, build in build_cases().items():
+        if args.filter not in name:
+            continue
+        run, ops_per_call, cleanup = build()
+        try:
+            results[name] = measure(run, ops_per_call, args.repeat, args.min_time)
+        finally:
+            if cleanup:
+                cleanup()
+        print(f"{name:<45}{results[name]['median_us']:>12.3f} us/op")
+
+    report = {
+        "meta": {
+            "git_commit": get_git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "timestamp": int(time.time()),
+        },
+        "results": results,
+    }
+    output = args.output
+    if output is None:
+        os.makedirs(RESULTS_FOLDER, exist_ok=True)
+        output = os.path.join(RESULTS_FOLDER, f"{time.strftime('%Y%m%d_%H%M%S')}.json")
+    with open(output, "w") as result_file:
+        json.dump(report, result_file, indent=2)
+    print("results saved to", output)
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+        if compare(report, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
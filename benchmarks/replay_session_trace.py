@@ -0,0 +1,422 @@
+# Copyright (c) 2024.
+# -*-coding:utf-8 -*-
+"""
+@file: replay_session_trace.py
+@author: Jerry(Ruihuang)Yang
+@email: rxy216@case.edu
+@time: 10/19/26 17:30
+Replays session traces captured with SESSION_TRACE_DIR against main:app, served in-process by uvicorn.
+Deepgram STT/Speak, OpenAI/Anthropic, the thread validation, DynamoDB and Redis are replaced by local stand-ins
+that answer with the upstream responses and timing recorded in the trace, so a run only measures this service.
+Run from the repository root:
+    python benchmarks/replay_session_trace.py <trace.jsonl.gz> [...] --speed 4 --copies 10
+    python benchmarks/replay_session_trace.py <traces> --compare <old.json>   # diff against an earlier run
+--speed 1 replays at real speed, 4 four times faster, 0 as fast as possible.
+"""
+import argparse
+import asyncio
+import base64
+import contextvars
+import gzip
+import json
+import os
+import statistics
+import sys
+import threading
+import time
+import uuid
+from types import SimpleNamespace
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_FOLDER = os.path.join(REPO_ROOT, "benchmarks", "results")
+sys.path.insert(0, REPO_ROOT)
+
+for env_key in ("DEEPGRAM_API_KEY", "OPENAI_API_KEY", "ANTHROPIC_API_KEY"):
+    os.environ.setdefault(env_key, "replay")
+os.environ["STT_PREWARM_BUDGET"] = "0"  # STT must open after the replay client has registered its sid
+os.environ.pop("SESSION_TRACE_DIR", None)  # never record a replay
+os.environ.setdefault("RESUME_GRACE_S", "0")  # sessions close at disconnect, so every replay submits its recording
+
+replay_sid = contextvars.ContextVar("replay_sid", default=None)
+
+
+def load_trace(trace_path: str) -> list[dict]:
+    with gzip.open(trace_path, "rt") as trace_file:
+        return [json.loads(line) for line in trace_file if line.strip()]
+
+
+def scaled_sleep(seconds: float, speed: float):
+    if speed > 0 and seconds > 0:
+        time.sleep(seconds / speed)
+
+
+class ReplayUpstream:
+    """
+    The upstream responses of all loaded traces, looked up by the stand-ins.
+    """
+
+    def __init__(self, traces: list[list[dict]], speed: float):
+        self.speed = speed
+        self.stt_by_sid = {}  # sid of a running replay -> stt records of its trace
+        self.llm_turns = {}  # last user message -> [(delay_s, token)]
+        self.tts_by_chars = {}  # chars -> (bytes, latency_ms)
+        tts_bytes_per_char = []
+        tts_latencies = []
+        for records in traces:
+            last_user_message = None
+            turn_tokens = {}
+            for record in records:
+                if record["type"] == "chat":
+                    messages = record["message"].get("messages") or {}
+                    if messages:
+                        last_key = max(messages.keys(), key=int)
+                        last_user_message = messages[last_key]["content"]
+                elif record["type"] == "llm_start":
+                    turn_tokens[record["turn"]] = {"user": last_user_message, "started": record["t"], "tokens": []}
+                elif record["type"] == "llm_token" and record["turn"] in turn_tokens:
+                    turn = turn_tokens[record["turn"]]
+                    previous = turn["tokens"][-1][2] if turn["tokens"] else turn["started"]
+                    turn["tokens"].append(((record["t"] - previous) / 1000, record["text"], record["t"]))
+                elif record["type"] == "tts" and not record.get("cached"):
+                    self.tts_by_chars[record["chars"]] = (record["bytes"], record["latency_ms"])
+                    if record["chars"]:
+                        tts_bytes_per_char.append(record["bytes"] / record["chars"])
+                    tts_latencies.append(record["latency_ms"])
+            for turn in turn_tokens.values():
+                self.llm_turns[turn["user"]] = [(delay, token) for delay, token, _ in turn["tokens"]]
+        self.tts_bytes_per_char = statistics.median(tts_bytes_per_char) if tts_bytes_per_char else 600.0
+        self.tts_latency_ms = statistics.median(tts_latencies) if tts_latencies else 300.0
+
+    def llm_tokens(self, messages: list[dict]) -> list[tuple[float, str]]:
+        user_messages = [message["content"] for message in messages if message["role"] == "user"]
+        if user_messages and user_messages[-1] in self.llm_turns:
+            return self.llm_turns[user_messages[-1]]
+        return [(0.03, word + " ") for word in "Okay. Let's move on to the next question.".split()]
+
+    def tts_audio(self, text: str) -> tuple[bytes, float]:
+        size, latency_ms = self.tts_by_chars.get(len(text), (int(len(text) * self.tts_bytes_per_char),
+                                                             self.tts_latency_ms))
+        return b"\x00" * size, latency_ms / 1000
+
+
+class FakeResponse:
+    def __init__(self, status_code: int = 200, json_data=None, content: bytes = b"", delay_s: float = 0.0,
+                 speed: float = 1.0):
+        self.status_code = status_code
+        self.json_data = json_data
+        self.content = content
+        self.text = json.dumps(json_data) if json_data is not None else ""
+        self.delay_s = delay_s
+        self.speed = speed
+        self.http_version = "replay"
+
+    def json(self):
+        return self.json_data
+
+    def read(self) -> bytes:
+        return self.content
+
+    def iter_bytes(self, chunk_size: int = 4096):
+        # first byte after half the recorded latency, the rest spread over the other half
+        scaled_sleep(self.delay_s / 2, self.speed)
+        parts = max(1, len(self.content) // chunk_size)
+        for i in range(0, len(self.content), chunk_size):
+            yield self.content[i:i + chunk_size]
+            scaled_sleep(self.delay_s / 2 / parts, self.speed)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+class FakeHttpClient:
+    """
+    Stand-in for the pooled httpx clients: thread validation, Deepgram Speak and the processing node.
+    """
+
+    def __init__(self, upstream: ReplayUpstream, agent_id: str):
+        self.upstream = upstream
+        self.agent_id = agent_id
+
+    def head(self, url: str, **kwargs):
+        return FakeResponse()
+
+    def stream(self, method: str, url: str, json=None, **kwargs):
+        return self.request(method, url, json=json, stream=True)
+
+    def request(self, method: str, url: str, json=None, stream: bool = False, **kwargs):
+        if "validate_id" in url:
+            return FakeResponse(json_data={"data": {"agent_id": self.agent_id, "user_id": "replay"}})
+        if "api.deepgram.com/v1/speak" in url:
+            audio, delay_s = self.upstream.tts_audio(json["text"])
+            if not stream:
+                scaled_sleep(delay_s, self.upstream.speed)
+            return FakeResponse(content=audio, delay_s=delay_s, speed=self.upstream.speed)
+        return FakeResponse(json_data={"status": "ok"})
+
+
+class FakeLiveConnection:
+    """
+    Stand-in for a Deepgram live connection, emits the STT results recorded for the session.
+    """
+
+    def __init__(self, upstream: ReplayUpstream, sid: str):
+        self.upstream = upstream
+        self.sid = sid
+        self.handlers = []
+        self.stopped = threading.Event()
+
+    def on(self, event, handler):
+        # only transcripts are recorded, UtteranceEnd is left to the speech_final of the recorded results
+        if getattr(event, "name", event) == "Transcript":
+            self.handlers.append(handler)
+
+    def start(self, options) -> bool:
+        threading.Thread(target=self.__emit_results, daemon=True).start()
+        return True
+
+    def send(self, data):
+        return None
+
+    def finish(self):
+        self.stopped.set()
+
+    def __emit_results(self):
+        records = self.upstream.stt_by_sid.get(self.sid, [])
+        started = time.monotonic()
+        for record in records:
+            wait_s = record["offset_s"] / self.upstream.speed if self.upstream.speed > 0 else 0
+            if self.stopped.wait(max(0.0, started + wait_s - time.monotonic())):
+                return
+            result = SimpleNamespace(
+                channel=SimpleNamespace(alternatives=[SimpleNamespace(transcript=record["text"])]),
+                is_final=record["is_final"], speech_final=record["speech_final"], start=record["start"],
+                duration=record["duration"])
+            for handler in self.handlers:
+                handler(self, result)
+
+
+class FakeDeepgramClient:
+    def __init__(self, upstream: ReplayUpstream):
+        self.listen = SimpleNamespace(live=SimpleNamespace(v=lambda version: FakeLiveConnection(upstream,
+                                                                                               replay_sid.get())))
+
+
+class FakeOpenAI:
+    def __init__(self, upstream: ReplayUpstream):
+        def create(messages, stream=True, **kwargs):
+            return FakeTokenStream(upstream, upstream.llm_tokens(messages), anthropic=False)
+
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=create))
+
+
+class FakeAnthropic:
+    def __init__(self, upstream: ReplayUpstream):
+        def stream(messages, **kwargs):
+            return FakeTokenStream(upstream, upstream.llm_tokens(messages), anthropic=True)
+
+        self.messages = SimpleNamespace(stream=stream)
+
+
+class FakeTokenStream:
+    def __init__(self, upstream: ReplayUpstream, tokens: list[tuple[float, str]], anthropic: bool):
+        self.upstream = upstream
+        self.tokens = tokens
+        self.text_stream = self.__texts() if anthropic else None
+
+    def __texts(self):
+        for delay_s, token in self.tokens:
+            scaled_sleep(delay_s, self.upstream.speed)
+            yield token
+
+    def __iter__(self):
+        for token in self.__texts():
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=token))])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+class FakeAgentPromptHandler:
+    def __init__(self, *args, **kwargs):
+        from PromptManager import PromptManager
+        self.steps = PromptManager.STEPS
+
+    def get_agent_prompt(self, agent_id: str, step: str):
+        step_info = self.steps.get(int(step), self.steps[0])
+        return json.dumps({"instruction": step_info["instruction"], "information": step_info["information"]})
+
+    def cache_agent_all_steps(self, agent_id: str) -> bool:
+        return True
+
+
+class FakeMessageStorageHandler:
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def put_message(self, *args, **kwargs):
+        return str(int(time.time() * 1000))
+
+
+def install_stand_ins(upstream: ReplayUpstream):
+    """
+    Swap the provider clients and storage of main and the handlers it uses for the local stand-ins.
+    """
+    import main
+    fake_http_client = FakeHttpClient(upstream, "replay-agent")
+    for name in main.upstream_pools.UPSTREAMS:
+        main.upstream_pools.install(name, fake_http_client)
+    # installed before the startup warm-up, which then has nothing left to build
+    main.provider_clients.install("deepgram", FakeDeepgramClient(upstream))
+    main.provider_clients.install("openai", FakeOpenAI(upstream))
+    main.provider_clients.install("anthropic", FakeAnthropic(upstream))
+    main.provider_clients.install("agent_prompt_handler", FakeAgentPromptHandler())
+    main.provider_clients.install("message_storage_handler", FakeMessageStorageHandler())
+
+    original_start_transcription = main.start_transcription
+
+    async def start_transcription(sid):
+        replay_sid.set(sid)  # lets the Deepgram stand-in find the trace of this session
+        await original_start_transcription(sid)
+
+    main.start_transcription = start_transcription
+    return main.app
+
+
+async def replay_session(records: list[dict], upstream: ReplayUpstream, url: str, socketio_path: str,
+                         speed: float) -> dict:
+    import socketio
+    import main
+    # the client speaks the packet format the app was started with (SIO_SERIALIZER)
+    wire_format = main.sio_serializer.wire_format
+    client = socketio.AsyncClient(reconnection=False, **({"serializer": "msgpack"} if wire_format == "msgpack" else {}))
+    metrics = {"turns": [], "downlink_events": 0, "stt_results": 0}
+    pending_turn = {}
+
+    @client.on("downlink_chat_response")
+    async def on_chat_response(data):
+        metrics["downlink_events"] += 1
+        now = time.monotonic()
+        if data.get("first_yield") and "sent" in pending_turn:
+            pending_turn["first_response_ms"] = (now - pending_turn["sent"]) * 1000
+        if data.get("have_new_chunk") and "first_chunk_ms" not in pending_turn and "sent" in pending_turn:
+            pending_turn["first_chunk_ms"] = (now - pending_turn["sent"]) * 1000
+        if data.get("last_yield") and "sent" in pending_turn:
+            pending_turn["last_response_ms"] = (now - pending_turn["sent"]) * 1000
+            metrics["turns"].append(dict(pending_turn))
+            pending_turn.clear()
+
+    @client.on("downlink_stt_result")
+    async def on_stt_result(data):
+        metrics["stt_results"] += 1
+
+    connect_record = next(record for record in records if record["type"] == "connect")
+    auth = dict(connect_record.get("auth") or {})
+    auth["token"] = str(uuid.uuid4())
+    await client.connect(url, auth=auth, socketio_path=socketio_path, transports=["websocket"])
+    sid = client.get_sid()
+
+    first_audio_t = next((record["t"] for record in records if record["type"] == "audio"), 0)
+    upstream.stt_by_sid[sid] = [{**record, "offset_s": (record["t"] - first_audio_t) / 1000}
+                                for record in records if record["type"] == "stt"]
+
+    started = time.monotonic()
+    for record in records:
+        if speed > 0:
+            wait_s = started + record["t"] / 1000 / speed - time.monotonic()
+            if wait_s > 0:
+                await asyncio.sleep(wait_s)
+        if record["type"] == "audio":
+            audio = base64.b64decode(record["data"]) if "data" in record else b"\x00" * record["size"]
+            await client.emit("uplink_stt_audio", audio)
+        elif record["type"] == "chat":
+            pending_turn.clear()
+            pending_turn["sent"] = time.monotonic()
+            await client.emit("uplink_chat_message", record["message"])
+    await asyncio.sleep(1)
+    await client.disconnect()
+    upstream.stt_by_sid.pop(sid, None)
+    return metrics
+
+
+def summarize(all_metrics: list[dict], wall_s: float) -> dict:
+    turns = [turn for metrics in all_metrics for turn in metrics["turns"]]
+
+    def stats(key: str) -> dict:
+        values = sorted(turn[key] for turn in turns if key in turn)
+        if not values:
+            return {}
+        return {"median_ms": round(statistics.median(values), 1),
+                "p95_ms": round(values[min(len(values) - 1, int(len(values) * 0.95))], 1),
+                "max_ms": round(values[-1], 1)}
+
+    return {
+        "sessions": len(all_metrics),
+        "turns": len(turns),
+        "wall_s": round(wall_s, 2),
+        "downlink_events": sum(metrics["downlink_events"] for metrics in all_metrics),
+        "stt_results": sum(metrics["stt_results"] for metrics in all_metrics),
+        "first_response": stats("first_response_ms"),
+        "first_chunk": stats("first_chunk_ms"),
+        "last_response": stats("last_response_ms"),
+    }
+
+
+async def run(args) -> dict:
+    import uvicorn
+    traces = [load_trace(trace_path) for trace_path in args.traces]
+    upstream = ReplayUpstream(traces, args.speed)
+    app = install_stand_ins(upstream)
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=args.port, log_level="warning"))
+    server_task = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.05)
+    url = f"http://127.0.0.1:{args.port}"
+    started = time.monotonic()
+    try:
+        all_metrics = await asyncio.gather(*[
+            replay_session(records, upstream, url, args.socketio_path, args.speed)
+            for records in traces for _ in range(args.copies)])
+    finally:
+        server.should_exit = True
+        await server_task
+    return summarize(list(all_metrics), time.monotonic() - started)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay captured session traces against main:app.")
+    parser.add_argument("traces", nargs="+", help="trace files (*.trace.jsonl.gz)")
+    parser.add_argument("--speed", type=float, default=1.0, help="1 real speed, 4 four times faster, 0 no waits")
+    parser.add_argument("--copies", type=int, default=1, help="concurrent replays of every trace")
+    parser.add_argument("--port", type=int, default=5099)
+    parser.add_argument("--socketio-path", default="v1/dev/live/socket.io")
+    parser.add_argument("--output", default=None, help="result file, defaults to benchmarks/results/replay_<time>.json")
+    parser.add_argument("--compare", default=None, help="earlier replay result to compare against")
+    args = parser.parse_args()
+
+    summary = asyncio.run(run(args))
+    print(json.dumps(summary, indent=2))
+    output = args.output
+    if output is None:
+        os.makedirs(RESULTS_FOLDER, exist_ok=True)
+        output = os.path.join(RESULTS_FOLDER, f"replay_{time.strftime('%Y%m%d_%H%M%S')}.json")
+    with open(output, "w") as result_file:
+        json.dump({"args": vars(args), "summary": summary}, result_file, indent=2)
+    print("results saved to", output)
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)["summary"]
+        for key in ("first_response", "first_chunk", "last_response"):
+            old, new = baseline.get(key, {}), summary.get(key, {})
+            if old.get("median_ms") and new.get("median_ms"):
+                print(f"{key:<16} median {old['median_ms']:>9.1f} -> {new['median_ms']:>9.1f} ms "
+                      f"({new['median_ms'] / old['median_ms'] - 1:+.1%})")
+
+
+if __name__ == "__main__":
+    main()
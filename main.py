@@ -1,44 +1,75 @@
-import hashlib
 import time
+
+MODULE_IMPORT_STARTED = time.perf_counter()  # for the startup report
+import hashlib
+import hmac
 import json
-from dotenv import load_dotenv, dotenv_values
-from fastapi import FastAPI, BackgroundTasks, HTTPException
-from fastapi.responses import FileResponse
+from dotenv import load_dotenv
+from fastapi import FastAPI, BackgroundTasks, HTTPException, Header
+from fastapi.responses import FileResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 import socketio
-from deepgram import DeepgramClient, LiveTranscriptionEvents, LiveOptions
-from openai import OpenAI
-from anthropic import Anthropic
 import os
 import re
 import asyncio
 from io import BytesIO
 from ChatStream import ChatStream, ChatStreamModel
 from TtsStream import TtsStream
-from AgentPromptHandler import AgentPromptHandler
-import requests
+from ProviderClients import ProviderClients
+from UplinkAudioStage import UplinkAudioStage
+from NodeLoadMonitor import NodeLoadMonitor
+from SessionTimeline import SessionTimeline
+from VoiceActivityGate import VoiceActivityGate
+from LoopDiagnostics import LoopDiagnostics
+from SessionTraceRecorder import SessionTrace, SessionTraceRecorder
+from ProviderScheduler import ProviderScheduler
+from StepOpeningCache import StepOpeningCache
+from SioSerializer import SioSerializer
+from SessionResume import SessionResume, DownlinkEmitter
+from DownlinkScheduler import DownlinkScheduler
+from MemoryDiagnostics import MemoryDiagnostics
+from ServerTurn import ServerTurn
+from SpeculativeReply import SpeculativeReply
+from UpstreamPools import UpstreamPools
 
 DEV_PREFIX = "/dev"
 PROD_PREFIX = "/prod"
 CURRENT_VERSION_PREFIX = "/v1"
 
-# try loading from .env file (only when running locally)
-try:
-    config = dotenv_values(".env")
-except FileNotFoundError:
-    config = {}
-# load secrets from /run/secrets/ (only when running in docker)
-load_dotenv(dotenv_path="/run/secrets/prepit-secret")
+# load secrets from /run/secrets/ (only when running in docker), then the .env file
+SECRETS_FILE = "/run/secrets/prepit-secret"
+if os.path.isfile(SECRETS_FILE):
+    load_dotenv(dotenv_path=SECRETS_FILE)
 load_dotenv()
-dg_client = DeepgramClient(api_key=os.getenv("DEEPGRAM_API_KEY"))
-openai_client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-anthropic_client = Anthropic(api_key=os.getenv("ANTHROPIC_API_KEY"))
-agent_prompt_handler = AgentPromptHandler()
-
+# Deepgram, OpenAI, Anthropic and the storage handlers are built by the startup warm-up, not at import
+provider_clients = ProviderClients.get_instance()
+upstream_pools = UpstreamPools.get_instance()  # warm connections to Deepgram Speak, the backend and the processing node
+startup_report = {}  # ms since main started importing: import_ms, startup_hook_ms, ready_ms
+node_load_monitor = NodeLoadMonitor()
+loop_diagnostics = LoopDiagnostics()
+session_trace_recorder = SessionTraceRecorder()
+memory_diagnostics = MemoryDiagnostics()
+
+sio_serializer = SioSerializer()
 sio_server = socketio.AsyncServer(
     async_mode='asgi',
     cors_allowed_origins=[],
+    **sio_serializer.server_options(),
 )
+session_resume = SessionResume()
+
+
+async def disconnect_slow_client(sid):
+    """
+    Disconnect the sockets of a session whose downlink queue hit its hard limit, the client is not reading.
+    :param sid: The sid the session state is kept under, its resumed sockets are disconnected too.
+    """
+    for socket_sid in [sid] + [socket_sid for socket_sid, session_sid in session_keys.items() if session_sid == sid]:
+        await sio_server.disconnect(socket_sid)
+
+
+downlink_scheduler = DownlinkScheduler(sio_server, disconnect_slow_client)  # bounded per-session downlink queues
+downlink = DownlinkEmitter(sio_server, session_resume, downlink_scheduler)  # buffered while a session is parked
 
 sio_app = socketio.ASGIApp(
     socketio_server=sio_server,
@@ -78,43 +109,230 @@ app.add_middleware(
 app.mount(f"{CURRENT_VERSION_PREFIX}{DEV_PREFIX}/live", app=sio_app)
 app.mount(f"{CURRENT_VERSION_PREFIX}{PROD_PREFIX}/live", app=sio_app)
 
-load_dotenv()
 runner_access_token = '123'
 # User sessions dictionary to store Deepgram connections
 user_sessions = {}
 transcription_tasks = {}
 audio_buffers = {}
+uplink_stages = {}  # Dictionary to store the per-session uplink audio stages in front of Deepgram
 chat_tasks = {}  # Dictionary to store active chat tasks
+chat_streams = {}  # Dictionary to store the ChatStream of the active chat tasks
+llm_stream_tasks = set()  # All in-flight chat tasks of this node, for admission control
+pending_connects = set()  # Sids admitted by connect that are still being validated, they count as sessions
+processing_submissions = set()  # Uploads to the processing node in flight, referenced until they are done
 user_ids = {}  # Dictionary to store user IDs
 thread_ids = {}  # Dictionary to store thread IDs
+tts_encodings = {}  # Dictionary to store the TTS output encoding negotiated with each client
+uplink_audio_formats = {}  # Dictionary to store the raw PCM format of clients that send linear16 audio
+vad_gates = {}  # Dictionary to store the voice-activity gates of PCM uplinks
+session_traces = {}  # Dictionary to store the session traces in capture mode (SESSION_TRACE_DIR)
 recording_processing_data_packets = {}  # Dictionary to store recording processing data packets
+session_timelines = {}  # Dictionary to store the STT timing data (audio_timestamps) of each recording
+server_turns = {}  # Dictionary to store the server-driven turn state of sessions in server turn mode
+speculations = {}  # Dictionary to store the speculative reply held for the utterance in progress
+session_keys = {}  # Dictionary to map the sid of a resumed socket to the sid its session state is kept under
+AUDIO_FILE_FOLDER = "volume_cache/interviewee_recordings"
 
 last_audio_data_received_timestamp = {}  # Dictionary to store the last audio data received timestamp
+stt_activity = {}  # Dictionary to store the last audio / keep alive time of each open Deepgram connection
+
+# Every per-sid dictionary, for the memory diagnostics to find entries that outlived their session
+SESSION_STATE = {
+    "user_sessions": user_sessions, "transcription_tasks": transcription_tasks, "audio_buffers": audio_buffers,
+    "uplink_stages": uplink_stages, "chat_tasks": chat_tasks, "chat_streams": chat_streams, "user_ids": user_ids,
+    "thread_ids": thread_ids, "tts_encodings": tts_encodings, "uplink_audio_formats": uplink_audio_formats,
+    "vad_gates": vad_gates, "session_traces": session_traces, "server_turns": server_turns,
+    "speculations": speculations, "downlink_queues": downlink_scheduler.queues,
+    "recording_processing_data_packets": recording_processing_data_packets, "session_timelines": session_timelines,
+    "last_audio_data_received_timestamp": last_audio_data_received_timestamp, "stt_activity": stt_activity,
+}
+
+STT_PREWARM_BUDGET = int(os.getenv("STT_PREWARM_BUDGET", "0"))  # open STT at connect while fewer are open than this
+STT_KEEPALIVE_INTERVAL_S = float(os.getenv("STT_KEEPALIVE_INTERVAL_S", "5"))
+STT_IDLE_TEARDOWN_S = float(os.getenv("STT_IDLE_TEARDOWN_S", "60"))
+STT_SCHEDULER_TICK_S = 1.0
+STT_VAD_GATE = os.getenv("STT_VAD_GATE", "0") == "1"  # gate silence in front of STT for linear16 uplinks
+SERVER_TURN_MODE = os.getenv("SERVER_TURN_MODE", "1") == "1"  # clients may ask for server-driven turns
+SPECULATIVE_LLM = os.getenv("SPECULATIVE_LLM", "0") == "1"  # start replies on stable interims in server turn mode
+SPECULATION_STABLE_MS = float(os.getenv("SPECULATION_STABLE_MS", "300"))  # how long an interim must not change
+SPECULATION_MIN_WORDS = int(os.getenv("SPECULATION_MIN_WORDS", "3"))
+
+
+def ensure_stt_connection(sid):
+    """
+    Open the Deepgram connection of a session if it is not open or being opened yet.
+    :param sid: The socket id of the session.
+    """
+    if sid in user_sessions:
+        return
+    if sid in transcription_tasks and not transcription_tasks[sid].done():
+        return
+    transcription_tasks[sid] = asyncio.create_task(start_transcription(sid))
+
+
+def count_stt_connections() -> int:
+    """
+    Count the Deepgram connections that are open or being opened.
+    """
+    opening = sum(1 for sid, task in transcription_tasks.items() if not task.done() and sid not in user_sessions)
+    return len(user_sessions) + opening
+
+
+async def close_stt_connection(sid):
+    """
+    Close the Deepgram connection of a session, it is opened again by the next audio frame.
+    :param sid: The socket id of the session.
+    """
+    if sid in uplink_stages:
+        uplink_stages[sid].set_connection_open(False)
+    stt_activity.pop(sid, None)
+    dg_connection = user_sessions.pop(sid, None)
+    if dg_connection:
+        await asyncio.to_thread(dg_connection.finish)
+
+
+async def stt_idle_scheduler():
+    """
+    One server-side loop for all sessions: sends KeepAlive to Deepgram during silence and closes connections that
+    have been idle for longer than STT_IDLE_TEARDOWN_S. Only raw PCM uplinks are torn down, webm/ogg streams carry
+    their header in the first frame only and a reopened connection could not decode them.
+    """
+    while True:
+        await asyncio.sleep(STT_SCHEDULER_TICK_S)
+        now = time.monotonic()
+        for sid in list(stt_activity.keys()):
+            activity = stt_activity.get(sid)
+            if activity is None or sid not in user_sessions:
+                continue
+            if now - activity["last_audio"] >= STT_IDLE_TEARDOWN_S and sid in uplink_audio_formats:
+                print("Closing idle STT connection:", sid)
+                await close_stt_connection(sid)
+            elif now - max(activity["last_audio"], activity["last_keep_alive"]) >= STT_KEEPALIVE_INTERVAL_S:
+                activity["last_keep_alive"] = now
+                try:
+                    await asyncio.to_thread(user_sessions[sid].send, '{ "type": "KeepAlive" }')
+                except Exception as e:
+                    print(f"Failed to send keep alive to Deepgram: {sid} {e}")
+
+
+@app.on_event("startup")
+async def start_background_tasks():
+    asyncio.create_task(stt_idle_scheduler())
+    asyncio.create_task(node_load_monitor.run_lag_sampler())
+    loop_diagnostics.start()
+    memory_diagnostics.start()
+    startup_report["startup_hook_ms"] = round((time.perf_counter() - MODULE_IMPORT_STARTED) * 1000, 1)
+    asyncio.create_task(warm_up_provider_clients())
+    asyncio.create_task(upstream_pools.keep_warm())
+
+
+@app.on_event("shutdown")
+async def flush_session_traces():
+    # the trace writer is a daemon thread, let it finish the queued records first
+    await asyncio.to_thread(session_trace_recorder.flush)
+
+
+async def warm_up_provider_clients():
+    await asyncio.to_thread(provider_clients.warm_up)
+    startup_report["ready_ms"] = round((time.perf_counter() - MODULE_IMPORT_STARTED) * 1000, 1)
+    print("Node ready, startup report:", startup_report)
 
 
 async def start_transcription(sid):
     # Create and configure the Deepgram connection
-    dg_connection = dg_client.listen.live.v("1")
+    from deepgram import LiveTranscriptionEvents, LiveOptions  # loaded by the warm-up already
+    dg_connection = provider_clients.get("deepgram").listen.live.v("1")
     options = LiveOptions(model="nova-3", language="en-US", interim_results=True, smart_format=True, endpointing='600',
                           utterance_end_ms='1000', filler_words=True)
+    if sid in uplink_audio_formats:
+        # raw PCM has no container header, Deepgram has to be told the format
+        options.encoding = "linear16"
+        options.sample_rate = uplink_audio_formats[sid]["sample_rate"]
+        options.channels = 1
+
+    loop = asyncio.get_running_loop()  # the SDK calls the handlers from its own thread
+    vad_gate = vad_gates.get(sid)
+    stream = {"generation": 0}  # set once the connection is open, results cannot arrive before
 
     # Define event handlers
     def on_message(self, result, **kwargs):
         if result:
             sentence = result.channel.alternatives[0].transcript
             if sentence:
-                # Run sio_server.emit in the event loop
+                start, duration = result.start, result.duration
+                stage = uplink_stages.get(sid)
+                if stage:
+                    # Deepgram times restart on every connection and skip dropped audio
+                    start, duration = stage.to_input_time(stream["generation"], start, duration)
+                if vad_gate:
+                    # Deepgram only heard the forwarded audio, move the times back onto the recording
+                    start, duration = vad_gate.to_recording_time(start, duration)
+                # Queue the result on the downlink of the session, in the event loop
                 parsed_result = {'text': sentence, 'is_final': result.is_final, 'speech_final': result.speech_final,
-                                 'start': result.start, 'duration': result.duration,
-                                 'timestamp': get_unix_timestamp_ms()}
-                asyncio.run(sio_server.emit('downlink_stt_result', parsed_result, room=sid))
-                recording_processing_data_packets[sid]["audio_timestamps"].append(parsed_result)
+                                 'start': start, 'duration': duration, 'timestamp': get_unix_timestamp_ms()}
+                asyncio.run_coroutine_threadsafe(downlink.emit('downlink_stt_result', parsed_result, room=sid), loop)
+                if sid in session_traces:
+                    session_traces[sid].record("stt", text=sentence, is_final=result.is_final,
+                                               speech_final=result.speech_final, start=start, duration=duration)
+                timeline = session_timelines.get(sid)
+                if timeline:
+                    timeline.add_segment(sentence, result.is_final, result.speech_final, start, duration,
+                                         parsed_result['timestamp'])
+            turn = server_turns.get(sid)
+            if turn:
+                # speech_final can come with an empty transcript, it still closes the utterance
+                utterance = turn.add_transcript(sentence, result.is_final, result.speech_final)
+                if utterance:
+                    asyncio.run_coroutine_threadsafe(run_server_turn(sid, utterance), loop)
+                elif SPECULATIVE_LLM:
+                    loop.call_soon_threadsafe(on_candidate_changed, sid, turn.candidate_text())
+
+    def on_utterance_end(self, utterance_end, **kwargs):
+        # fallback of the endpointing for noisy audio, sent after utterance_end_ms without words
+        turn = server_turns.get(sid)
+        if turn:
+            utterance = turn.end_utterance()
+            if utterance:
+                asyncio.run_coroutine_threadsafe(run_server_turn(sid, utterance), loop)
 
     dg_connection.on(LiveTranscriptionEvents.Transcript, on_message)
-
-    # Start the connection
-    dg_connection.start(options)
+    dg_connection.on(LiveTranscriptionEvents.UtteranceEnd, on_utterance_end)
+
+    # Start the connection, off the event loop since the SDK connects synchronously. Opens go through the provider
+    # scheduler, so a class starting together does not open every connection in the same second
+    async with ProviderScheduler.get_instance().async_slot("deepgram_stt", sid, ProviderScheduler.PRIORITY_FIRST):
+        started = await asyncio.to_thread(dg_connection.start, options)
+    if not started:
+        print("Failed to open STT connection:", sid)
+        return
+    if sid not in uplink_stages:
+        # the client disconnected while the connection was being opened
+        await asyncio.to_thread(dg_connection.finish)
+        return
     user_sessions[sid] = dg_connection
+    now = time.monotonic()
+    stt_activity[sid] = {"last_audio": now, "last_keep_alive": now}
+    stream["generation"] = uplink_stages[sid].set_connection_open(True)
+
+
+def parse_sample_rate(auth: dict) -> int | None:
+    """
+    Read the sample rate of a linear16 uplink from the connect auth.
+    :return: The sample rate, 16000 if not given, None if it is not one Deepgram and the gate support.
+    """
+    try:
+        sample_rate = int(auth.get("sample_rate", 16000))
+    except (TypeError, ValueError):
+        return None
+    return sample_rate if sample_rate in VoiceActivityGate.SUPPORTED_SAMPLE_RATES else None
+
+
+def on_uplink_pressure(sid, paused: bool):
+    """
+    Ask the client to pause its audio uplink while Deepgram is behind, and to resume once it caught up. The client
+    keeps the audio it records meanwhile and sends it after the resume.
+    """
+    asyncio.create_task(downlink.emit("downlink_uplink_pressure", {"paused": paused}, room=sid))
 
 
 def generate_dynamic_auth_code():
@@ -133,47 +351,125 @@ def get_unix_timestamp_ms() -> int:
     return int(time.time() * 1000)
 
 
+async def resume_session(sid, auth) -> bool:
+    """
+    Let a reconnecting client take over its parked session, without validation, agent prefetch or STT setup.
+    :param sid: The socket id of the new connection.
+    :param auth: The auth of the connection, with the resume_token of the session and its interview ID.
+    :return: True if the session was resumed.
+    """
+    session_sid = session_resume.find(auth.get("resume_token"), auth.get("token"))
+    if session_sid is None:
+        return False
+    # join the room of the session first, so nothing emitted from now on misses the new socket
+    await sio_server.enter_room(sid, session_sid)
+    resumed = session_resume.resume(session_sid)
+    if resumed is None:
+        await sio_server.leave_room(sid, session_sid)
+        return False
+    buffered_events, dropped_events = resumed
+    session_keys[sid] = session_sid
+    print("Session resumed:", session_sid, "by", sid)
+    # queued on the downlink of the session right away, so the new events cannot overtake the buffered ones
+    downlink_scheduler.enqueue("downlink_session_resumed",
+                               {"resume_token": session_resume.token_of(session_sid),
+                                "tts_encoding": tts_encodings.get(session_sid, TtsStream.DEFAULT_ENCODING),
+                                "replayed_events": len(buffered_events), "dropped_events": dropped_events},
+                               session_sid)
+    for event, data in buffered_events:
+        downlink_scheduler.enqueue(event, data, session_sid)
+    return True
+
+
 @sio_server.event
 async def connect(sid, environ, auth):
     access_token = auth.get("token")
     print("checking interview ID: ", access_token)
+    if not sio_serializer.accepts(auth):
+        await sio_server.emit("downlink_protocol_mismatch", room=sid, data=sio_serializer.protocol_info())
+        print("protocol version mismatch, rejected interview ID:", access_token)
+        return False
+    if await resume_session(sid, auth):
+        return True
+    sample_rate = parse_sample_rate(auth)
+    if auth.get("audio_format") == "linear16" and sample_rate is None:
+        await sio_server.emit("downlink_audio_format_invalid", room=sid,
+                              data={"sample_rates": list(VoiceActivityGate.SUPPORTED_SAMPLE_RATES)})
+        print("invalid sample rate, rejected interview ID:", access_token)
+        return False
     if check_uuid_format(access_token):
-        # send a post request to the backend to check if the interview ID is valid
-        # the post body should be {thread_id: str, dynamic_auth_code: str}
-        response = requests.post("https://api.prepit-ai.com/v1/prod/admin/threads/validate_id",
-                                 json={"thread_id": access_token,
-                                       "dynamic_auth_code": generate_dynamic_auth_code()})
-        if response.status_code == 200:
-            agent_id = response.json().get("data").get("agent_id")
-            user_id = response.json().get("data").get("user_id")
-            user_ids[sid] = user_id
-            thread_ids[sid] = access_token
-            recording_processing_data_packets[sid] = {
-                "thread_id": access_token,
-                "ws_conn_sid": sid,
-                "ws_conn_started": get_unix_timestamp_ms(),
-                "audio_started": False,
-                "audio_timestamps": [],
-                "audio_pause_timestamps": [],
-                "user_msg_timestamps": {},
-            }  # Initialize the data packet
-            print("agent_id:", agent_id)
-            await sio_server.emit("downlink_interview_id_check_success", room=sid, data={"agent_id": agent_id})
-            print("valid interview ID:", access_token)
-        else:
-            await sio_server.emit("downlink_interview_id_check_fail", room=sid)
-            await sio_server.disconnect(sid)
-            print("invalid interview ID:", access_token)
+        if not provider_clients.ready:
+            # the clients are still being built by the warm-up, building one here would block the loop
+            await sio_server.emit("downlink_server_busy", room=sid, data=node_load_monitor.busy_event("warming_up"))
+            print("node warming up, rejected interview ID:", access_token)
             return False
-        agent_prompt_handler.cache_agent_all_steps(agent_id)
-        print("Client connected:", sid)
-        # Schedule start_transcription to run on the event loop
-        transcription_tasks[sid] = asyncio.create_task(start_transcription(sid))
-
-        # Initialize an in-memory buffer for audio data
-        audio_buffers[sid] = BytesIO()
-
-        return True
+        if not node_load_monitor.admit_session(len(uplink_stages) + len(pending_connects)):
+            await sio_server.emit("downlink_server_busy", room=sid, data=node_load_monitor.busy_event("sessions"))
+            print("node busy, rejected interview ID:", access_token)
+            return False
+        pending_connects.add(sid)  # holds the slot while the backend validates the interview ID
+        try:
+            # send a post request to the backend to check if the interview ID is valid
+            # the post body should be {thread_id: str, dynamic_auth_code: str}
+            response = await asyncio.to_thread(upstream_pools.request, "backend", "POST",
+                                               "https://api.prepit-ai.com/v1/prod/admin/threads/validate_id",
+                                               json={"thread_id": access_token,
+                                                     "dynamic_auth_code": generate_dynamic_auth_code()})
+            if response.status_code == 200:
+                agent_id = response.json().get("data").get("agent_id")
+                user_id = response.json().get("data").get("user_id")
+                user_ids[sid] = user_id
+                thread_ids[sid] = access_token
+                tts_encodings[sid] = TtsStream.negotiate_encoding(auth.get("tts_encoding"))
+                if auth.get("audio_format") == "linear16":
+                    uplink_audio_formats[sid] = {"sample_rate": sample_rate}
+                    if STT_VAD_GATE:
+                        vad_gates[sid] = VoiceActivityGate(uplink_audio_formats[sid]["sample_rate"])
+                recording_processing_data_packets[sid] = {
+                    "thread_id": access_token,
+                    "ws_conn_sid": sid,
+                    "ws_conn_started": get_unix_timestamp_ms(),
+                    "audio_started": False,
+                    "audio_pause_timestamps": [],
+                    "user_msg_timestamps": {},
+                }  # Initialize the data packet
+                # audio_timestamps are streamed to a spool file next to the recording, see SessionTimeline
+                os.makedirs(AUDIO_FILE_FOLDER, exist_ok=True)
+                session_timelines[sid] = SessionTimeline(
+                    f"{AUDIO_FILE_FOLDER}/{access_token[0:8]}_{sid}.timeline.part")
+                trace = session_trace_recorder.open(sid, access_token, agent_id, auth)
+                if trace:
+                    session_traces[sid] = trace
+                print("agent_id:", agent_id)
+                if auth.get("turn_mode") == "server" and SERVER_TURN_MODE:
+                    server_turns[sid] = ServerTurn(agent_id, access_token, auth.get("provider", "openai"))
+                await sio_server.emit("downlink_interview_id_check_success", room=sid,
+                                      data={"agent_id": agent_id, "tts_encoding": tts_encodings[sid],
+                                            "resume_token": session_resume.issue(sid, access_token),
+                                            "turn_mode": "server" if sid in server_turns else "client"})
+                print("valid interview ID:", access_token)
+            else:
+                await sio_server.emit("downlink_interview_id_check_fail", room=sid)
+                await sio_server.disconnect(sid)
+                print("invalid interview ID:", access_token)
+                return False
+            agent_prompt_handler = provider_clients.get("agent_prompt_handler")
+            agent_prompt_handler.cache_agent_all_steps(agent_id)
+            StepOpeningCache.get_instance().submit_agent(agent_id, provider_clients.get("openai"), tts_encodings[sid])
+            print("Client connected:", sid)
+            # Initialize an in-memory buffer for audio data
+            audio_buffers[sid] = BytesIO()
+            uplink_stages[sid] = UplinkAudioStage(sid, lambda: user_sessions.get(sid),
+                                                  uplink_audio_formats.get(sid, {}).get("sample_rate"),
+                                                  lambda paused: on_uplink_pressure(sid, paused))
+
+            # The STT connection is opened by the first audio frame, pre-warm it only while under the budget
+            if count_stt_connections() < STT_PREWARM_BUDGET:
+                ensure_stt_connection(sid)
+
+            return True
+        finally:
+            pending_connects.discard(sid)
     return False
 
 
@@ -195,13 +491,18 @@ async def message(sid, data):
 
 @sio_server.event
 async def uplink_stt_audio(sid, audio_data):
+    sid = session_keys.get(sid, sid)
     # This event will be triggered by the frontend to send audio data to Deepgram
     audio_length = len(audio_data)
     # only print log if length is divisible by 5
     if audio_length % 5 == 0:
         print("Received audio data from client:", sid, "audio_data length:", audio_length)
-    if sid in user_sessions:
-        user_sessions[sid].send(audio_data)
+    if sid in uplink_stages:
+        if sid in session_traces:
+            session_traces[sid].audio(audio_data)
+        # Append the audio data to the in-memory buffer first, the uplink stage may wait on Deepgram
+        if sid in audio_buffers:
+            audio_buffers[sid].write(audio_data)
         if sid in recording_processing_data_packets and not recording_processing_data_packets[sid]["audio_started"]:
             recording_processing_data_packets[sid]["audio_started"] = True
             recording_processing_data_packets[sid]["audio_started_at"] = get_unix_timestamp_ms()
@@ -211,15 +512,21 @@ async def uplink_stt_audio(sid, audio_data):
         if last_audio != 0 and time_now - last_audio > 1500:
             recording_processing_data_packets[sid]["audio_pause_timestamps"].append([last_audio, time_now])
 
-        # Append the audio data to the in-memory buffer
-        if sid in audio_buffers:
-            audio_buffers[sid].write(audio_data)
+        # Silent spans of PCM uplinks are held back by the gate, the idle scheduler keeps STT alive meanwhile
+        stt_frames = vad_gates[sid].process(audio_data) if sid in vad_gates else [audio_data]
+        if not stt_frames:
+            return
+        ensure_stt_connection(sid)
+        if sid in stt_activity:
+            stt_activity[sid]["last_audio"] = time.monotonic()
+        for stt_frame in stt_frames:
+            uplink_stages[sid].push(stt_frame)
 
 
 @sio_server.event
 async def uplink_chat_message(sid, message_data):
+    sid = session_keys.get(sid, sid)
     print("Received chat message from client:", sid, message_data)
-
     chat_stream_model = ChatStreamModel(
         dynamic_auth_code=message_data['dynamic_auth_code'],
         messages=message_data['messages'],
@@ -228,45 +535,201 @@ async def uplink_chat_message(sid, message_data):
         provider=message_data['provider'],
         thread_id=message_data['thread_id']
     )
-    chat_stream = ChatStream(sio_server, openai_client, anthropic_client)
+    if sid in session_traces:
+        # only client messages are recorded, a replay rebuilds server-driven turns from the STT records
+        session_traces[sid].record("chat", message=SessionTrace.redact(message_data))
+    on_reply = None
+    if sid in server_turns:
+        # a typed message in server turn mode, the client history is the reference from now on
+        turn = server_turns[sid]
+        keys = sorted(message_data['messages'].keys(), key=int)
+        turn.update_context({"messages": {key: message_data['messages'][key] for key in keys[:-1]},
+                             "current_step": message_data['current_step'], "provider": message_data['provider']})
+        user_text = message_data['messages'][keys[-1]]['content']
+        turn.pending_user_text = user_text
+
+        def on_reply(reply: str):
+            turn.commit(user_text, reply)
+    return await start_chat_turn(sid, chat_stream_model, message_data, on_reply)
+
+
+async def start_chat_turn(sid, chat_stream_model: ChatStreamModel, message_data: dict, on_reply=None,
+                          chat_stream: ChatStream | None = None, token_source=None) -> bool:
+    """
+    Stream the reply to a user message, from the client (uplink_chat_message) or from server turn detection.
+    :param sid: The sid the session state is kept under.
+    :param chat_stream_model: The validated chat request.
+    :param message_data: The raw chat request, for the feedback processing.
+    :param on_reply: Called with the whole reply text once it has been streamed.
+    :param chat_stream: The ChatStream the reply was speculated with, a new one otherwise.
+    :param token_source: The held tokens of a committed speculation.
+    :return: False if the node is too busy to start a reply.
+    """
+    if not node_load_monitor.admit_llm_stream(len(llm_stream_tasks)):
+        await sio_server.emit("downlink_server_busy", room=sid, data=node_load_monitor.busy_event("llm_streams"))
+        return False
+    if chat_stream is None:
+        chat_stream = ChatStream(downlink, provider_clients.get("openai"), provider_clients.get("anthropic"),
+                                 tts_encodings.get(sid, TtsStream.DEFAULT_ENCODING), session_traces.get(sid))
     user_msg_timestamp = chat_stream.user_message_timestamp
     user_msg_id = message_data['thread_id'][:8] + '#' + str(user_msg_timestamp)
     recording_processing_data_packets[sid]["user_msg_timestamps"][user_msg_timestamp] = user_msg_id
     user_id = user_ids[sid] if sid in user_ids else "0"
 
+    async def run_chat_stream():
+        await chat_stream.stream_chat(chat_stream_model, chat_stream_model.provider, chat_stream_model.current_step,
+                                      chat_stream_model.agent_id, sid, user_id, token_source)
+        if on_reply and chat_stream.response_text is not None:
+            on_reply(chat_stream.response_text)
+
     # Run stream_chat as an independent task
-    task = asyncio.create_task(
-        chat_stream.stream_chat(chat_stream_model, chat_stream_model.provider, chat_stream_model.current_step,
-                                chat_stream_model.agent_id, sid, user_id))
+    task = asyncio.create_task(run_chat_stream())
     chat_tasks[sid] = task
+    chat_streams[sid] = chat_stream
+    llm_stream_tasks.add(task)
+    task.add_done_callback(llm_stream_tasks.discard)
+
+    # Add a callback to remove the task from the dictionary once it is done, unless a newer turn replaced it
+    task.add_done_callback(lambda t: chat_tasks.pop(sid, None) if chat_tasks.get(sid) is t else None)
+    task.add_done_callback(lambda t: chat_streams.pop(sid, None) if chat_streams.get(sid) is chat_stream else None)
+
+    submit_in_background(submit_feedback_for_processing, message_data['messages'], message_data['thread_id'],
+                         message_data['agent_id'])
 
-    # Add a callback to remove the task from the dictionary once it is done
-    task.add_done_callback(lambda t: chat_tasks.pop(sid, None))
+    return True
+
+
+async def run_server_turn(sid, utterance: str):
+    """
+    Server turn mode: answer the utterance the STT endpointing just closed, from the history held by the server.
+    :param sid: The sid the session state is kept under.
+    :param utterance: The final transcript of the utterance.
+    """
+    turn = server_turns.get(sid)
+    speculation = speculations.pop(sid, None)
+    if turn is None or sid not in recording_processing_data_packets:
+        if speculation:
+            speculation.cancel()
+        return
+    task = chat_tasks.get(sid)
+    if task and not task.done():
+        # the candidate went on talking after the endpoint, answer all of it instead of the first part
+        task.cancel()
+        turn.interrupted += 1
+    user_text = f"{turn.pending_user_text} {utterance}".strip()
+    turn.pending_user_text = user_text
+    messages = turn.next_messages(user_text)
+    chat_stream_model = ChatStreamModel(dynamic_auth_code=generate_dynamic_auth_code(), messages=messages,
+                                        current_step=turn.current_step, agent_id=turn.agent_id,
+                                        provider=turn.provider, thread_id=turn.thread_id)
+    message_data = {"messages": messages, "current_step": turn.current_step, "agent_id": turn.agent_id,
+                    "provider": turn.provider, "thread_id": turn.thread_id}
+    await downlink.emit("downlink_turn_started", {"text": user_text, "message_index": len(messages) - 1,
+                                                  "current_step": turn.current_step,
+                                                  "speculative": bool(speculation and speculation.matches(utterance))},
+                        room=sid)
+    if speculation and speculation.matches(utterance):
+        # the reply is already on its way, stream the held tokens now
+        started = await start_chat_turn(sid, chat_stream_model, message_data,
+                                        lambda reply: turn.commit(user_text, reply),
+                                        speculation.chat_stream, speculation.commit())
+        if not started:
+            speculation.cancel()
+        return
+    if speculation:
+        speculation.cancel()
+    await start_chat_turn(sid, chat_stream_model, message_data, lambda reply: turn.commit(user_text, reply))
+
+
+def on_candidate_changed(sid, candidate: str):
+    """
+    Speculative mode: the transcript of the utterance in progress changed. Drop the speculation if it does not match
+    anymore, and start a new one if the transcript stays like this for SPECULATION_STABLE_MS.
+    """
+    if not candidate:
+        return
+    speculation = speculations.get(sid)
+    if speculation and not speculation.matches(candidate):
+        speculations.pop(sid).cancel()
+    if len(candidate.split()) >= SPECULATION_MIN_WORDS:
+        asyncio.get_running_loop().call_later(SPECULATION_STABLE_MS / 1000, start_speculation, sid, candidate)
+
+
+def start_speculation(sid, candidate: str):
+    """
+    Speculative mode: start the reply to the utterance in progress, if its transcript is still the same.
+    """
+    turn = server_turns.get(sid)
+    if turn is None or sid in speculations or turn.candidate_text() != candidate:
+        return
+    task = chat_tasks.get(sid)
+    if task and not task.done():
+        return  # a reply is streaming, the candidate is talking over it
+    if not node_load_monitor.admit_llm_stream(len(llm_stream_tasks)):
+        return  # speculation is the first thing to give up under load
+    messages = turn.next_messages(f"{turn.pending_user_text} {candidate}".strip())
+    chat_stream_model = ChatStreamModel(dynamic_auth_code=generate_dynamic_auth_code(), messages=messages,
+                                        current_step=turn.current_step, agent_id=turn.agent_id,
+                                        provider=turn.provider, thread_id=turn.thread_id)
+    chat_stream = ChatStream(downlink, provider_clients.get("openai"), provider_clients.get("anthropic"),
+                             tts_encodings.get(sid, TtsStream.DEFAULT_ENCODING), session_traces.get(sid))
+    token_stream = chat_stream.speculate(chat_stream_model, chat_stream_model.provider, chat_stream_model.current_step,
+                                         chat_stream_model.agent_id, sid, user_ids.get(sid, "0"))
+    speculations[sid] = SpeculativeReply(candidate, chat_stream, token_stream)
 
-    submit_feedback_for_processing(message_data['messages'], message_data['thread_id'], message_data['agent_id'])
 
+@sio_server.event
+async def uplink_turn_context(sid, context):
+    # Server turn mode: the client updates the history it holds (step changes, edits), {messages, current_step, provider}
+    sid = session_keys.get(sid, sid)
+    if sid not in server_turns:
+        return False
+    server_turns[sid].update_context(context)
     return True
 
 
 @sio_server.event
 async def uplink_keep_alive(sid):
+    # Keep alive is sent by stt_idle_scheduler now, the event is kept for older clients
     print("Received keep alive from client:", sid)
-    if sid in user_sessions:
-        user_sessions[sid].send('{ "type": "KeepAlive" }')
+
+
+@sio_server.event
+async def uplink_end_session(sid):
+    # The interview is over, the coming disconnect closes the session right away instead of parking it
+    session_resume.forget(session_keys.get(sid, sid))
+    return True
 
 
 @sio_server.event
 async def disconnect(sid):
     print("Client disconnected:", sid)
-    audio_file_folder = "volume_cache/interviewee_recordings"
-    if sid in user_sessions:
-        user_sessions[sid].finish()  # Close the Deepgram connection
-        del user_sessions[sid]  # Remove the session from the dictionary
+    sid = session_keys.pop(sid, sid)
+    if session_resume.park(sid, close_session):
+        downlink.park(sid)
+        print("Session parked for resume:", sid)
+        return True
+    return await close_session(sid)
+
+
+async def close_session(sid):
+    """
+    Tear a session down: flush and close STT, write and submit the recording, stop the reply stream.
+    :param sid: The sid the session state is kept under.
+    """
+    session_resume.forget(sid)
+    downlink_scheduler.close(sid)
+    audio_file_folder = AUDIO_FILE_FOLDER
+    if sid in uplink_stages:
+        await uplink_stages[sid].close()  # Flush the audio still queued for Deepgram
+        del uplink_stages[sid]
+    await close_stt_connection(sid)  # Close the Deepgram connection
     if sid in transcription_tasks:
         transcription_tasks[sid].cancel()
         del transcription_tasks[sid]
     if sid in user_ids:
         del user_ids[sid]
+    tts_encodings.pop(sid, None)
     if sid in last_audio_data_received_timestamp:
         del last_audio_data_received_timestamp[sid]
 
@@ -284,33 +747,50 @@ async def disconnect(sid):
         if sid in recording_processing_data_packets and recording_processing_data_packets[sid]["user_msg_timestamps"]:  # Check if there are user messages
             recording_processing_data_packets[sid]["ws_conn_finished"] = get_unix_timestamp_ms()
             recording_processing_data_packets[sid]["recording_id"] = recording_id
+            if sid in vad_gates:
+                recording_processing_data_packets[sid].update(vad_gates[sid].timing_data())
             # Save the recording processing data packet to a json file
             json_file_path = f"{audio_file_folder}/{recording_id}.json"
-            with open(json_file_path, "w") as data_file:
-                json.dump(recording_processing_data_packets[sid], data_file)
+            await asyncio.to_thread(session_timelines.pop(sid).write_metadata, json_file_path,
+                                    recording_processing_data_packets[sid])
             del recording_processing_data_packets[sid]
 
             # Submit the files for processing
-            submit_files_for_processing(wav_file_path, json_file_path, thread_ids[sid], sid)
+            submit_in_background(submit_files_for_processing, wav_file_path, json_file_path, thread_ids[sid], sid)
 
         del audio_buffers[sid]
         del thread_ids[sid]
 
+    if sid in session_timelines:
+        session_timelines.pop(sid).discard()  # Nothing to submit, drop the spool file
+    uplink_audio_formats.pop(sid, None)
+    vad_gates.pop(sid, None)
+    server_turns.pop(sid, None)
+    if sid in speculations:
+        speculations.pop(sid).cancel()
+    if sid in session_traces:
+        session_traces.pop(sid).close()
+
     if sid in chat_tasks:
         chat_tasks[sid].cancel()
         del chat_tasks[sid]
     return True
 
 
+def submit_in_background(submit, *args):
+    """
+    Run a blocking upload to the processing node on a worker thread, without holding up the caller. The uploads can
+    take up to the processing node timeout.
+    :param submit: submit_files_for_processing or submit_feedback_for_processing.
+    """
+    submission = asyncio.create_task(asyncio.to_thread(submit, *args))
+    processing_submissions.add(submission)
+    submission.add_done_callback(processing_submissions.discard)
+
+
 def submit_files_for_processing(wav_file_path: str, json_file_path: str, thread_id: str, ws_sid: str):
     url = "http://code-runner-node-0.courseyai.com:6050/new_audio_processing_task"
 
-    # Open the files to upload
-    files = {
-        'metadata_file': open(json_file_path, 'rb'),
-        'wav_file': open(wav_file_path, 'rb'),
-    }
-
     # Define additional string parameters
     data = {
         'thread_id': thread_id,
@@ -319,8 +799,13 @@ def submit_files_for_processing(wav_file_path: str, json_file_path: str, thread_
     }
 
     try:
-        # Send the POST request with the files and additional parameters
-        response = requests.post(url, files=files, data=data)
+        # Open the files to upload and send the POST request with the files and additional parameters
+        with open(json_file_path, 'rb') as metadata_file, open(wav_file_path, 'rb') as wav_file:
+            files = {
+                'metadata_file': metadata_file,
+                'wav_file': wav_file,
+            }
+            response = upstream_pools.request("processing_node", "POST", url, files=files, data=data)
 
         # Check if the request was successful
         if response.status_code != 200:
@@ -360,11 +845,6 @@ def submit_feedback_for_processing(messages: dict, thread_id: str, agent_id: str
         with open(feedback_file_path, "w") as data_file:
             json.dump(messages_to_process, data_file)
 
-        # Open the file to upload
-        files = {
-            'messages_file': open(feedback_file_path, 'rb'),
-        }
-
         # Define additional string parameters
         data = {
             'thread_id': thread_id,
@@ -374,8 +854,12 @@ def submit_feedback_for_processing(messages: dict, thread_id: str, agent_id: str
         }
 
         try:
-            # Send the POST request with the files and additional parameters
-            response = requests.post(url, files=files, data=data)
+            # Open the file to upload and send the POST request with the file and additional parameters
+            with open(feedback_file_path, 'rb') as messages_file:
+                files = {
+                    'messages_file': messages_file,
+                }
+                response = upstream_pools.request("processing_node", "POST", url, files=files, data=data)
 
             # Check if the request was successful
             if response.status_code != 200:
@@ -403,16 +887,30 @@ async def get_tts_file(tts_session_id: str, chunk_id: str, background_tasks: Bac
     """
     ENDPOINT: /v1/dev/tts
     serves the TTS audio file for the specified session id and chunk id.
+    In TTS streaming mode a chunk that is still being synthesized is streamed as its bytes arrive, otherwise the
+    request waits for the chunk to be done.
     :param tts_session_id:
     :param chunk_id:
     :param background_tasks:
     :return:
     """
-    file_location = f"{TtsStream.TTS_AUDIO_CACHE_FOLDER}/{tts_session_id}_{chunk_id}.mp3"
-    if os.path.isfile(file_location):
+    synthesis = TtsStream.get_in_progress(tts_session_id, chunk_id)
+    if synthesis and not synthesis["progressive"]:
+        await TtsStream.wait_done(synthesis)  # the chunk is still being synthesized, serve it once it is done
+        synthesis = None
+    if synthesis and not await TtsStream.wait_started(synthesis):
+        synthesis = None  # Deepgram failed or the chunk was served from the phrase cache, serve the file if any
+    if synthesis:
+        # streaming mode, the audio is still arriving from Deepgram: forward it chunk by chunk
+        media_type = TtsStream.MEDIA_TYPES[synthesis["path"].rsplit(".", 1)[-1]]
+        background_tasks.add_task(delete_file_after_delay, synthesis["path"], 60)  # 60 seconds delay
+        return StreamingResponse(TtsStream.iter_progressive(synthesis), media_type=media_type)
+    audio_file = TtsStream.find_audio_file(tts_session_id, chunk_id)
+    if audio_file:
+        file_location, media_type = audio_file
         # Add the delete_file_after_delay function as a background task
         background_tasks.add_task(delete_file_after_delay, file_location, 60)  # 60 seconds delay
-        return FileResponse(path=file_location, media_type="audio/mpeg")
+        return FileResponse(path=file_location, media_type=media_type)
     else:
         raise HTTPException(status_code=404, detail="File not found")
 
@@ -420,5 +918,151 @@ async def get_tts_file(tts_session_id: str, chunk_id: str, background_tasks: Bac
 @app.get(f"{CURRENT_VERSION_PREFIX}{DEV_PREFIX}/ping")
 @app.get(f"{CURRENT_VERSION_PREFIX}{PROD_PREFIX}/ping")
 async def ping():
-    connected_users = len(user_sessions)
-    return {"status": connected_users}
+    """
+    ENDPOINT: /v1/dev/ping
+    health and load report of this node, for nginx or a global router to spread the sessions.
+    status is the number of connected users, kept for older monitors.
+    """
+    connected_users = len(uplink_stages)
+    uplink_max_lag_ms = max((stage.last_lag_ms for stage in uplink_stages.values()), default=0)
+    report = node_load_monitor.load_report(connected_users + len(pending_connects), len(llm_stream_tasks),
+                                           TtsStream.queue_depth())
+    report["ready"] = report["ready"] and provider_clients.ready  # no traffic before the clients are warm
+    return {"status": connected_users, **report, "uplink_max_lag_ms": round(uplink_max_lag_ms, 1),
+            "tts_cache": TtsStream.get_phrase_cache().stats(), "providers": ProviderScheduler.get_instance().stats(),
+            "step_openings": StepOpeningCache.get_instance().stats(), "resume": session_resume.stats(),
+            "speculation": SpeculativeReply.stats(), "downlink": downlink_scheduler.stats(), "upstream_pools": upstream_pools.stats(),
+            "sio_protocol": sio_serializer.protocol_info(),
+            "startup": {**startup_report, "clients": provider_clients.report()}}
+
+
+@app.get(f"{CURRENT_VERSION_PREFIX}{DEV_PREFIX}/ready")
+@app.get(f"{CURRENT_VERSION_PREFIX}{PROD_PREFIX}/ready")
+async def ready():
+    """
+    ENDPOINT: /v1/dev/ready
+    readiness probe, 503 until the provider clients are warm, so a new container only takes traffic once it can serve.
+    """
+    if provider_clients.failed:
+        raise HTTPException(status_code=503, detail={"failed": dict(provider_clients.failed)})
+    if not provider_clients.ready:
+        raise HTTPException(status_code=503, detail="Warming up")
+    return {"ready": True, **startup_report}
+
+
+@app.get(f"{CURRENT_VERSION_PREFIX}{DEV_PREFIX}/protocol")
+@app.get(f"{CURRENT_VERSION_PREFIX}{PROD_PREFIX}/protocol")
+async def get_protocol():
+    """
+    ENDPOINT: /v1/dev/protocol
+    Socket.IO packet format of this node, the client picks its parser from it before connecting and sends the
+    protocol version it speaks in auth.protocol_version.
+    """
+    return sio_serializer.protocol_info()
+
+
+def check_admin_token(admin_token: str | None):
+    """
+    Guard for the diagnostics endpoints: they only exist when ADMIN_DIAGNOSTICS_TOKEN is set, and need it in the
+    X-Admin-Token header.
+    :param admin_token: The X-Admin-Token header of the request.
+    """
+    expected_token = os.getenv("ADMIN_DIAGNOSTICS_TOKEN")
+    if not expected_token or not admin_token or not hmac.compare_digest(admin_token, expected_token):
+        raise HTTPException(status_code=404, detail="Not found")
+
+
+@app.get(f"{CURRENT_VERSION_PREFIX}{DEV_PREFIX}/diagnostics/loop")
+@app.get(f"{CURRENT_VERSION_PREFIX}{PROD_PREFIX}/diagnostics/loop")
+async def get_loop_diagnostics(reset: bool = False, x_admin_token: str | None = Header(default=None)):
+    """
+    ENDPOINT: /v1/dev/diagnostics/loop
+    admin only, event loop lag percentiles and the handlers that blocked the loop, with their stack traces.
+    Needs LOOP_DIAGNOSTICS=1 to collect anything.
+    :param reset: clear the collected stalls after reporting them.
+    :param x_admin_token:
+    :return:
+    """
+    check_admin_token(x_admin_token)
+    report = loop_diagnostics.report()
+    if reset:
+        loop_diagnostics.reset()
+    return report
+
+
+def session_memory(sid) -> dict:
+    """
+    Estimated bytes a live session holds, by component.
+    :param sid: The sid the session state is kept under.
+    """
+    components = {"recording_buffer": 0, "timing_data": 0, "history": 0, "uplink_queue": 0, "vad_preroll": 0}
+    if sid in audio_buffers:
+        components["recording_buffer"] = audio_buffers[sid].getbuffer().nbytes
+    if sid in session_timelines:
+        components["timing_data"] += session_timelines[sid].estimated_bytes()
+    if sid in recording_processing_data_packets:
+        components["timing_data"] += len(json.dumps(recording_processing_data_packets[sid]))
+    if sid in chat_streams:
+        components["history"] = chat_streams[sid].history_bytes
+    if sid in uplink_stages:
+        components["uplink_queue"] = uplink_stages[sid].queued_bytes()
+    if sid in vad_gates:
+        components["vad_preroll"] = sum(len(frame) for frame in vad_gates[sid].preroll)
+    queued_tts = 0
+    if sid in chat_streams:
+        tts_session_id = chat_streams[sid].tts_session_id
+        queued_tts = sum(1 for file_key in list(TtsStream.in_progress.keys()) if file_key.startswith(tts_session_id))
+    return {**components, "total": sum(components.values()), "queued_tts_chunks": queued_tts,
+            "queued_downlink_frames": downlink_scheduler.depth(sid), "parked": sid in session_resume.parked}
+
+
+@app.get(f"{CURRENT_VERSION_PREFIX}{DEV_PREFIX}/diagnostics/memory")
+@app.get(f"{CURRENT_VERSION_PREFIX}{PROD_PREFIX}/diagnostics/memory")
+async def get_memory_diagnostics(snapshot: bool = False, stop_tracing: bool = False, top: int = 25,
+                                 x_admin_token: str | None = Header(default=None)):
+    """
+    ENDPOINT: /v1/dev/diagnostics/memory
+    admin only, estimated bytes per live session by component, per-sid entries and objects that outlived their
+    socket, and on demand a tracemalloc diff grouped by module.
+    The instance census walks every object of the heap and the snapshot diff compares every traced allocation, tens
+    to hundreds of ms on a loaded node and more with MEMORY_TRACEMALLOC_FRAMES > 1. Both run in a worker thread, so
+    the event loop keeps serving sessions, but they still take CPU and the GIL from it while they run.
+    :param snapshot: diff the allocations against the previous snapshot call, the first call starts tracing.
+    :param stop_tracing: stop tracemalloc, it slows allocations down while it runs.
+    :param top: number of modules in the snapshot diff.
+    :param x_admin_token:
+    :return:
+    """
+    check_admin_token(x_admin_token)
+    live_sids = set(uplink_stages.keys())
+    sessions = {sid: session_memory(sid) for sid in live_sids}
+    totals = {}
+    for usage in sessions.values():
+        for component, value in usage.items():
+            if isinstance(value, int) and not isinstance(value, bool):
+                totals[component] = totals.get(component, 0) + value
+    tts_files = [entry for entry in os.scandir(TtsStream.TTS_AUDIO_CACHE_FOLDER) if entry.is_file()] \
+        if os.path.isdir(TtsStream.TTS_AUDIO_CACHE_FOLDER) else []
+    tasks = {}
+    for task in asyncio.all_tasks():
+        name = getattr(task.get_coro(), "__qualname__", type(task.get_coro()).__name__)
+        tasks[name] = tasks.get(name, 0) + 1
+    report = {
+        "process": memory_diagnostics.process_memory(),
+        "live_sessions": len(live_sids),
+        "session_totals": totals,
+        "sessions": sessions,
+        "orphaned_state": memory_diagnostics.orphans(SESSION_STATE, live_sids),
+        "instances": await asyncio.to_thread(memory_diagnostics.census),
+        "tasks": dict(sorted(tasks.items(), key=lambda item: -item[1])),
+        "tts_in_progress": len(TtsStream.in_progress),
+        "tts_audio_files": {"count": len(tts_files), "bytes": sum(entry.stat().st_size for entry in tts_files)},
+    }
+    if snapshot:
+        report["tracemalloc"] = await asyncio.to_thread(memory_diagnostics.snapshot_diff, top)
+    if stop_tracing:
+        memory_diagnostics.stop_tracing()
+    return report
+
+
+startup_report["import_ms"] = round((time.perf_counter() - MODULE_IMPORT_STARTED) * 1000, 1)
@@ -0,0 +1,13 @@
+# Copyright (c) 2024.
+# -*-coding:utf-8 -*-
+"""
+@file: conftest.py
+@author: Jerry(Ruihuang)Yang
+@email: rxy216@case.edu
+@time: 10/20/26 10:00
+Unit tests of the standalone modules, run from the repository root with python -m pytest.
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,99 @@
+# Copyright (c) 2024.
+# -*-coding:utf-8 -*-
+"""
+@file: test_chat_stream.py
+@author: Jerry(Ruihuang)Yang
+@email: rxy216@case.edu
+@time: 10/20/26 13:50
+"""
+import asyncio
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("pydantic")
+from ChatStream import ChatStream  # noqa: E402
+from ProviderScheduler import ProviderScheduler  # noqa: E402
+
+
+class FakeOpenAIStream:
+    def __init__(self, texts: list, delay_s: float, fail: bool = False):
+        self.texts = texts
+        self.delay_s = delay_s
+        self.fail = fail
+        self.closed = threading.Event()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.closed.set()
+
+    def __iter__(self):
+        for text in self.texts:
+            time.sleep(self.delay_s)  # a blocking read, like the SDK
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=text))])
+        if self.fail:
+            raise RuntimeError("stream broke")
+
+
+def build_chat_stream(stream: FakeOpenAIStream) -> ChatStream:
+    chat_stream = ChatStream.__new__(ChatStream)
+    chat_stream.openai_client = SimpleNamespace(
+        chat=SimpleNamespace(completions=SimpleNamespace(create=lambda **kwargs: stream)))
+    chat_stream.provider_scheduler = ProviderScheduler()
+    chat_stream.session_key = "session"
+    chat_stream.llm_priority = ProviderScheduler.PRIORITY_FIRST
+    return chat_stream
+
+
+def test_provider_stream_does_not_block_the_event_loop():
+    stream = FakeOpenAIStream(["Okay", ".", None, " Next"], delay_s=0.02)
+    chat_stream = build_chat_stream(stream)
+
+    async def run():
+        ticks = 0
+
+        async def tick():
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.005)
+                ticks += 1
+
+        ticker = asyncio.create_task(tick())
+        texts = [text async for text in chat_stream._ChatStream__openai_chat_generator([])]
+        ticker.cancel()
+        return texts, ticks
+
+    texts, ticks = asyncio.run(run())
+    assert texts == ["Okay", ".", " Next"]
+    assert ticks >= 5  # the loop kept running while the worker waited on the stream
+    assert stream.closed.is_set()
+    assert chat_stream.provider_scheduler.stats()["openai"]["active"] == 0
+
+
+def test_provider_errors_reach_the_caller_and_release_the_slot():
+    chat_stream = build_chat_stream(FakeOpenAIStream(["Okay"], delay_s=0, fail=True))
+
+    async def run():
+        return [text async for text in chat_stream._ChatStream__openai_chat_generator([])]
+
+    with pytest.raises(RuntimeError, match="stream broke"):
+        asyncio.run(run())
+    assert chat_stream.provider_scheduler.stats()["openai"]["active"] == 0
+
+
+def test_closing_the_generator_stops_the_worker():
+    stream = FakeOpenAIStream(["a"] * 100, delay_s=0.01)
+    chat_stream = build_chat_stream(stream)
+
+    async def run():
+        generator = chat_stream._ChatStream__openai_chat_generator([])
+        assert await generator.__anext__() == "a"
+        await generator.aclose()
+        assert chat_stream.provider_scheduler.stats()["openai"]["active"] == 0
+
+    asyncio.run(run())
+    assert stream.closed.wait(1)
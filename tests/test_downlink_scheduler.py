@@ -0,0 +1,150 @@
+# Copyright (c) 2024.
+# -*-coding:utf-8 -*-
+"""
+@file: test_downlink_scheduler.py
+@author: Jerry(Ruihuang)Yang
+@email: rxy216@case.edu
+@time: 10/20/26 14:20
+"""
+import asyncio
+from types import SimpleNamespace
+
+from DownlinkScheduler import DownlinkScheduler
+
+
+class FakeSioServer:
+    """
+    Stand-in for socketio.AsyncServer: one socket per room, with an Engine.IO queue depth the test sets.
+    """
+
+    def __init__(self):
+        self.sent = []
+        self.transport_depth = 0
+        self.emit_gate = None  # asyncio.Event holding the emits back while it is not set
+        self.manager = SimpleNamespace(get_participants=lambda namespace, room: [(room, "eio_" + room)])
+        self.eio = SimpleNamespace(sockets=self)
+
+    def get(self, eio_sid):
+        return SimpleNamespace(queue=SimpleNamespace(qsize=lambda: self.transport_depth))
+
+    async def emit(self, event, data=None, room=None):
+        if self.emit_gate is not None:
+            await self.emit_gate.wait()
+        self.sent.append((event, data))
+
+
+def stt(text: str, is_final: bool) -> dict:
+    return {"text": text, "is_final": is_final}
+
+
+def chat(response: str, **flags) -> dict:
+    return {"response": response, "tts_session_id": "tts", "have_new_chunk": False, "first_yield": False,
+            "last_yield": False, **flags}
+
+
+async def drain(scheduler: DownlinkScheduler, room: str = "room"):
+    while scheduler.depth(room):
+        await asyncio.sleep(0.001)
+
+
+def build_scheduler(monkeypatch, on_overflow=None, **env) -> tuple[DownlinkScheduler, FakeSioServer]:
+    for name, value in env.items():
+        monkeypatch.setenv(name, str(value))
+    monkeypatch.setattr(DownlinkScheduler, "POLL_S", 0.001)
+    sio_server = FakeSioServer()
+    return DownlinkScheduler(sio_server, on_overflow), sio_server
+
+
+def test_slow_client_gets_the_latest_interim_and_every_final_in_order(monkeypatch):
+    scheduler, sio_server = build_scheduler(monkeypatch)
+
+    async def run():
+        sio_server.transport_depth = 100  # the client is behind, frames wait here
+        scheduler.enqueue("downlink_stt_result", stt("I", False), "room")
+        scheduler.enqueue("downlink_stt_result", stt("I think", False), "room")
+        scheduler.enqueue("downlink_chat_response", chat("Okay", first_yield=True), "room")
+        scheduler.enqueue("downlink_chat_response", chat("Okay. Let"), "room")
+        scheduler.enqueue("downlink_chat_response", chat("Okay. Let's"), "room")
+        scheduler.enqueue("downlink_stt_result", stt("I think so.", True), "room")
+        scheduler.enqueue("downlink_stt_result", stt("Next", False), "room")
+        await asyncio.sleep(0.01)
+        sio_server.transport_depth = 0
+        await drain(scheduler)
+
+    asyncio.run(run())
+    assert sio_server.sent == [
+        ("downlink_chat_response", chat("Okay", first_yield=True)),
+        ("downlink_chat_response", chat("Okay. Let's")),
+        ("downlink_stt_result", stt("I think so.", True)),  # a final drops the interims before it
+        ("downlink_stt_result", stt("Next", False)),
+    ]
+    assert scheduler.stats()["coalesced"] == 3
+
+
+def test_over_the_soft_limit_the_oldest_superseding_frame_goes(monkeypatch):
+    scheduler, sio_server = build_scheduler(monkeypatch, DOWNLINK_MAX_QUEUED=2)
+
+    async def run():
+        sio_server.transport_depth = 100
+        scheduler.enqueue("downlink_chat_response", chat("partial"), "room")
+        scheduler.enqueue("downlink_notice", {"n": 1}, "room")
+        scheduler.enqueue("downlink_notice", {"n": 2}, "room")
+        scheduler.enqueue("downlink_notice", {"n": 3}, "room")  # ordered, kept over the soft limit
+        sio_server.transport_depth = 0
+        await drain(scheduler)
+
+    asyncio.run(run())
+    assert sio_server.sent == [("downlink_notice", {"n": 1}), ("downlink_notice", {"n": 2}),
+                               ("downlink_notice", {"n": 3})]
+    assert scheduler.stats()["dropped"] == 1 and scheduler.stats()["overflow"] == 1
+
+
+def test_hard_limit_disconnects_the_client(monkeypatch):
+    overflowed = []
+
+    async def on_overflow(room):
+        overflowed.append(room)
+
+    scheduler, sio_server = build_scheduler(monkeypatch, on_overflow, DOWNLINK_MAX_QUEUED=2,
+                                            DOWNLINK_HARD_MAX_QUEUED=3)
+
+    async def run():
+        sio_server.transport_depth = 100
+        for n in range(5):
+            scheduler.enqueue("downlink_notice", {"n": n}, "room")
+        await asyncio.sleep(0.01)
+        assert scheduler.depth("room") == 3
+        return scheduler.take("room")
+
+    pending = asyncio.run(run())
+    assert overflowed == ["room"]
+    assert pending == [("downlink_notice", {"n": n}) for n in range(3)]
+    assert scheduler.stats()["disconnected"] == 1 and scheduler.stats()["dropped"] == 2
+
+
+def test_take_during_an_emit_keeps_the_frame(monkeypatch):
+    scheduler, sio_server = build_scheduler(monkeypatch)
+
+    async def run():
+        sio_server.emit_gate = asyncio.Event()  # the emit never finishes
+        scheduler.enqueue("downlink_notice", {"n": 1}, "room")
+        scheduler.enqueue("downlink_notice", {"n": 2}, "room")
+        await asyncio.sleep(0.01)
+        return scheduler.take("room")
+
+    assert asyncio.run(run()) == [("downlink_notice", {"n": 1}), ("downlink_notice", {"n": 2})]
+    assert sio_server.sent == []
+
+
+def test_unreadable_transport_is_reported(monkeypatch):
+    scheduler, sio_server = build_scheduler(monkeypatch)
+    sio_server.eio = SimpleNamespace()  # an Engine.IO without the sockets map
+
+    async def run():
+        scheduler.enqueue("downlink_notice", {"n": 1}, "room")
+        await drain(scheduler)
+
+    asyncio.run(run())
+    assert sio_server.sent == [("downlink_notice", {"n": 1})]
+    stats = scheduler.stats()
+    assert stats["transport_backpressure"] is False and stats["transport_errors"] == 1
@@ -0,0 +1,35 @@
+# Copyright (c) 2024.
+# -*-coding:utf-8 -*-
+"""
+@file: test_loop_diagnostics.py
+@author: Jerry(Ruihuang)Yang
+@email: rxy216@case.edu
+@time: 10/20/26 17:30
+"""
+import asyncio
+import time
+
+from LoopDiagnostics import LoopDiagnostics
+
+
+async def handle_slow_request():
+    time.sleep(0.3)  # a blocking call on the event loop
+
+
+def test_blocked_loop_is_recorded_under_its_handler_with_the_stack(monkeypatch):
+    monkeypatch.setenv("LOOP_DIAGNOSTICS", "1")
+    monkeypatch.setenv("LOOP_BLOCK_THRESHOLD_MS", "100")
+    diagnostics = LoopDiagnostics()
+
+    async def run():
+        diagnostics.start()
+        await asyncio.sleep(0.1)
+        await handle_slow_request()
+        await asyncio.sleep(0.2)  # the heartbeat ticks again and the watchdog records the stall
+        return diagnostics.report()
+
+    report = asyncio.run(run())
+    stall = report["blocking_handlers"]["test_loop_diagnostics.py:handle_slow_request"]
+    assert stall["count"] == 1 and 200 <= stall["max_ms"] <= 400
+    assert "time.sleep(0.3)" in stall["stacks"][0]["stack"]
+    assert report["loop_lag_ms"]["max"] >= 200
@@ -0,0 +1,50 @@
+# Copyright (c) 2024.
+# -*-coding:utf-8 -*-
+"""
+@file: test_memory_diagnostics.py
+@author: Jerry(Ruihuang)Yang
+@email: rxy216@case.edu
+@time: 10/20/26 17:05
+"""
+import os
+
+import MemoryDiagnostics as memory_diagnostics_module
+from MemoryDiagnostics import MemoryDiagnostics
+
+
+def test_orphans_lists_the_entries_of_gone_sessions():
+    session_state = {
+        "audio_buffers": {"live": 1, "gone": 2},
+        "user_ids": {"live": 1},
+        "tts_encodings": {f"gone{i}": "mp3" for i in range(8)},
+    }
+    report = MemoryDiagnostics().orphans(session_state, {"live"})
+    assert report == {"audio_buffers": {"count": 1, "sample": ["gone"]},
+                      "tts_encodings": {"count": 8, "sample": [f"gone{i}" for i in range(5)]}}
+
+
+def test_allocations_are_grouped_by_module():
+    module_of = MemoryDiagnostics._MemoryDiagnostics__module_of
+    repo_root = memory_diagnostics_module.REPO_ROOT
+    stdlib_root = memory_diagnostics_module.STDLIB_ROOT
+    assert module_of(os.path.join(repo_root, "ChatStream.py")) == "ChatStream.py"
+    assert module_of(os.path.join(repo_root, "benchmarks", "bench_hot_paths.py")) == \
+        os.path.join("benchmarks", "bench_hot_paths.py")
+    assert module_of("/venv/lib/python3.12/site-packages/openai/_client.py") == "openai"
+    assert module_of("/venv/lib/python3.12/site-packages/six.py") == "six"
+    assert module_of(os.path.join(stdlib_root, "asyncio", "events.py")) == "stdlib:asyncio"
+    assert module_of(os.path.join(stdlib_root, "json.py")) == "stdlib:json"
+    assert module_of("<string>") == "<string>"
+
+
+def test_snapshot_diff_takes_a_baseline_then_reports_the_growth():
+    diagnostics = MemoryDiagnostics()
+    try:
+        assert diagnostics.snapshot_diff()["modules"] == []
+        held = [bytearray(1024) for _ in range(200)]
+        modules = diagnostics.snapshot_diff()["modules"]
+        assert any(module["module"].endswith("test_memory_diagnostics.py") and module["size_diff_bytes"] > 200 * 1024
+                   for module in modules)
+        del held
+    finally:
+        diagnostics.stop_tracing()
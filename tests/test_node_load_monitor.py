@@ -0,0 +1,20 @@
+# Copyright (c) 2024.
+# -*-coding:utf-8 -*-
+"""
+@file: test_node_load_monitor.py
+@author: Jerry(Ruihuang)Yang
+@email: rxy216@case.edu
+@time: 10/20/26 10:20
+"""
+from NodeLoadMonitor import NodeLoadMonitor
+
+
+def test_max_loop_lag_is_windowed_not_reset_by_polling(monkeypatch):
+    monkeypatch.setenv("LOOP_LAG_WINDOW_S", "60")
+    monitor = NodeLoadMonitor()
+    monitor.add_lag_sample(400.0, now=100.0)
+    monitor.add_lag_sample(5.0, now=130.0)
+    monitor.load_report(1, 0, 0)  # one poller
+    monitor.load_report(1, 0, 0)  # another one
+    assert monitor.max_loop_lag_ms(now=150.0) == 400.0
+    assert monitor.max_loop_lag_ms(now=170.0) == 5.0
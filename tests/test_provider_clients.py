@@ -0,0 +1,39 @@
+# Copyright (c) 2024.
+# -*-coding:utf-8 -*-
+"""
+@file: test_provider_clients.py
+@author: Jerry(Ruihuang)Yang
+@email: rxy216@case.edu
+@time: 10/20/26 13:10
+"""
+from ProviderClients import ProviderClients
+
+
+def build_clients(failing: str | None = None) -> ProviderClients:
+    clients = ProviderClients()
+
+    def builder(name):
+        def build():
+            if name == failing:
+                raise RuntimeError(f"no {name}")
+            return object()
+        return build
+
+    clients.builders = {name: builder(name) for name in clients.builders}
+    return clients
+
+
+def test_ready_once_every_client_is_built():
+    clients = build_clients()
+    assert not clients.ready
+    clients.warm_up()
+    assert clients.ready and clients.report()["failed"] == {}
+
+
+def test_not_ready_when_a_client_fails():
+    clients = build_clients(failing="openai")
+    clients.warm_up()
+    report = clients.report()
+    assert not clients.ready and not report["ready"]
+    assert report["failed"] == {"openai": "no openai"}
+    assert "deepgram" in report["build_ms"]
@@ -0,0 +1,79 @@
+# Copyright (c) 2024.
+# -*-coding:utf-8 -*-
+"""
+@file: test_provider_scheduler.py
+@author: Jerry(Ruihuang)Yang
+@email: rxy216@case.edu
+@time: 10/20/26 10:00
+"""
+import asyncio
+import json
+
+import pytest
+
+from ProviderScheduler import ProviderScheduler
+
+
+def build_scheduler(monkeypatch, **limit) -> ProviderScheduler:
+    monkeypatch.setenv("PROVIDER_LIMITS", json.dumps({"test": {"rate": 1000, "burst": 1000, "concurrency": 1,
+                                                               **limit}}))
+    return ProviderScheduler()
+
+
+def test_priority_first_then_round_robin_across_sessions(monkeypatch):
+    scheduler = build_scheduler(monkeypatch)
+    order = []
+
+    async def call(name, session, priority):
+        async with scheduler.async_slot("test", session, priority):
+            order.append(name)
+            await asyncio.sleep(0.01)
+
+    async def run():
+        holder = asyncio.create_task(call("holder", "x", ProviderScheduler.PRIORITY_NORMAL))
+        await asyncio.sleep(0)
+        tasks = []
+        for name, session, priority in (("a1", "a", ProviderScheduler.PRIORITY_NORMAL),
+                                        ("a2", "a", ProviderScheduler.PRIORITY_NORMAL),
+                                        ("b1", "b", ProviderScheduler.PRIORITY_NORMAL),
+                                        ("bg", "c", ProviderScheduler.PRIORITY_BACKGROUND),
+                                        ("first", "c", ProviderScheduler.PRIORITY_FIRST)):
+            tasks.append(asyncio.create_task(call(name, session, priority)))
+            await asyncio.sleep(0)
+        await asyncio.gather(holder, *tasks)
+
+    asyncio.run(run())
+    assert order == ["holder", "first", "a1", "b1", "a2", "bg"]
+
+
+def test_token_bucket_holds_calls_over_the_burst(monkeypatch):
+    scheduler = build_scheduler(monkeypatch, rate=0, burst=2, concurrency=10)
+
+    async def run():
+        for _ in range(2):
+            async with scheduler.async_slot("test", "a"):
+                pass
+        with pytest.raises(asyncio.TimeoutError):
+            async with asyncio.timeout(0.3):
+                async with scheduler.async_slot("test", "a"):
+                    pass
+
+    asyncio.run(run())
+    stats = scheduler.stats()["test"]
+    assert stats["granted"] == 2
+    assert stats["waiting"] == 0  # the cancelled call left the queue
+    assert stats["active"] == 0
+
+
+def test_sync_slot_from_worker_threads(monkeypatch):
+    scheduler = build_scheduler(monkeypatch, concurrency=2)
+
+    def call():
+        with scheduler.slot("test", "a"):
+            return scheduler.stats()["test"]["active"]
+
+    async def run():
+        return await asyncio.gather(*(asyncio.to_thread(call) for _ in range(6)))
+
+    assert max(asyncio.run(run())) <= 2
+    assert scheduler.stats()["test"]["granted"] == 6
@@ -0,0 +1,47 @@
+# Copyright (c) 2024.
+# -*-coding:utf-8 -*-
+"""
+@file: test_server_turn.py
+@author: Jerry(Ruihuang)Yang
+@email: rxy216@case.edu
+@time: 10/20/26 13:30
+"""
+from ServerTurn import ServerTurn
+
+
+def test_speech_final_ends_the_utterance_with_all_final_segments():
+    turn = ServerTurn("agent", "thread")
+    assert turn.add_transcript("I think", False, False) is None
+    assert turn.candidate_text() == "I think"
+    assert turn.add_transcript("I think the market", True, False) is None
+    assert turn.add_transcript("is big", False, False) is None
+    assert turn.candidate_text() == "I think the market is big"
+    assert turn.add_transcript("is about ten billion.", True, True) == "I think the market is about ten billion."
+    assert turn.candidate_text() == ""
+
+
+def test_empty_speech_final_still_closes_the_utterance():
+    turn = ServerTurn("agent", "thread")
+    turn.add_transcript("Okay.", True, False)
+    assert turn.add_transcript("", True, True) == "Okay."
+    assert turn.add_transcript("", True, True) is None  # nothing final was said since
+
+
+def test_utterance_end_closes_what_endpointing_missed():
+    turn = ServerTurn("agent", "thread")
+    turn.add_transcript("Let me think", True, False)
+    turn.add_transcript("about", False, False)
+    assert turn.end_utterance() == "Let me think"  # interim words are not part of the utterance
+    assert turn.end_utterance() is None
+
+
+def test_history_follows_the_client_context_and_completed_turns():
+    turn = ServerTurn("agent", "thread")
+    turn.update_context({"messages": {0: {"role": "assistant", "content": "Hello.", "step": 0}}, "current_step": "1",
+                         "provider": "anthropic"})
+    assert turn.next_messages("Hi.") == {"0": {"role": "assistant", "content": "Hello.", "step": 0},
+                                         "1": {"role": "user", "content": "Hi.", "step": 1}}
+    turn.commit("Hi.", "Let's start.")
+    assert turn.messages["2"] == {"role": "assistant", "content": "Let's start.", "step": 1}
+    assert turn.provider == "anthropic"
+    assert turn.stats() == {"turns": 1, "interrupted": 0, "messages": 3, "current_step": 1}
@@ -0,0 +1,70 @@
+# Copyright (c) 2024.
+# -*-coding:utf-8 -*-
+"""
+@file: test_session_resume.py
+@author: Jerry(Ruihuang)Yang
+@email: rxy216@case.edu
+@time: 10/20/26 12:50
+"""
+import asyncio
+
+from SessionResume import SessionResume
+
+
+def build_resume(monkeypatch, grace_s: str = "0.05") -> SessionResume:
+    monkeypatch.setenv("RESUME_GRACE_S", grace_s)
+    monkeypatch.setenv("RESUME_MAX_BUFFERED_EVENTS", "2")
+    return SessionResume()
+
+
+def test_resume_is_off_by_default(monkeypatch):
+    monkeypatch.delenv("RESUME_GRACE_S", raising=False)
+    session_resume = SessionResume()
+    assert session_resume.issue("sid", "thread") is None
+
+    async def park():
+        return session_resume.park("sid", None)
+
+    assert asyncio.run(park()) is False
+
+
+def test_parked_session_expires_after_the_window(monkeypatch):
+    session_resume = build_resume(monkeypatch)
+    token = session_resume.issue("sid", "thread")
+    closed = []
+
+    async def on_expire(sid):
+        closed.append(sid)
+
+    async def run():
+        assert session_resume.park("sid", on_expire)
+        assert session_resume.find(token, "thread") == "sid"
+        await asyncio.sleep(0.1)
+
+    asyncio.run(run())
+    assert closed == ["sid"]
+    assert session_resume.find(token, "thread") is None
+    assert session_resume.stats()["expired"] == 1
+
+
+def test_resume_within_the_window_returns_the_buffered_events(monkeypatch):
+    session_resume = build_resume(monkeypatch)
+    token = session_resume.issue("sid", "thread")
+    closed = []
+
+    async def on_expire(sid):
+        closed.append(sid)
+
+    async def run():
+        session_resume.park("sid", on_expire)
+        for i in range(3):
+            assert session_resume.buffer("sid", "downlink_stt_result", i)
+        assert session_resume.find(token, "other_thread") is None  # the token only resumes its own interview
+        resumed = session_resume.resume(session_resume.find(token, "thread"))
+        await asyncio.sleep(0.1)
+        return resumed
+
+    events, dropped = asyncio.run(run())
+    assert events == [("downlink_stt_result", 1), ("downlink_stt_result", 2)] and dropped == 1
+    assert closed == []
+    assert session_resume.buffer("sid", "downlink_stt_result", 3) is False
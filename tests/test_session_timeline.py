@@ -0,0 +1,64 @@
+# Copyright (c) 2024.
+# -*-coding:utf-8 -*-
+"""
+@file: test_session_timeline.py
+@author: Jerry(Ruihuang)Yang
+@email: rxy216@case.edu
+@time: 10/20/26 16:10
+"""
+import json
+import os
+
+from SessionTimeline import SessionTimeline
+
+
+def build_timeline(tmp_path, monkeypatch, keep_interim=False) -> SessionTimeline:
+    monkeypatch.setenv("TIMING_KEEP_INTERIM", "1" if keep_interim else "0")
+    return SessionTimeline(str(tmp_path / "session.timeline.part"))
+
+
+def write_and_load(timeline, tmp_path, fields) -> dict:
+    json_file_path = tmp_path / "session.json"
+    timeline.write_metadata(str(json_file_path), fields)
+    with open(json_file_path) as data_file:
+        return json.load(data_file)
+
+
+def test_metadata_file_keeps_its_format(tmp_path, monkeypatch):
+    timeline = build_timeline(tmp_path, monkeypatch)
+    timeline.add_segment("hello there", True, True, 0.5, 1.25, 1000)
+    metadata = write_and_load(timeline, tmp_path, {"thread_id": "t", "audio_timestamps": ["stale"],
+                                                   "audio_pause_timestamps": [[1, 2]]})
+    assert metadata == {"thread_id": "t", "audio_pause_timestamps": [[1, 2]],
+                        "audio_timestamps": [{"text": "hello there", "is_final": True, "speech_final": True,
+                                              "start": 0.5, "duration": 1.25, "timestamp": 1000}]}
+    assert not os.path.exists(timeline.spool_path)
+
+
+def test_metadata_file_without_fields_or_segments(tmp_path, monkeypatch):
+    timeline = build_timeline(tmp_path, monkeypatch)
+    assert write_and_load(timeline, tmp_path, {}) == {"audio_timestamps": []}
+    timeline.add_segment("late", True, False, 0.0, 0.1, 1)  # closed, dropped
+    assert timeline.texts == []
+
+
+def test_interim_segments_are_only_kept_when_asked(tmp_path, monkeypatch):
+    for keep_interim, expected in ((False, ["final"]), (True, ["interim", "final"])):
+        timeline = build_timeline(tmp_path, monkeypatch, keep_interim)
+        timeline.add_segment("interim", False, False, 0.0, 0.5, 1)
+        timeline.add_segment("final", True, False, 0.0, 0.6, 2)
+        metadata = write_and_load(timeline, tmp_path, {"thread_id": "t"})
+        assert [segment["text"] for segment in metadata["audio_timestamps"]] == expected
+
+
+def test_segments_spooled_over_several_flushes_are_written_in_order(tmp_path, monkeypatch):
+    timeline = build_timeline(tmp_path, monkeypatch)
+    count = SessionTimeline.FLUSH_EVERY * 2 + 5
+    for i in range(count):
+        timeline.add_segment(f'say "{i}"', True, i % 2 == 0, i * 0.5, 0.4, 1000 + i)
+    assert timeline.rows_written == SessionTimeline.FLUSH_EVERY * 2 and len(timeline.texts) == 5
+    metadata = write_and_load(timeline, tmp_path, {"thread_id": "t"})
+    segments = metadata["audio_timestamps"]
+    assert [segment["text"] for segment in segments] == [f'say "{i}"' for i in range(count)]
+    assert segments[-1] == {"text": f'say "{count - 1}"', "is_final": True, "speech_final": (count - 1) % 2 == 0,
+                            "start": (count - 1) * 0.5, "duration": 0.4, "timestamp": 1000 + count - 1}
@@ -0,0 +1,47 @@
+# Copyright (c) 2024.
+# -*-coding:utf-8 -*-
+"""
+@file: test_session_trace_recorder.py
+@author: Jerry(Ruihuang)Yang
+@email: rxy216@case.edu
+@time: 10/20/26 11:40
+"""
+import base64
+import glob
+import gzip
+import json
+
+from SessionTraceRecorder import SessionTrace, SessionTraceRecorder
+
+
+def read_records(trace_dir) -> list[dict]:
+    (trace_path,) = glob.glob(f"{trace_dir}/*.trace.jsonl.gz")
+    with gzip.open(trace_path, "rt") as trace_file:
+        return [json.loads(line) for line in trace_file]
+
+
+def test_trace_redacts_credentials_and_keeps_the_rest(tmp_path, monkeypatch):
+    monkeypatch.setenv("SESSION_TRACE_DIR", str(tmp_path))
+    monkeypatch.setenv("SESSION_TRACE_AUDIO", "1")
+    recorder = SessionTraceRecorder()
+    auth = {"token": "7d1c2f9e-0000-4000-8000-000000000000", "resume_token": "secret", "tts_encoding": "opus"}
+    trace = recorder.open("sid", auth["token"], "agent", auth)
+    trace.record("chat", message=SessionTrace.redact({"dynamic_auth_code": "abc", "thread_id": auth["token"],
+                                                      "messages": {"0": {"role": "user", "content": "hi"}}}))
+    trace.audio(b"\x01\x02")
+    trace.close()
+    trace.record("stt", text="late")  # after close, dropped
+    recorder.flush()
+
+    connect, chat, audio, disconnect = read_records(tmp_path)
+    assert connect["auth"] == {"token": "redacted", "resume_token": "redacted", "tts_encoding": "opus"}
+    assert chat["message"]["dynamic_auth_code"] == "redacted" and chat["message"]["thread_id"] == "redacted"
+    assert chat["message"]["messages"]["0"]["content"] == "hi"
+    assert base64.b64decode(audio["data"]) == b"\x01\x02" and audio["size"] == 2
+    assert disconnect["type"] == "disconnect"
+    assert "7d1c2f9e-0000" not in json.dumps([connect, chat])
+
+
+def test_capture_mode_off_records_nothing(monkeypatch):
+    monkeypatch.delenv("SESSION_TRACE_DIR", raising=False)
+    assert SessionTraceRecorder().open("sid", "thread", "agent", {}) is None
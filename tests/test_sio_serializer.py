@@ -0,0 +1,26 @@
+# Copyright (c) 2024.
+# -*-coding:utf-8 -*-
+"""
+@file: test_sio_serializer.py
+@author: Jerry(Ruihuang)Yang
+@email: rxy216@case.edu
+@time: 10/20/26 12:30
+"""
+from SioSerializer import SioSerializer
+
+
+def test_protocol_version_is_checked_and_parsed_safely(monkeypatch):
+    monkeypatch.setenv("SIO_SERIALIZER", "msgpack")
+    serializer = SioSerializer()
+    assert serializer.protocol_info() == {"protocol_version": 1, "serializer": "msgpack"}
+    assert serializer.accepts({})
+    assert serializer.accepts({"protocol_version": "1"})
+    assert not serializer.accepts({"protocol_version": 2})
+    assert not serializer.accepts({"protocol_version": "one"})
+    assert not serializer.accepts({"protocol_version": None})
+
+
+def test_unknown_mode_falls_back_to_json(monkeypatch):
+    monkeypatch.setenv("SIO_SERIALIZER", "yaml")
+    serializer = SioSerializer()
+    assert serializer.wire_format == "json" and serializer.server_options() == {}
@@ -0,0 +1,97 @@
+# Copyright (c) 2024.
+# -*-coding:utf-8 -*-
+"""
+@file: test_speculative_reply.py
+@author: Jerry(Ruihuang)Yang
+@email: rxy216@case.edu
+@time: 10/20/26 16:40
+"""
+import asyncio
+
+import pytest
+
+from SpeculativeReply import SpeculativeReply
+
+
+@pytest.fixture(autouse=True)
+def reset_counters(monkeypatch):
+    for name in ("started", "hits", "misses", "wasted_tokens", "committed_tokens"):
+        monkeypatch.setattr(SpeculativeReply, name, 0)
+
+
+def provider_stream(tokens, closed: list, error: Exception | None = None, hang: bool = False):
+    async def stream():
+        try:
+            for token in tokens:
+                yield token
+            if error is not None:
+                raise error
+            if hang:
+                await asyncio.Event().wait()
+        finally:
+            closed.append(True)
+
+    return stream()
+
+
+async def collect(token_stream) -> list:
+    return [token async for token in token_stream]
+
+
+def test_transcripts_match_by_their_words():
+    assert SpeculativeReply.normalize("Well, I'd say  THE market is big!") == "well i'd say the market is big"
+
+    async def run():
+        speculation = SpeculativeReply("I think so.", None, provider_stream([], []))
+        await speculation.task
+        return speculation
+
+    speculation = asyncio.run(run())
+    assert speculation.matches("i think so") and not speculation.matches("I think so, maybe")
+
+
+def test_commit_replays_the_held_tokens_after_the_provider_finished():
+    closed = []
+
+    async def run():
+        speculation = SpeculativeReply("hi", None, provider_stream(["a", "b", "c"], closed))
+        await speculation.task
+        token_stream = speculation.commit()
+        assert SpeculativeReply.hits == 0  # not read yet, the turn may still be refused
+        return await collect(token_stream)
+
+    assert asyncio.run(run()) == ["a", "b", "c"]
+    assert closed == [True]
+    assert SpeculativeReply.stats() == {"started": 1, "hits": 1, "misses": 0, "hit_rate": 1.0, "wasted_tokens": 0,
+                                        "committed_tokens": 3}
+
+
+def test_cancel_stops_the_provider_and_counts_the_waste():
+    closed = []
+
+    async def run():
+        speculation = SpeculativeReply("hi", None, provider_stream(["a", "b"], closed, hang=True))
+        await asyncio.sleep(0.01)
+        speculation.commit()  # refused by start_chat_turn, never read
+        speculation.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await speculation.task
+
+    asyncio.run(run())
+    assert closed == [True]
+    assert SpeculativeReply.stats() == {"started": 1, "hits": 0, "misses": 1, "hit_rate": 0.0, "wasted_tokens": 2,
+                                        "committed_tokens": 0}
+
+
+def test_provider_error_is_raised_to_the_turn():
+    async def run():
+        speculation = SpeculativeReply("hi", None, provider_stream(["a"], [], error=RuntimeError("provider down")))
+        await speculation.task
+        assert not speculation.matches("hi")
+        tokens = []
+        with pytest.raises(RuntimeError, match="provider down"):
+            async for token in speculation.commit():
+                tokens.append(token)
+        return tokens
+
+    assert asyncio.run(run()) == ["a"]
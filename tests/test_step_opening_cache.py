@@ -0,0 +1,52 @@
+# Copyright (c) 2024.
+# -*-coding:utf-8 -*-
+"""
+@file: test_step_opening_cache.py
+@author: Jerry(Ruihuang)Yang
+@email: rxy216@case.edu
+@time: 10/20/26 12:10
+"""
+import json
+from types import SimpleNamespace
+
+from PromptManager import PromptManager
+from StepOpeningCache import StepOpeningCache
+from TtsStream import TtsStream
+
+STEP_PROMPT = json.dumps({"instruction": PromptManager.STEPS[1]["instruction"],
+                          "information": PromptManager.STEPS[1]["information"]})
+
+
+class FakePromptHandler:
+    def get_agent_prompt(self, agent_id: str, step: str):
+        return STEP_PROMPT if step == "1" else None
+
+
+class FakeOpenAI:
+    def __init__(self):
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    @staticmethod
+    def create(**kwargs):
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content="Let's start the market."))])
+
+
+def test_disabled_cache_has_no_workers(monkeypatch):
+    monkeypatch.setenv("STEP_OPENING_PRECOMPUTE", "0")
+    cache = StepOpeningCache()
+    assert cache.executor is None
+    cache.submit_agent("agent", FakeOpenAI(), "mp3")
+    assert cache.get("agent", "1", STEP_PROMPT, "mp3") is None
+
+
+def test_precomputed_opening_is_served(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("STEP_OPENING_PRECOMPUTE", "1")
+    monkeypatch.setattr(TtsStream, "synthesize", lambda self, text: b"audio of " + text.encode())
+    cache = StepOpeningCache()
+    cache.precompute_agent("agent", FakeOpenAI(), "mp3", FakePromptHandler())
+    opening = cache.get("agent", "1", STEP_PROMPT, "mp3")
+    assert opening == {"text": "Let's start the market.", "audio": b"audio of Let's start the market."}
+    assert cache.stats()["precomputed"] == 1 and cache.stats()["hits"] == 1
+    assert cache.get("agent", "1", STEP_PROMPT + " edited", "mp3") is None  # an edited prompt is a new entry
+    cache.executor.shutdown()
@@ -0,0 +1,55 @@
+# Copyright (c) 2024.
+# -*-coding:utf-8 -*-
+"""
+@file: test_tts_phrase_cache.py
+@author: Jerry(Ruihuang)Yang
+@email: rxy216@case.edu
+@time: 10/20/26 10:40
+"""
+from TtsPhraseCache import TtsPhraseCache
+
+
+def build_cache(monkeypatch, **env) -> TtsPhraseCache:
+    monkeypatch.setenv("TTS_CACHE_TIER", "")
+    for name, value in env.items():
+        monkeypatch.setenv(name, str(value))
+    return TtsPhraseCache()
+
+
+def test_key_keeps_case_and_collapses_whitespace(monkeypatch):
+    cache = build_cache(monkeypatch)
+    assert cache.make_key(" Okay.  ", "voice") == cache.make_key("Okay.", "voice")
+    assert cache.make_key("US", "voice") != cache.make_key("us", "voice")
+    assert cache.make_key("Okay.", "voice", "mp3") != cache.make_key("Okay.", "voice", "opus")
+
+
+def test_lru_evicts_least_recently_used_entry(monkeypatch):
+    cache = build_cache(monkeypatch, TTS_CACHE_MEMORY_MAX_ENTRIES=2)
+    cache.put("a", b"1")
+    cache.put("b", b"2")
+    assert cache.get("a") == b"1"  # a is now the most recent
+    cache.put("c", b"3")
+    assert cache.get("b") is None
+    assert cache.get("a") == b"1" and cache.get("c") == b"3"
+    stats = cache.stats()
+    assert stats["evictions"] == 1 and stats["entries"] == 2 and stats["misses"] == 1
+
+
+def test_lru_respects_the_byte_limit(monkeypatch):
+    cache = build_cache(monkeypatch, TTS_CACHE_MEMORY_MAX_BYTES=10)
+    cache.put("a", b"x" * 6)
+    cache.put("b", b"y" * 6)
+    assert cache.get("a") is None
+    assert cache.memory_bytes == 6
+
+
+def test_disk_tier_serves_after_memory_eviction_and_trims_to_its_limit(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    cache = build_cache(monkeypatch, TTS_CACHE_TIER="disk", TTS_CACHE_MEMORY_MAX_ENTRIES=1,
+                        TTS_CACHE_DISK_MAX_BYTES=25)
+    cache.put("a", b"a" * 10)
+    cache.put("b", b"b" * 10)  # a leaves memory, stays on disk
+    assert cache.get("a") == b"a" * 10
+    assert cache.stats()["hits_second_tier"] == 1
+    cache.put("c", b"c" * 10)  # 30 bytes on disk, trimmed to 90% of 25
+    assert cache.disk_bytes <= 25 * 0.9
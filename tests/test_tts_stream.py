@@ -0,0 +1,74 @@
+# Copyright (c) 2024.
+# -*-coding:utf-8 -*-
+"""
+@file: test_tts_stream.py
+@author: Jerry(Ruihuang)Yang
+@email: rxy216@case.edu
+@time: 10/20/26 10:00
+"""
+import asyncio
+import threading
+
+from TtsStream import TtsStream
+
+
+def test_stream_tts_returns_before_the_synthesis(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    release = threading.Event()
+    tts = TtsStream("session")
+
+    def synthesize(text, priority):
+        release.wait(5)
+        return b"audio of " + text.encode()
+
+    tts._TtsStream__synthesize = synthesize
+    tts.stream_tts("Hello there [pause] friend, how are you doing today?", "1")
+    synthesis = TtsStream.get_in_progress("session", "1")
+    assert synthesis is not None and not synthesis["done"].is_set()
+    assert TtsStream.queue_depth() == 1
+
+    release.set()
+    asyncio.run(TtsStream.wait_done(synthesis))
+    file_location, media_type = TtsStream.find_audio_file("session", "1")
+    with open(file_location, "rb") as f:
+        assert f.read() == b"audio of Hello there  friend, how are you doing today?"
+    assert media_type == "audio/mpeg"
+    assert TtsStream.get_in_progress("session", "1") is None
+    assert TtsStream.queue_depth() == 0
+
+
+def build_synthesis(path) -> dict:
+    return {"path": str(path), "done": threading.Event(), "started": threading.Event(), "progressive": True}
+
+
+def test_wait_started_reports_a_failed_synthesis(tmp_path, monkeypatch):
+    monkeypatch.setattr(TtsStream, "STREAM_POLL_S", 0.001)
+    synthesis = build_synthesis(tmp_path / "chunk.mp3")
+    synthesis["done"].set()  # Deepgram answered an error, no audio file was opened
+    assert asyncio.run(TtsStream.wait_started(synthesis)) is False
+    synthesis["started"].set()
+    assert asyncio.run(TtsStream.wait_started(synthesis)) is True
+
+
+def test_iter_progressive_times_out_on_idle_not_on_total_time(tmp_path, monkeypatch):
+    monkeypatch.setattr(TtsStream, "STREAM_POLL_S", 0.01)
+    monkeypatch.setattr(TtsStream, "STREAM_TIMEOUT_S", 0.05)
+    path = tmp_path / "chunk.mp3"
+    synthesis = build_synthesis(path)
+
+    def write_slowly():
+        with open(path, "wb") as f:
+            for _ in range(5):  # 5 writes 0.03 s apart, longer than the timeout in total
+                f.write(b"ab")
+                f.flush()
+                threading.Event().wait(0.03)
+        synthesis["done"].set()
+
+    async def collect():
+        return b"".join([data async for data in TtsStream.iter_progressive(synthesis)])
+
+    writer = threading.Thread(target=write_slowly)
+    writer.start()
+    audio = asyncio.run(collect())
+    writer.join()
+    assert audio == b"ab" * 5
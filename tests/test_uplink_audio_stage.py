@@ -0,0 +1,177 @@
+# Copyright (c) 2024.
+# -*-coding:utf-8 -*-
+"""
+@file: test_uplink_audio_stage.py
+@author: Jerry(Ruihuang)Yang
+@email: rxy216@case.edu
+@time: 10/20/26 15:00
+"""
+import asyncio
+import threading
+
+from UplinkAudioStage import UplinkAudioStage
+
+
+class FakeConnection:
+    def __init__(self):
+        self.sent = []
+        self.release = threading.Event()
+        self.release.set()
+
+    def send(self, data):
+        self.release.wait(5)
+        self.sent.append(data)
+
+
+def build_stage(monkeypatch, connection, sample_rate=None, **env) -> tuple[UplinkAudioStage, list]:
+    for name, value in env.items():
+        monkeypatch.setenv(name, str(value))
+    pressure = []
+    stage = UplinkAudioStage("sid", lambda: connection, sample_rate, pressure.append)
+    stage.set_connection_open(True)
+    return stage, pressure
+
+
+def test_frames_are_merged_into_windows_and_flushed_by_the_timer(monkeypatch):
+    connection = FakeConnection()
+
+    async def run():
+        stage, _ = build_stage(monkeypatch, connection, UPLINK_COALESCE_WINDOW_MS=30)
+        stage.push(b"a")
+        stage.push(b"b")
+        assert connection.sent == []  # the window is still open
+        await asyncio.sleep(0.1)  # the client went quiet, the timer sends the window
+        stage.push(b"c")
+        await stage.close()
+        return stage
+
+    stage = asyncio.run(run())
+    assert connection.sent == [b"ab", b"c"]
+    assert stage.stats()["frames_in"] == 3 and stage.stats()["batches_sent"] == 2
+
+
+def test_pcm_drops_the_oldest_batch_when_deepgram_is_behind(monkeypatch):
+    connection = FakeConnection()
+    connection.release.clear()
+
+    async def run():
+        stage, pressure = build_stage(monkeypatch, connection, sample_rate=16000, UPLINK_COALESCE_WINDOW_MS=0,
+                                      UPLINK_MAX_QUEUED_BATCHES=2)
+        for frame in (b"1", b"2", b"3", b"4", b"5"):
+            stage.push(frame)
+            await asyncio.sleep(0.01)  # the first batch is taken by the sender, which is stuck in send
+        connection.release.set()
+        await stage.close()
+        return stage, pressure
+
+    stage, pressure = asyncio.run(run())
+    assert connection.sent == [b"1", b"4", b"5"]
+    assert stage.stats()["dropped_batches"] == 2 and pressure == []
+
+
+def test_container_stream_is_held_and_the_client_paused_never_dropped(monkeypatch):
+    connection = FakeConnection()
+    connection.release.clear()
+
+    async def run():
+        stage, pressure = build_stage(monkeypatch, connection, UPLINK_COALESCE_WINDOW_MS=0,
+                                      UPLINK_MAX_QUEUED_BATCHES=2)
+        for frame in (b"1", b"2", b"3", b"4", b"5"):
+            stage.push(frame)
+            await asyncio.sleep(0.01)
+        assert pressure == [True] and stage.queued_bytes() == 4
+        connection.release.set()
+        await asyncio.sleep(0.1)
+        await stage.close()
+        return stage, pressure
+
+    stage, pressure = asyncio.run(run())
+    assert b"".join(connection.sent) == b"12345"
+    assert pressure == [True, False]
+    assert stage.stats()["dropped_bytes"] == 0
+
+
+def test_container_stream_over_the_pending_limit_stops_transcription(monkeypatch):
+    connection = FakeConnection()
+    connection.release.clear()
+
+    async def run():
+        stage, pressure = build_stage(monkeypatch, connection, UPLINK_COALESCE_WINDOW_MS=0,
+                                      UPLINK_MAX_QUEUED_BATCHES=1, UPLINK_MAX_PENDING_BYTES=4)
+        for frame in (b"11", b"22", b"33", b"44", b"55"):
+            stage.push(frame)
+            await asyncio.sleep(0.01)
+        stage.push(b"66")  # ignored, the stream is overrun
+        connection.release.set()
+        await stage.close()
+        return stage, pressure
+
+    stage, pressure = asyncio.run(run())
+    assert stage.stats()["overrun"] and pressure == [True, False]
+    assert connection.sent == [b"11", b"22"]
+
+
+def test_close_drains_the_queue_and_the_open_window(monkeypatch):
+    connection = FakeConnection()
+
+    async def run():
+        stage, _ = build_stage(monkeypatch, connection, UPLINK_COALESCE_WINDOW_MS=10000)
+        stage.set_connection_open(False)  # nothing can be sent until the connection opens
+        stage.push(b"a")
+        stage.push(b"b")
+        close = asyncio.create_task(stage.close())
+        await asyncio.sleep(0.01)
+        assert connection.sent == []
+        stage.set_connection_open(True)
+        await close
+        stage.push(b"late")  # closed stages take no more audio
+        return stage
+
+    stage = asyncio.run(run())
+    assert connection.sent == [b"ab"]
+    assert stage.sender_task.cancelled() or stage.sender_task.done()
+
+
+def test_audio_waits_for_a_slow_open_instead_of_being_dropped(monkeypatch):
+    connection = FakeConnection()
+    holder = {}
+
+    async def run():
+        monkeypatch.setenv("UPLINK_COALESCE_WINDOW_MS", "0")
+        stage = UplinkAudioStage("sid", lambda: holder.get("connection"), 16000)
+        stage.push(b"first")
+        await asyncio.sleep(0.2)  # the open is held back by the provider scheduler
+        holder["connection"] = connection
+        stage.set_connection_open(True)
+        await stage.close()
+        return stage
+
+    stage = asyncio.run(run())
+    assert connection.sent == [b"first"] and stage.stats()["dropped_bytes"] == 0
+
+
+def test_stt_times_are_mapped_back_across_drops_and_reopens(monkeypatch):
+    connection = FakeConnection()
+    connection.release.clear()
+    frame_100ms = b"\x00" * 3200  # 16 kHz linear16
+
+    async def run():
+        stage, _ = build_stage(monkeypatch, connection, sample_rate=16000, UPLINK_COALESCE_WINDOW_MS=0,
+                               UPLINK_MAX_QUEUED_BATCHES=2)
+        for _ in range(5):
+            stage.push(frame_100ms)
+            await asyncio.sleep(0.01)
+        connection.release.set()
+        await asyncio.sleep(0.1)
+        stage.set_connection_open(False)  # idle teardown
+        generation = stage.set_connection_open(True)
+        stage.push(frame_100ms)
+        await stage.close()
+        return stage, generation
+
+    stage, generation = asyncio.run(run())
+    # the first connection heard input 0-100 ms, then 300-500 ms after two batches were dropped
+    assert stage.to_input_time(generation - 1, 0.05, 0.05) == (0.05, 0.05)
+    assert stage.to_input_time(generation - 1, 0.12, 0.05) == (0.32, 0.05)
+    # the second connection restarts at 0, which is 500 ms into the input
+    assert stage.to_input_time(generation, 0.02, 0.05) == (0.52, 0.05)
@@ -0,0 +1,61 @@
+# Copyright (c) 2024.
+# -*-coding:utf-8 -*-
+"""
+@file: test_voice_activity_gate.py
+@author: Jerry(Ruihuang)Yang
+@email: rxy216@case.edu
+@time: 10/20/26 11:05
+"""
+from array import array
+
+from VoiceActivityGate import VoiceActivityGate
+
+SAMPLE_RATE = 16000
+FRAME_MS = 100
+
+
+def frame(amplitude: int) -> bytes:
+    samples = SAMPLE_RATE * FRAME_MS // 1000
+    return array("h", [amplitude if i % 2 else -amplitude for i in range(samples)]).tobytes()
+
+
+SPEECH = frame(3000)
+SILENCE = frame(0)
+
+
+def build_gate(monkeypatch) -> VoiceActivityGate:
+    monkeypatch.setenv("VAD_THRESHOLD_RMS", "500")
+    monkeypatch.setenv("VAD_HANGOVER_MS", "300")
+    monkeypatch.setenv("VAD_PREROLL_MS", "200")
+    return VoiceActivityGate(SAMPLE_RATE)
+
+
+def feed(gate: VoiceActivityGate, frames: list[bytes]) -> int:
+    return sum(len(gate.process(f)) for f in frames)
+
+
+def test_silence_is_held_back_and_preroll_released_on_onset(monkeypatch):
+    gate = build_gate(monkeypatch)
+    assert feed(gate, [SILENCE] * 10) == 0
+    forwarded = gate.process(SPEECH)
+    assert forwarded == [SILENCE, SILENCE, SPEECH]  # 200 ms of preroll, then the voiced frame
+
+
+def test_speech_and_pause_intervals_in_audio_time(monkeypatch):
+    gate = build_gate(monkeypatch)
+    feed(gate, [SILENCE] * 10 + [SPEECH] * 5 + [SILENCE] * 10 + [SPEECH] * 3)
+    timing = gate.timing_data()
+    # the first interval starts at the preroll and ends where the silence started
+    assert timing["vad_speech_intervals"] == [[800, 1500], [2300, 2800]]
+    assert timing["vad_pause_intervals"] == [[0, 800], [1500, 2300]]
+    assert timing["vad_audio_ms"] == 2800
+
+
+def test_stt_times_are_mapped_back_to_the_recording(monkeypatch):
+    gate = build_gate(monkeypatch)
+    feed(gate, [SILENCE] * 10 + [SPEECH] * 5 + [SILENCE] * 10 + [SPEECH] * 3)
+    # forwarded: 800-1800 ms (preroll, speech, hangover) is gated 0-1000, 2300-2800 ms is gated 1000-1500
+    assert gate.to_recording_time(0.2, 0.5) == (1.0, 0.5)
+    assert gate.to_recording_time(1.1, 0.2) == (2.4, 0.2)
+    # a result ending on a span boundary stays in its span
+    assert gate.to_recording_time(0.5, 0.5) == (1.3, 0.5)